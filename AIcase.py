@@ -5,117 +5,102 @@
 
 import json
 import logging
-import threading
+import functools
+import os
 from flask import Flask, request, jsonify
 
 # 导入配置和工具模块
 import config
 from utils import (
     extract_doc_url,
-    build_rich_text_message,
     send_feishu_message,
     is_mention_bot,
     get_message_content,
     get_chat_id,
+    admin_token_error,
     logger
 )
-
-# 导入 Coze SDK
-from cozepy import Coze, TokenAuth, Stream, WorkflowEvent, WorkflowEventType, COZE_CN_BASE_URL
+from deadline import RunDeadline, active_runs
+from hedging import workflow_hedging
+from circuit_breaker import breaker_states, STATE_OPEN
+from run_history import run_history, query_from_args
+from concurrency import workflow_limiter
+from scheduler import workflow_scheduler, CLASS_BOT
+from fair_queue import chat_queue
+from workflow_engine import WorkflowEngine, active_transcripts
+from coordination import coordinator, WorkQueue, CoordinationError, claim_once
+from config_reload import config_reloader
+import profiler
+import memory_diagnostics
+from feishu_ws import FeishuLongConnection
 
 # 创建 Flask 应用
 app = Flask(__name__)
 
-# 初始化 Coze 客户端
-coze_client = Coze(
-    auth=TokenAuth(token=config.COZE_API_TOKEN),
-    base_url=config.COZE_API_BASE
-)
+# 按需性能分析（见 config.PROFILING_TOKEN）
+profiler.install(app)
+
+# 配置热更新：监听 SIGHUP 与配置文件修改（见 config.CONFIG_FILE；Coze 客户端的重建见 workflow_engine）
+config_reloader.start_watching()
+
+# 群聊消息的共享工作队列（COORDINATION_BACKEND 为 redis 时使用，已处理消息的去重见 coordination.claim_once）
+bot_queue = WorkQueue("bot_events")
+
+# 飞书长连接客户端（FEISHU_EVENT_MODE 为 long_connection 时在 main 中启动）
+feishu_connection = None
 
-# 用于记录已处理的消息，避免重复处理
-processed_messages = set()
+# 内存诊断：统计内部结构的大小（见 config.DIAGNOSTICS_TOKEN）
+memory_diagnostics.register_gauge("coordination", coordinator.snapshot)
+memory_diagnostics.register_gauge("active_transcripts", lambda: {
+    "runs": len(active_transcripts),
+    "bytes": sum(transcript.retained_bytes for transcript in list(active_transcripts.values()))
+})
+memory_diagnostics.register_gauge("active_runs", active_runs)
+memory_diagnostics.register_gauge("chat_queued", lambda: chat_queue.snapshot()["queued"])
+memory_diagnostics.register_gauge("run_history", run_history.stats)
+memory_diagnostics.register_gauge("scheduler_queued", lambda: {
+    cls: stats["queued"] for cls, stats in workflow_scheduler.snapshot().items()
+})
+memory_diagnostics.install(app)
+
+
+# 工作流运行引擎：与 api.py 相同的运行流程，结果发送到触发消息的群聊，失败（含被拒绝）时发送错误消息
+workflow_engine = WorkflowEngine("bot", transport=send_feishu_message, notify_rejected=True)
 
 
 def handle_workflow_stream(
     workflow_id: str,
     doc_url: str,
-    chat_id: str
+    chat_id: str,
+    deadline: RunDeadline = None,
+    client=None
 ):
     """
-    处理 Coze 工作流的流式响应
+    处理 Coze 工作流的流式响应，并把结果发送到群聊
     
     Args:
         workflow_id: 工作流 ID
         doc_url: 文档链接
         chat_id: 飞书群组 ID
+        deadline: 本次运行的时限（可选），覆盖流式调用和通知发送
+        client: 提供 workflows.runs.stream/resume 的客户端（可选，默认使用全局 Coze 客户端，
+                回放录制时传入 stream_recorder.ReplayClient）
     """
+    own_deadline = deadline is None
+    if own_deadline:
+        deadline = RunDeadline(config.WORKFLOW_RUN_TIMEOUT)
+    
     try:
-        logger.info(f"开始调用工作流: workflow_id={workflow_id}, doc_url={doc_url}")
-        
-        # 收集工作流的输出结果
-        workflow_results = []
-        
-        # 调用工作流（流式）
-        stream = coze_client.workflows.runs.stream(
-            workflow_id=workflow_id,
-            parameters={
-                "doc_url": doc_url
-            }
-        )
-        
-        # 处理流式事件
-        for event in stream:
-            if event.event == WorkflowEventType.MESSAGE:
-                # 收到消息事件
-                message = event.message
-                logger.info(f"工作流消息: {message}")
-                if message:
-                    workflow_results.append(str(message))
-                    
-            elif event.event == WorkflowEventType.ERROR:
-                # 收到错误事件
-                error = event.error
-                logger.error(f"工作流错误: {error}")
-                workflow_results.append(f"错误: {error}")
-                
-            elif event.event == WorkflowEventType.INTERRUPT:
-                # 收到中断事件（需要人工干预）
-                logger.warning(f"工作流中断: {event.interrupt}")
-                workflow_results.append("工作流需要人工干预")
-        
-        # 工作流执行完成，构建结果消息
-        result_text = "\n".join(workflow_results) if workflow_results else "工作流执行完成"
-        
-        logger.info(f"工作流执行完成，结果: {result_text}")
-        
-        # 构建富文本消息卡片
-        message_card = build_rich_text_message(
-            doc_url=doc_url,
-            workflow_result=result_text,
-            status="success"
+        # 按群聊的优先级类别申请并发名额；被拒绝、熔断、超时时同样发送错误消息到群组
+        priority = config.SCHEDULER_CHAT_CLASSES.get(chat_id, CLASS_BOT)
+        result = workflow_engine.run(
+            doc_url, priority, deadline,
+            chat_id=chat_id, workflow_id=workflow_id, client=client
         )
-        
-        # 发送消息到飞书群
-        success = send_feishu_message(chat_id, message_card)
-        
-        if success:
-            logger.info(f"成功发送完成消息到群组: {chat_id}")
-        else:
-            logger.error(f"发送完成消息失败: chat_id={chat_id}")
-            
-    except Exception as e:
-        logger.error(f"处理工作流时发生异常: {str(e)}")
-        
-        # 发送错误消息到群组
-        try:
-            error_card = build_rich_text_message(
-                doc_url=doc_url,
-                workflow_result=f"执行异常: {str(e)}",
-                status="error"
-            )
-            send_feishu_message(chat_id, error_card)
-        except Exception as send_error:
-            logger.error(f"发送错误消息失败: {str(send_error)}")
+        logger.info(f"工作流运行结束: chat_id={chat_id}, success={result.get('success')}")
+    finally:
+        if own_deadline:
+            deadline.close()
 
 
 def process_message_async(event_data: dict):
@@ -153,17 +138,85 @@ def process_message_async(event_data: dict):
         
         logger.info(f"准备处理文档: {doc_url}, 群组: {chat_id}")
         
-        # 调用工作流处理
-        handle_workflow_stream(
-            workflow_id=config.COZE_WORKFLOW_ID,
-            doc_url=doc_url,
-            chat_id=chat_id
-        )
+        # 调用工作流处理（整个运行共享同一个时限）
+        with RunDeadline(config.WORKFLOW_RUN_TIMEOUT) as run:
+            handle_workflow_stream(
+                workflow_id=config.COZE_WORKFLOW_ID,
+                doc_url=doc_url,
+                chat_id=chat_id,
+                deadline=run
+            )
         
     except Exception as e:
         logger.error(f"异步处理消息时发生异常: {str(e)}")
 
 
+def dispatch_event(data: dict) -> bool:
+    """
+    分发一个飞书事件（HTTP 回调与长连接共用）
+    
+    Args:
+        data: 事件 JSON（已通过验证）
+    
+    Returns:
+        False 表示消息已处理过（重复推送），否则为 True
+    """
+    event_type = data.get('header', {}).get('event_type')
+    
+    if event_type != 'im.message.receive_v1':
+        logger.info(f"收到其他类型事件: {event_type}")
+        return True
+    
+    # 接收到消息事件
+    event_data = data.get('event', {})
+    
+    # 获取消息 ID，用于去重
+    message_id = event_data.get('message', {}).get('message_id')
+    
+    # 检查是否已处理过，并标记为已处理（多实例部署时所有实例共享去重记录）
+    if not claim_once(f"feishu:message:{message_id}"):
+        logger.info(f"消息已处理过，跳过: {message_id}")
+        return False
+    
+    # 多实例部署：放入共享队列，由任一实例的 worker 领取后放入该实例的群聊队列
+    if coordinator.distributed:
+        try:
+            bot_queue.submit(event_data)
+            logger.info(f"已提交消息到共享队列: {message_id}")
+            return True
+        except CoordinationError as e:
+            logger.error(f"提交共享队列失败，改为本实例处理: {str(e)}")
+    
+    enqueue_chat_event(event_data)
+    return True
+
+
+def enqueue_chat_event(event_data: dict) -> bool:
+    """
+    按群聊公平排队，由群聊队列的后台线程处理（避免阻塞回调响应，单个群聊刷屏不会占满所有线程）
+    
+    本实例收到的消息和共享队列中领取的消息都经过这里，CHAT_MAX_CONCURRENCY 对两者同样生效；
+    共享队列的任务在放入群聊队列后即确认，实例在处理前退出时该消息不会重新投递
+    
+    Args:
+        event_data: 飞书事件数据
+    
+    Returns:
+        False 表示该群聊排队消息已达上限，消息被丢弃
+    """
+    message_id = event_data.get('message', {}).get('message_id')
+    chat_id = get_chat_id(event_data) or ""
+    # 回调请求开启了分析时，处理线程一并采样
+    task = profiler.bind(process_message_async)
+    if not chat_queue.submit(chat_id, functools.partial(task, event_data)):
+        profiler.unbind(task)
+        logger.warning(f"群聊 {chat_id} 排队消息已达上限（{config.CHAT_MAX_QUEUED} 条），丢弃消息: {message_id}")
+        return False
+    
+    logger.info(f"已提交消息到群聊队列: {message_id}")
+    return True
+
+
 @app.route('/webhook', methods=['POST'])
 def webhook():
     """
@@ -189,35 +242,8 @@ def webhook():
             return jsonify({"error": "invalid token"}), 401
         
         # 3. 处理事件
-        event_type = data.get('header', {}).get('event_type')
-        
-        if event_type == 'im.message.receive_v1':
-            # 接收到消息事件
-            event_data = data.get('event', {})
-            
-            # 获取消息 ID，用于去重
-            message_id = event_data.get('message', {}).get('message_id')
-            
-            # 检查是否已处理过
-            if message_id in processed_messages:
-                logger.info(f"消息已处理过，跳过: {message_id}")
-                return jsonify({"message": "already processed"})
-            
-            # 标记为已处理
-            processed_messages.add(message_id)
-            
-            # 在后台线程中处理消息（避免阻塞回调响应）
-            thread = threading.Thread(
-                target=process_message_async,
-                args=(event_data,)
-            )
-            thread.daemon = True
-            thread.start()
-            
-            logger.info(f"已启动后台线程处理消息: {message_id}")
-            
-        else:
-            logger.info(f"收到其他类型事件: {event_type}")
+        if not dispatch_event(data):
+            return jsonify({"message": "already processed"})
         
         # 返回成功响应
         return jsonify({"message": "success"})
@@ -227,16 +253,60 @@ def webhook():
         return jsonify({"error": str(e)}), 500
 
 
+@app.route('/api/runs', methods=['GET'])
+def api_runs():
+    """
+    查询运行历史（分页）
+    
+    查询参数: doc_url, status, source, since, until, limit, offset
+    需要管理令牌（见 config.RUN_HISTORY_TOKEN）：记录中含文档链接、群组 ID 和错误信息
+    """
+    denied = admin_token_error(config.RUN_HISTORY_TOKEN, request.headers.get('X-Admin-Token'))
+    if denied:
+        message, status = denied
+        return jsonify({"error": message}), status
+    
+    try:
+        return jsonify(query_from_args(request.args))
+    except ValueError as e:
+        return jsonify({"error": f"参数错误: {str(e)}"}), 400
+    except Exception as e:
+        logger.error(f"查询运行历史异常: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+
 @app.route('/health', methods=['GET'])
 def health():
     """
     健康检查接口
     """
-    return jsonify({
-        "status": "ok",
+    circuits = breaker_states()
+    degraded = any(state['state'] == STATE_OPEN for state in circuits.values())
+    
+    result = {
+        "status": "degraded" if degraded else "ok",
         "service": "飞书机器人 + Coze 工作流",
-        "version": "1.0.0"
-    })
+        "version": "1.0.0",
+        "event_mode": config.FEISHU_EVENT_MODE,
+        "circuits": circuits,
+        "concurrency": workflow_limiter.snapshot(),
+        "scheduler": workflow_scheduler.snapshot(),
+        "chat_queue": chat_queue.snapshot(),
+        "coordination": coordinator.snapshot(),
+        "hedging": workflow_hedging.snapshot(),
+        "engine": workflow_engine.snapshot(),
+        "config": config_reloader.snapshot()
+    }
+    
+    if coordinator.distributed:
+        result["bot_queue"] = bot_queue.snapshot()
+    
+    if feishu_connection is not None:
+        result["long_connection"] = feishu_connection.snapshot()
+        if not feishu_connection.connected:
+            result["status"] = "degraded"
+    
+    return jsonify(result)
 
 
 @app.route('/', methods=['GET'])
@@ -249,7 +319,9 @@ def index():
     <p>服务运行中...</p>
     <ul>
         <li>Webhook 地址: /webhook</li>
+        <li>运行历史: /api/runs（需配置 RUN_HISTORY_TOKEN）</li>
         <li>健康检查: /health</li>
+        <li>内存诊断: /admin/memory（需配置 DIAGNOSTICS_TOKEN）</li>
     </ul>
     """
 
@@ -258,12 +330,29 @@ def main():
     """
     主函数，启动 Flask 服务
     """
+    global feishu_connection
+    
     logger.info("=" * 60)
     logger.info("飞书机器人 + Coze 工作流集成服务启动中...")
     logger.info(f"监听地址: {config.FLASK_HOST}:{config.FLASK_PORT}")
-    logger.info(f"Webhook 路径: http://{config.FLASK_HOST}:{config.FLASK_PORT}/webhook")
+    if config.FEISHU_EVENT_MODE == 'long_connection':
+        logger.info("事件接收方式: 飞书长连接（无需公网回调地址）")
+    else:
+        logger.info(f"Webhook 路径: http://{config.FLASK_HOST}:{config.FLASK_PORT}/webhook")
     logger.info("=" * 60)
     
+    # 调试模式的重载器只在子进程中启动后台线程，避免重复连接
+    serving = not config.FLASK_DEBUG or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'
+    
+    # 长连接模式：后台线程接收事件
+    if serving and config.FEISHU_EVENT_MODE == 'long_connection':
+        feishu_connection = FeishuLongConnection(dispatch_event)
+        feishu_connection.start()
+    
+    # 多实例部署：启动 worker 领取共享队列中的消息，放入本实例的群聊队列按群聊公平处理
+    if serving and coordinator.distributed:
+        bot_queue.start_workers(enqueue_chat_event, config.WORKER_THREADS)
+    
     # 启动 Flask 应用
     app.run(
         host=config.FLASK_HOST,
@@ -5,20 +5,38 @@
 
 import json
 import logging
-from flask import Flask, request, jsonify
+import os
+from flask import Flask, request, jsonify, make_response
 from flask_cors import CORS
 
 # 导入配置和工具模块
 import config
 from utils import (
     extract_doc_url,
-    build_rich_text_message,
     send_via_custom_bot_webhook,
+    admin_token_error,
     logger
 )
-
-# 导入 Coze SDK
-from cozepy import Coze, TokenAuth, WorkflowEvent, WorkflowEventType
+from deadline import RunDeadline, CANCEL_CLIENT_GONE, active_runs
+from hedging import workflow_hedging
+from circuit_breaker import breaker_states, STATE_OPEN
+from run_history import run_history, query_from_args
+from idempotency import (
+    idempotency_store,
+    IdempotencyConflict,
+    IdempotencyInProgress,
+    IdempotencyStoreFull,
+    MAX_KEY_LENGTH
+)
+from concurrency import workflow_limiter
+from scheduler import workflow_scheduler, CLASS_INTERACTIVE, CLASS_BULK
+from coordination import coordinator
+import doc_cache
+from watchlist import doc_watcher
+from workflow_engine import WorkflowEngine
+from config_reload import config_reloader
+import profiler
+import memory_diagnostics
 
 # 创建 Flask 应用
 app = Flask(__name__)
@@ -26,201 +44,134 @@ app = Flask(__name__)
 # 启用 CORS（允许前端跨域请求）
 CORS(app)
 
-# 初始化 Coze 客户端
-coze_client = Coze(
-    auth=TokenAuth(token=config.COZE_API_TOKEN),
-    base_url=config.COZE_API_BASE
-)
+# 按需性能分析（见 config.PROFILING_TOKEN）
+profiler.install(app)
+
+# 配置热更新：监听 SIGHUP 与配置文件修改（见 config.CONFIG_FILE；Coze 客户端的重建见 workflow_engine）
+config_reloader.start_watching()
+
+# 内存诊断：统计内部结构的大小（见 config.DIAGNOSTICS_TOKEN）
+memory_diagnostics.register_gauge("idempotency_keys", lambda: len(idempotency_store))
+memory_diagnostics.register_gauge("active_runs", active_runs)
+memory_diagnostics.register_gauge("run_history", run_history.stats)
+memory_diagnostics.register_gauge("doc_result_cache", doc_cache.result_cache.snapshot)
+memory_diagnostics.register_gauge("scheduler_queued", lambda: {
+    cls: stats["queued"] for cls, stats in workflow_scheduler.snapshot().items()
+})
+memory_diagnostics.install(app)
+
+
+def _send_webhook(chat_id, card: dict, deadline: RunDeadline) -> bool:
+    """通过自定义机器人 Webhook 发送到固定的飞书群（不区分 chat_id）"""
+    return send_via_custom_bot_webhook(card, deadline=deadline)
+
+
+# 工作流运行引擎：结果按文档版本缓存，通过 Webhook 通知；被拒绝或熔断时不发送通知
+workflow_engine = WorkflowEngine("api", transport=_send_webhook)
+
+
+def _request_budget() -> float:
+    """
+    本次运行的总时限：客户端可通过 X-Request-Timeout 缩短，但不能超过服务端上限，
+    也不能短于通知预留时间加最短运行时间（否则工作流阶段一开始就已到期）
+    
+    Raises:
+        ValueError: 请求的时限过短
+    """
+    budget = config.WORKFLOW_RUN_TIMEOUT
+    try:
+        requested = float(request.headers.get('X-Request-Timeout', budget))
+    except ValueError:
+        return budget
+    if requested > 0 and requested < budget:
+        minimum = config.NOTIFY_TIMEOUT_RESERVE + config.WORKFLOW_MIN_RUN_TIME
+        if requested < minimum:
+            raise ValueError(f"X-Request-Timeout 不能小于 {minimum} 秒")
+        budget = requested
+    return budget
 
 
-def process_workflow(doc_url: str) -> dict:
+def _process_document(doc_url: str, budget: float, priority: str):
     """
-    处理 Coze 工作流（流式调用）
+    执行一次文档处理：调用工作流并发送飞书通知
     
     Args:
         doc_url: 文档链接
+        budget: 本次运行的总时限（秒）
+        priority: 优先级类别（interactive / bot / bulk）
     
     Returns:
-        包含处理结果的字典
+        Flask 响应
     """
-    try:
-        logger.info(f"开始调用工作流: doc_url={doc_url}")
-        
-        # 存储工作流结果
-        workflow_messages = []  # 所有消息
-        workflow_output = None  # 最终输出变量
-        workflow_data = {}  # 工作流数据
-        
-        # 构建调用参数
-        params = {
-            "workflow_id": config.COZE_WORKFLOW_ID,
-            "parameters": {
-                "inputurl": doc_url  # 使用 inputurl 参数名
-            }
-        }
-        
-        # 添加 bot_id（如果配置了）
-        if hasattr(config, 'COZE_BOT_ID') and config.COZE_BOT_ID:
-            params["bot_id"] = config.COZE_BOT_ID
-            logger.info(f"使用 Bot ID: {config.COZE_BOT_ID}")
-        
-        logger.info(f"调用参数: {params}")
-        
-        # 开始流式调用
-        stream = coze_client.workflows.runs.stream(**params)
-        
-        logger.info("开始监听工作流事件流...")
-        
-        # 处理流式事件
-        for event in stream:
-            event_type = event.event
-            logger.info(f"收到事件: {event_type}")
-            
-            # MESSAGE 事件 - 工作流执行过程中的消息
-            if event_type == WorkflowEventType.MESSAGE:
-                message = event.message
-                logger.info(f"MESSAGE 内容: {message}")
-                if message:
-                    workflow_messages.append(str(message))
-            
-            # ERROR 事件 - 工作流执行错误
-            elif event_type == WorkflowEventType.ERROR:
-                error = event.error
-                logger.error(f"ERROR: {error}")
-                return {
-                    "success": False,
-                    "error": str(error)
-                }
-            
-            # INTERRUPT 事件 - 工作流中断，需要恢复
-            elif event_type == WorkflowEventType.INTERRUPT:
-                logger.info(f"INTERRUPT: {event.interrupt}")
-                interrupt_data = event.interrupt.interrupt_data
-                
-                # 递归处理中断（可能会有多次中断）
-                def handle_interrupt(interrupt_event_data, depth=0):
-                    if depth > 10:
-                        logger.error("中断嵌套过深，可能存在循环")
-                        return
-                    
-                    logger.info(f"自动恢复工作流执行... (深度: {depth})")
-                    resume_stream = coze_client.workflows.runs.resume(
-                        workflow_id=config.COZE_WORKFLOW_ID,
-                        event_id=interrupt_event_data.event_id,
-                        resume_data="",
-                        interrupt_type=interrupt_event_data.type
-                    )
-                    
-                    # 处理恢复后的所有事件
-                    for resume_event in resume_stream:
-                        logger.info(f"Resume 事件 (深度{depth}): {resume_event.event}")
-                        
-                        if resume_event.event == WorkflowEventType.MESSAGE:
-                            if resume_event.message:
-                                logger.info(f"Resume 消息内容: {resume_event.message}")
-                                workflow_messages.append(str(resume_event.message))
-                        
-                        elif resume_event.event == WorkflowEventType.ERROR:
-                            raise Exception(str(resume_event.error))
-                        
-                        elif resume_event.event == WorkflowEventType.INTERRUPT:
-                            # 又遇到中断，递归处理
-                            logger.info(f"Resume 后又遇到 INTERRUPT，继续处理...")
-                            handle_interrupt(resume_event.interrupt.interrupt_data, depth + 1)
-                
-                # 开始处理中断
-                try:
-                    handle_interrupt(interrupt_data)
-                except Exception as e:
-                    logger.error(f"处理中断时出错: {e}")
-                    return {"success": False, "error": str(e)}
-            
-            # 其他事件类型，记录用于调试
-            else:
-                logger.info(f"其他事件类型: {event_type}")
-                # 记录完整事件以便调试
-                logger.info(f"完整事件对象: {event}")
-                
-                # 尝试提取事件中的数据
-                if hasattr(event, '__dict__'):
-                    logger.info(f"事件属性: {event.__dict__}")
-        
-        logger.info("✅ 工作流事件流结束")
-        
-        # 打印所有收到的消息（重要！用于调试）
-        logger.info(f"=" * 60)
-        logger.info(f"收到的消息数量: {len(workflow_messages)}")
-        for idx, msg in enumerate(workflow_messages, 1):
-            logger.info(f"消息 [{idx}]: {msg}")
-        logger.info(f"=" * 60)
-        
-        # 提取最终输出
-        import re
-        # 定义匹配 output 的正则表达式模式
-        patterns = [
-            r'"output"\s*:\s*"([^"]+)"',
-            r'output\s*:\s*"([^"]+)"',
-            r'output\s*:\s*([^\s\n,\}]+)',
-        ]
-        
-        # 方法1: 从最后一个消息中提取（很多工作流会在最后输出结果）
-        if workflow_messages:
-            last_message = workflow_messages[-1]
-            logger.info(f"正在从最后一条消息提取 output: {last_message}")
-            
-            # 尝试从消息中提取 output
-            for pattern in patterns:
-                match = re.search(pattern, last_message)
-                if match:
-                    workflow_output = match.group(1)
-                    logger.info(f"✅ 从最后一条消息中提取到 output: {workflow_output}")
-                    break
-        
-        # 方法2: 如果还是没有提取到，检查所有消息
-        if not workflow_output and workflow_messages:
-            full_text = "\n".join(workflow_messages)
-            logger.info(f"尝试从完整文本中提取 output...")
-            logger.info(f"完整文本: {full_text}")
-            for pattern in patterns:
-                match = re.search(pattern, full_text)
-                if match:
-                    workflow_output = match.group(1)
-                    logger.info(f"✅ 从完整文本中提取到 output: {workflow_output}")
-                    break
+    with RunDeadline(budget) as run:
+        # 客户端断开时取消运行
+        run.bind_client(request.environ)
         
-        # 如果还是没有提取到，记录警告
-        if not workflow_output:
-            logger.warning("⚠️⚠️⚠️ 警告：未能从工作流消息中提取到 output 变量！")
-            logger.warning(f"请检查工作流是否正确输出了 output 变量")
-            logger.warning(f"当前收到的所有消息: {workflow_messages}")
-        
-        # 添加 URL 协议前缀
-        if workflow_output:
-            if not workflow_output.startswith(('http://', 'https://')):
-                workflow_output = f"http://{workflow_output}"
-                logger.info(f"添加协议后: {workflow_output}")
-            logger.info(f"✅✅✅ 最终输出链接: {workflow_output}")
-        else:
-            logger.error(f"❌❌❌ 未能提取到输出链接！")
-        
-        # 构建返回结果
-        result_text = "\n".join(workflow_messages) if workflow_messages else "工作流执行完成"
-        
-        logger.info(f"最终结果文本: {result_text}")
-        logger.info(f"最终输出链接: {workflow_output}")
-        
-        return {
+        # 缓存 → 并发名额 → 工作流 → Webhook 通知
+        result = workflow_engine.run(doc_url, priority, run)
+    
+    if result.get('cancelled') == CANCEL_CLIENT_GONE:
+        # 客户端已放弃，不再发送通知
+        logger.warning(f"客户端已断开，放弃本次运行: {doc_url}")
+        return jsonify({
+            "success": False,
+            "message": result.get('error')
+        }), 499
+    
+    if 'retry_after' in result:
+        # 并发已达上限或上游已熔断，快速失败
+        response = jsonify({
+            "success": False,
+            "message": result.get('error')
+        })
+        response.headers['Retry-After'] = str(int(result['retry_after']) + 1)
+        return response, 503
+    
+    if result['success']:
+        return jsonify({
             "success": True,
-            "result": result_text,
-            "output": workflow_output
-        }
-        
-    except Exception as e:
-        logger.error(f"处理工作流时发生异常: {str(e)}")
-        return {
+            "message": "工作流已触发，处理完成后将在飞书群内收到通知",
+            "result": result.get('result'),
+            "cached": result.get('cached', False)
+        })
+    else:
+        return jsonify({
             "success": False,
-            "error": str(e)
-        }
+            "message": result.get('error', '工作流执行失败')
+        }), 504 if result.get('cancelled') else 500
+
+
+def _process_watched_doc(payload: dict):
+    """
+    重新运行一个有修改的监听文档（doc_watch 队列的 worker 调用）
+    
+    以 bulk 优先级申请并发名额，不挤占交互请求；失败时在下个扫描周期重试
+    
+    Args:
+        payload: {"doc_url": 文档链接, "revision": 检测到的版本}
+    """
+    doc_url = payload["doc_url"]
+    if doc_cache.lookup(doc_url)[1] is not None:
+        # 当前版本已经运行过（如通过 /api/process 手动触发）
+        logger.info(f"监听文档的当前版本已有结果，跳过: {doc_url}")
+        return
+    
+    logger.info(f"重新运行监听文档: {doc_url}")
+    with RunDeadline(config.WORKFLOW_RUN_TIMEOUT) as run:
+        result = workflow_engine.run(doc_url, CLASS_BULK, run)
+    
+    if not result['success']:
+        logger.warning(f"监听文档运行失败，下个扫描周期重试: {doc_url}")
+        doc_watcher.retry_later(doc_url, payload["revision"])
+
+
+def _snapshot_response(response):
+    """把 Flask 响应转换为可保存、可重建的 (body, status, headers)"""
+    headers = [
+        (name, value) for name, value in response.headers.items()
+        if name in ('Content-Type', 'Retry-After')
+    ]
+    return response.get_data(), response.status_code, headers
 
 
 @app.route('/api/process', methods=['POST'])
@@ -249,47 +200,145 @@ def api_process():
         
         logger.info(f"收到处理请求: {doc_url}")
         
-        # 调用工作流处理
-        result = process_workflow(doc_url)
+        # 本次运行的总时限（X-Request-Timeout）与优先级类别（请求头 X-Priority 或请求体 priority，默认 interactive）
+        try:
+            budget = _request_budget()
+            priority = workflow_scheduler.resolve_class(
+                request.headers.get('X-Priority') or data.get('priority'),
+                default=CLASS_INTERACTIVE
+            )
+        except ValueError as e:
+            return jsonify({
+                "success": False,
+                "message": str(e)
+            }), 400
+        
+        # 未携带幂等键时直接处理
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if not idempotency_key:
+            return _process_document(doc_url, budget, priority)
+        
+        if len(idempotency_key) > MAX_KEY_LENGTH:
+            return jsonify({
+                "success": False,
+                "message": "Idempotency-Key 过长"
+            }), 400
         
-        if result['success']:
-            # 构建富文本消息卡片
-            message_card = build_rich_text_message(
-                doc_url=doc_url,
-                workflow_result=result.get('result', '工作流执行完成'),
-                workflow_output=result.get('output'),  # 传递输出链接
-                status="success"
+        # 同一幂等键只执行一次：重放返回已保存的结果，或等待仍在执行的原请求
+        try:
+            snapshot, replayed = idempotency_store.execute(
+                idempotency_key,
+                fingerprint=doc_url,
+                func=lambda: _snapshot_response(make_response(_process_document(doc_url, budget, priority))),
+                wait_timeout=budget,
+                cacheable=lambda outcome: outcome[1] not in (499, 503)
             )
-            
-            # 通过 Webhook 发送消息到飞书群
-            send_success = send_via_custom_bot_webhook(message_card)
-            
-            if send_success:
-                logger.info("成功发送完成消息到飞书群")
-            else:
-                logger.warning("发送完成消息失败")
-            
+        except IdempotencyConflict:
+            return jsonify({
+                "success": False,
+                "message": "Idempotency-Key 已用于其他文档"
+            }), 422
+        except IdempotencyInProgress:
+            return jsonify({
+                "success": False,
+                "message": "相同 Idempotency-Key 的请求仍在处理中"
+            }), 409
+        except IdempotencyStoreFull:
+            logger.warning(f"幂等键存储已满且全部在执行中，拒绝请求: {doc_url}")
+            response = jsonify({
+                "success": False,
+                "message": "服务繁忙，请稍后重试"
+            })
+            response.headers['Retry-After'] = '5'
+            return response, 503
+        
+        body, status, headers = snapshot
+        response = app.response_class(body, status=status, headers=headers)
+        if replayed:
+            response.headers['Idempotent-Replayed'] = 'true'
+        return response
+        
+    except Exception as e:
+        logger.error(f"API 处理异常: {str(e)}")
+        return jsonify({
+            "success": False,
+            "message": f"服务器错误: {str(e)}"
+        }), 500
+
+
+@app.route('/api/runs', methods=['GET'])
+def api_runs():
+    """
+    查询运行历史（分页）
+    
+    查询参数: doc_url, status, source, since, until, limit, offset
+    需要管理令牌（见 config.RUN_HISTORY_TOKEN）：记录中含文档链接、群组 ID 和错误信息
+    """
+    denied = admin_token_error(config.RUN_HISTORY_TOKEN, request.headers.get('X-Admin-Token'))
+    if denied:
+        message, status = denied
+        return jsonify({"success": False, "message": message}), status
+    
+    try:
+        return jsonify(query_from_args(request.args))
+    except ValueError as e:
+        return jsonify({
+            "success": False,
+            "message": f"参数错误: {str(e)}"
+        }), 400
+    except Exception as e:
+        logger.error(f"查询运行历史异常: {str(e)}")
+        return jsonify({
+            "success": False,
+            "message": f"服务器错误: {str(e)}"
+        }), 500
+
+
+@app.route('/api/watch', methods=['GET', 'POST', 'DELETE'])
+def api_watch():
+    """
+    文档监听列表：GET 分页查询（limit, offset），POST 添加、DELETE 取消监听（请求体 {"doc_url": "..."}）
+    
+    需要管理令牌（见 config.WATCH_ADMIN_TOKEN）：添加的文档修改后会自动运行工作流并发送群通知
+    """
+    denied = admin_token_error(config.WATCH_ADMIN_TOKEN, request.headers.get('X-Admin-Token'))
+    if denied:
+        message, status = denied
+        return jsonify({"success": False, "message": message}), status
+    
+    try:
+        if request.method == 'GET':
+            limit = min(max(int(request.args.get('limit', 50)), 1), 200)
+            offset = max(int(request.args.get('offset', 0)), 0)
+            return jsonify(doc_watcher.list(limit=limit, offset=offset))
+        
+        data = request.get_json(silent=True) or {}
+        doc_url = (data.get('doc_url') or '').strip()
+        if not doc_url:
+            return jsonify({
+                "success": False,
+                "message": "缺少 doc_url 参数"
+            }), 400
+        
+        if request.method == 'POST':
             return jsonify({
                 "success": True,
-                "message": "工作流已触发，处理完成后将在飞书群内收到通知",
-                "result": result.get('result')
+                "doc": doc_watcher.add(doc_url)
             })
-        else:
-            # 发送错误消息
-            error_card = build_rich_text_message(
-                doc_url=doc_url,
-                workflow_result=f"执行失败: {result.get('error', '未知错误')}",
-                status="error"
-            )
-            send_via_custom_bot_webhook(error_card)
-            
+        
+        if not doc_watcher.remove(doc_url):
             return jsonify({
                 "success": False,
-                "message": result.get('error', '工作流执行失败')
-            }), 500
-            
+                "message": "文档不在监听列表中"
+            }), 404
+        return jsonify({"success": True})
+    except ValueError as e:
+        return jsonify({
+            "success": False,
+            "message": f"参数错误: {str(e)}"
+        }), 400
     except Exception as e:
-        logger.error(f"API 处理异常: {str(e)}")
+        logger.error(f"处理监听列表请求异常: {str(e)}")
         return jsonify({
             "success": False,
             "message": f"服务器错误: {str(e)}"
@@ -301,10 +350,21 @@ def health():
     """
     健康检查接口
     """
+    circuits = breaker_states()
+    degraded = any(state['state'] == STATE_OPEN for state in circuits.values())
+    
     return jsonify({
-        "status": "ok",
+        "status": "degraded" if degraded else "ok",
         "service": "Coze 工作流助手 API",
-        "version": "2.0.0"
+        "version": "2.0.0",
+        "circuits": circuits,
+        "concurrency": workflow_limiter.snapshot(),
+        "scheduler": workflow_scheduler.snapshot(),
+        "coordination": coordinator.snapshot(),
+        "hedging": workflow_hedging.snapshot(),
+        "engine": workflow_engine.snapshot(),
+        "config": config_reloader.snapshot(),
+        "watch": doc_watcher.snapshot()
     })
 
 
@@ -318,6 +378,8 @@ def index():
         "version": "2.0.0",
         "endpoints": {
             "process": "/api/process (POST)",
+            "runs": "/api/runs (GET)",
+            "watch": "/api/watch (GET/POST/DELETE)",
             "health": "/api/health (GET)"
         }
     })
@@ -333,6 +395,10 @@ def main():
     logger.info(f"API 端点: http://{config.FLASK_HOST}:{config.FLASK_PORT}/api/process")
     logger.info("=" * 60)
     
+    # 定期检查监听文档（调试模式下只在重载后的子进程中启动）
+    if config.WATCH_ENABLED and (not config.FLASK_DEBUG or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'):
+        doc_watcher.start(_process_watched_doc)
+    
     # 启动 Flask 应用
     app.run(
         host=config.FLASK_HOST,
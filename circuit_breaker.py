@@ -0,0 +1,205 @@
+"""
+熔断器模块 - 上游依赖（Coze、飞书）故障时快速失败
+
+状态流转：
+- CLOSED：正常放行，连续失败达到阈值后进入 OPEN
+- OPEN：直接拒绝（抛出 CircuitOpenError），等待恢复时间后进入 HALF_OPEN
+- HALF_OPEN：只放行少量探测请求，成功则回到 CLOSED，失败则重新 OPEN
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态，请求被快速拒绝"""
+
+    # 快速失败并未真正访问上游，不作为新的故障样本
+    breaker_neutral = True
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"上游服务 {name} 暂时不可用（已熔断），请 {int(retry_after) + 1} 秒后重试")
+        self.name = name
+        self.retry_after = retry_after
+
+
+def is_dependency_failure(exc: BaseException) -> bool:
+    """
+    判断异常是否代表上游依赖故障
+
+    - 异常自身声明 breaker_neutral=True（如客户端主动断开）时不计入
+    - 带响应的 4xx（429 除外）属于请求本身的问题，不计入
+    - 其他异常（连接失败、超时、5xx 等）均计为故障
+    """
+    if getattr(exc, 'breaker_neutral', False):
+        return False
+    response = getattr(exc, 'response', None)
+    status = getattr(response, 'status_code', None)
+    if isinstance(status, int) and status < 500 and status != 429:
+        return False
+    return True
+
+
+class CircuitBreaker:
+    """带半开探测的熔断器（线程安全）"""
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = None,
+        recovery_timeout: float = None,
+        half_open_max_calls: int = None
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold or config.CIRCUIT_FAILURE_THRESHOLD
+        self.recovery_timeout = recovery_timeout or config.CIRCUIT_RECOVERY_TIMEOUT
+        self.half_open_max_calls = half_open_max_calls or config.CIRCUIT_HALF_OPEN_MAX_CALLS
+
+        self._lock = threading.Lock()
+        self._state = STATE_CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._half_open_calls = 0
+
+        # 统计信息
+        self._total_failures = 0
+        self._total_rejected = 0
+        self._last_failure = None
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    def _current_state(self, now: float) -> str:
+        # 调用方需持有锁；OPEN 到期后转为 HALF_OPEN
+        if self._state == STATE_OPEN and now - self._opened_at >= self.recovery_timeout:
+            self._state = STATE_HALF_OPEN
+            self._half_open_calls = 0
+            logger.info(f"熔断器 {self.name} 进入半开状态，放行探测请求")
+        return self._state
+
+    def acquire(self):
+        """
+        申请一次调用许可
+
+        Raises:
+            CircuitOpenError: 熔断中，或半开状态下探测名额已用完
+        """
+        with self._lock:
+            now = time.monotonic()
+            state = self._current_state(now)
+            if state == STATE_CLOSED:
+                return
+            if state == STATE_HALF_OPEN and self._half_open_calls < self.half_open_max_calls:
+                self._half_open_calls += 1
+                return
+            self._total_rejected += 1
+            retry_after = max(0.0, self.recovery_timeout - (now - self._opened_at))
+        raise CircuitOpenError(self.name, retry_after)
+
+    def record_success(self):
+        """记录一次成功调用"""
+        with self._lock:
+            if self._state == STATE_HALF_OPEN:
+                logger.info(f"熔断器 {self.name} 探测成功，恢复正常")
+            self._state = STATE_CLOSED
+            self._failures = 0
+            self._half_open_calls = 0
+
+    def record_failure(self, error: Any = None):
+        """记录一次失败调用"""
+        with self._lock:
+            now = time.monotonic()
+            state = self._current_state(now)
+            self._failures += 1
+            self._total_failures += 1
+            self._last_failure = str(error) if error is not None else None
+
+            if state == STATE_HALF_OPEN or self._failures >= self.failure_threshold:
+                if state != STATE_OPEN:
+                    logger.warning(f"熔断器 {self.name} 打开: 连续失败 {self._failures} 次, 最近错误: {error}")
+                self._state = STATE_OPEN
+                self._opened_at = now
+                self._half_open_calls = 0
+
+    def release(self):
+        """归还调用许可但不计入成功或失败（如调用被主动取消）"""
+        with self._lock:
+            if self._state == STATE_HALF_OPEN and self._half_open_calls > 0:
+                self._half_open_calls -= 1
+
+    @contextmanager
+    def guard(self):
+        """
+        在熔断器保护下执行一段调用
+
+        正常结束记为成功；依赖故障类异常记为失败；其他异常只归还许可
+
+        Raises:
+            CircuitOpenError: 熔断中
+        """
+        self.acquire()
+        try:
+            yield self
+        except Exception as e:
+            if is_dependency_failure(e):
+                self.record_failure(e)
+            else:
+                self.release()
+            raise
+        except BaseException:
+            self.release()
+            raise
+        else:
+            self.record_success()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """导出当前状态，用于健康检查"""
+        with self._lock:
+            now = time.monotonic()
+            state = self._current_state(now)
+            snapshot = {
+                "state": state,
+                "consecutive_failures": self._failures,
+                "total_failures": self._total_failures,
+                "total_rejected": self._total_rejected,
+                "last_failure": self._last_failure
+            }
+            if state == STATE_OPEN:
+                snapshot["retry_after"] = round(max(0.0, self.recovery_timeout - (now - self._opened_at)), 1)
+            return snapshot
+
+
+# 全局熔断器注册表（按依赖名称）
+_breakers: Dict[str, CircuitBreaker] = {}
+_registry_lock = threading.Lock()
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    """获取（不存在则创建）指定依赖的熔断器"""
+    with _registry_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = CircuitBreaker(name)
+            _breakers[name] = breaker
+        return breaker
+
+
+def breaker_states() -> Dict[str, Dict[str, Any]]:
+    """所有熔断器的当前状态"""
+    with _registry_lock:
+        breakers = list(_breakers.values())
+    return {breaker.name: breaker.snapshot() for breaker in breakers}
@@ -0,0 +1,261 @@
+"""
+自适应并发限制模块 - 根据 Coze 实测延迟和错误率调整允许的在途运行数
+
+采用 AIMD（加性增、乘性减）控制：
+- 成功且首个事件延迟接近基线：并发上限缓慢增加（每 limit 次成功约 +1），且只在上限被用满时增长
+- 延迟明显高于基线：上限按 latency 比例小幅收缩
+- 上游过载信号（429/5xx、上游调用开始后才到期的超时）：上限按 backoff 比例大幅收缩
+- 熔断快速失败、排队过久或客户端时限过短导致的超时、客户端断开、业务错误：只归还名额，不影响上限
+- 基线取最近两个时间窗口内的最小延迟，随时段变化自动更新
+
+超出上限的请求被快速拒绝（LimitExceeded，携带建议的 Retry-After），或在限定时间内排队等待
+"""
+
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import config
+from utils import logger
+from deadline import CANCEL_DEADLINE
+
+
+class LimitExceeded(Exception):
+    """在途运行已达上限，请求被拒绝"""
+
+    def __init__(self, name: str, limit: int, retry_after: float):
+        super().__init__(f"服务繁忙（{name} 并发已达上限 {limit}），请 {int(retry_after) + 1} 秒后重试")
+        self.name = name
+        self.limit = limit
+        self.retry_after = retry_after
+
+
+class Permit:
+    """一次运行占用的并发名额，结束时报告结果并归还"""
+
+    def __init__(self, limiter: 'AdaptiveLimiter', on_release: Callable[[], None] = None):
+        self._limiter = limiter
+        self._released = False
+        # 归还名额时的回调（调度器据此更新各优先级的在途数）
+        self.on_release = on_release
+
+    def success(self, latency_ms: Optional[float]):
+        """运行正常完成（latency_ms 为首个事件延迟，未知时传 None）"""
+        self._finish(self._limiter._on_success(latency_ms))
+
+    def overload(self):
+        """运行因上游过载失败（429/5xx、上游调用开始后的超时）"""
+        self._finish(self._limiter._on_overload)
+
+    def release(self):
+        """归还名额但不影响并发上限（如客户端断开、业务错误）"""
+        self._finish(None)
+
+    def _finish(self, feedback):
+        if self._released:
+            return
+        self._released = True
+        if self.on_release is not None:
+            self.on_release()
+        self._limiter._release(feedback)
+
+    def __enter__(self) -> 'Permit':
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class AdaptiveLimiter:
+    """基于延迟与错误反馈的自适应并发限制器（线程安全）"""
+
+    def __init__(
+        self,
+        name: str,
+        initial_limit: int = None,
+        min_limit: int = None,
+        max_limit: int = None
+    ):
+        self.name = name
+        self.min_limit = min_limit or config.CONCURRENCY_MIN_LIMIT
+        self.max_limit = max_limit or config.CONCURRENCY_MAX_LIMIT
+        self._limit = float(initial_limit or config.CONCURRENCY_INITIAL_LIMIT)
+        self._inflight = 0
+        self._cond = threading.Condition()
+
+        # 延迟基线（窗口最小值）与平滑延迟
+        self._window_start = time.monotonic()
+        self._window_min: Optional[float] = None
+        self._prev_window_min: Optional[float] = None
+        self._ewma_latency: Optional[float] = None
+
+        # 统计信息
+        self._shed = 0
+        self._overloads = 0
+
+        # 名额归还后的回调（在锁外调用）
+        self._listeners: List[Callable[[], None]] = []
+
+    def add_listener(self, listener: Callable[[], None]):
+        """注册名额归还后的回调，如调度器据此唤醒排队的请求"""
+        self._listeners.append(listener)
+
+    @property
+    def limit(self) -> int:
+        return max(self.min_limit, int(self._limit))
+
+    def acquire(self, timeout: float = 0) -> Permit:
+        """
+        申请一个并发名额
+
+        Args:
+            timeout: 名额已满时最多等待的秒数，0 表示立即拒绝
+
+        Raises:
+            LimitExceeded: 等待超时仍没有空闲名额
+        """
+        if not config.ADAPTIVE_CONCURRENCY_ENABLED:
+            return Permit(_UNLIMITED)
+
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._inflight >= self.limit:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._shed += 1
+                    raise LimitExceeded(self.name, self.limit, self._retry_after())
+                self._cond.wait(remaining)
+            self._inflight += 1
+        return Permit(self)
+
+    def try_acquire(self) -> Optional[Permit]:
+        """非阻塞地申请一个名额，没有空闲名额时返回 None"""
+        if not config.ADAPTIVE_CONCURRENCY_ENABLED:
+            return Permit(_UNLIMITED)
+
+        with self._cond:
+            if self._inflight >= self.limit:
+                return None
+            self._inflight += 1
+        return Permit(self)
+
+    def retry_after(self) -> float:
+        """建议客户端重试前等待的秒数"""
+        with self._cond:
+            return self._retry_after()
+
+    def _retry_after(self) -> float:
+        # 平均每隔 latency / limit 秒会空出一个名额
+        latency = (self._ewma_latency or 1000.0) / 1000
+        return max(1.0, latency / max(self.limit, 1))
+
+    def _release(self, feedback):
+        with self._cond:
+            utilized = self._inflight >= self.limit
+            self._inflight -= 1
+            if feedback is not None:
+                feedback(utilized)
+            self._cond.notify()
+
+        for listener in self._listeners:
+            try:
+                listener()
+            except Exception as e:
+                logger.error(f"并发名额回调出错: {str(e)}")
+
+    def _on_success(self, latency_ms: Optional[float]):
+        # 返回在持有锁时执行的反馈函数
+        def apply(utilized: bool):
+            if latency_ms is None:
+                return
+            baseline = self._update_baseline(latency_ms)
+            if latency_ms > baseline * config.CONCURRENCY_LATENCY_TOLERANCE:
+                # 延迟明显升高：按比例小幅收缩
+                ratio = baseline * config.CONCURRENCY_LATENCY_TOLERANCE / latency_ms
+                self._set_limit(self._limit * max(ratio, config.CONCURRENCY_BACKOFF_RATIO))
+            elif utilized:
+                # 上限被用满且延迟正常：加性增长
+                self._set_limit(self._limit + 1.0 / self._limit)
+        return apply
+
+    def _on_overload(self, utilized: bool):
+        self._overloads += 1
+        self._set_limit(self._limit * config.CONCURRENCY_BACKOFF_RATIO)
+
+    def _update_baseline(self, latency_ms: float) -> float:
+        # 调用方需持有锁
+        now = time.monotonic()
+        if now - self._window_start >= config.CONCURRENCY_BASELINE_WINDOW:
+            self._prev_window_min = self._window_min
+            self._window_min = None
+            self._window_start = now
+        if self._window_min is None or latency_ms < self._window_min:
+            self._window_min = latency_ms
+        if self._ewma_latency is None:
+            self._ewma_latency = latency_ms
+        else:
+            self._ewma_latency = self._ewma_latency * 0.8 + latency_ms * 0.2
+
+        candidates = [m for m in (self._window_min, self._prev_window_min) if m is not None]
+        return min(candidates)
+
+    def _set_limit(self, value: float):
+        # 调用方需持有锁
+        old = self.limit
+        self._limit = min(float(self.max_limit), max(float(self.min_limit), value))
+        if self.limit != old:
+            logger.info(f"并发上限调整 {self.name}: {old} -> {self.limit}")
+            self._cond.notify_all()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """导出当前状态，用于健康检查"""
+        with self._cond:
+            return {
+                "limit": self.limit,
+                "inflight": self._inflight,
+                "latency_ms": round(self._ewma_latency) if self._ewma_latency is not None else None,
+                "shed": self._shed,
+                "overloads": self._overloads
+            }
+
+
+class _Unlimited:
+    """关闭自适应并发时使用的空实现（不调整上限，反馈全部忽略）"""
+
+    def _on_success(self, latency_ms: Optional[float]):
+        return None
+
+    def _on_overload(self, utilized: bool):
+        pass
+
+    def _release(self, feedback):
+        pass
+
+
+_UNLIMITED = _Unlimited()
+
+
+def report_result(permit: Permit, result: Dict[str, Any]):
+    """
+    根据 WorkflowEngine.execute 的返回结果向限制器反馈并归还名额
+
+    - 成功：以首个事件延迟作为延迟样本
+    - 上游故障、上游调用开始后才到期的超时（upstream_failure）：视为过载
+    - 其他（熔断快速失败、调用前就已到期、客户端断开、业务错误）：只归还名额
+    """
+    if result.get('success'):
+        permit.success(result.get('first_event_ms'))
+    elif result.get('cancelled') == CANCEL_DEADLINE:
+        # 排队过久或客户端给的时限过短导致的到期与上游负载无关
+        if result.get('upstream_failure'):
+            permit.overload()
+        else:
+            permit.release()
+    elif result.get('upstream_failure'):
+        permit.overload()
+    else:
+        permit.release()
+
+
+# 全局工作流并发限制器（api.py 与 AIcase.py 共用）
+workflow_limiter = AdaptiveLimiter("coze_workflow")
@@ -10,6 +10,9 @@ COZE_API_TOKEN = 'pat_YxybptyPLdYvVpEkIdyQ656pigqf9ZBpP37FNSHNVQxOFoS6kW3NjiRj3z
 # Coze 工作流 ID（从工作流的网址最后一段数字）
 COZE_WORKFLOW_ID = '7561294254754365486'
 
+# 工作流接收文档链接的入参名（与工作流开始节点的参数名一致，API 与机器人共用）
+COZE_WORKFLOW_INPUT_PARAM = 'inputurl'
+
 # Coze Bot ID（可选，如果工作流需要关联智能体）
 # 如果工作流有数据库节点、变量节点等，通常需要设置此项
 COZE_BOT_ID = None  # 如需要，填写 bot ID，例如：'7234567890123456789'
@@ -38,6 +41,17 @@ FEISHU_VERIFICATION_TOKEN = 'YOUR_VERIFICATION_TOKEN'  # ⚠️ 请从飞书开
 # 飞书 API 基础 URL
 FEISHU_API_BASE = 'https://open.feishu.cn/open-apis'
 
+# 事件接收方式：'webhook'（HTTP 回调 /webhook，需要公网地址）或 'long_connection'（长连接，无需公网地址）
+# 使用长连接时，需在飞书开放平台「事件与回调」中将订阅方式设为「使用长连接接收事件」
+FEISHU_EVENT_MODE = 'webhook'
+
+# 长连接服务地址（本地联调时可指向 feishu_ws.StandinServer）
+FEISHU_WS_DOMAIN = 'https://open.feishu.cn'
+
+# 长连接断开后的重连间隔（秒）：从最小值开始指数退避，不超过最大值
+FEISHU_WS_RECONNECT_MIN = 1
+FEISHU_WS_RECONNECT_MAX = 60
+
 # ===== 自定义机器人 Webhook（可选）=====
 # 如果您想使用自定义机器人 Webhook 发送消息，请填写以下 URL
 # 否则将使用企业自建应用的 API 发送消息
@@ -58,6 +72,241 @@ FLASK_PORT = 5000
 FLASK_DEBUG = True
 
 
+# ===== 运行时限配置 =====
+# 单次工作流运行的总时限（秒），覆盖流式调用、中断恢复和通知发送
+WORKFLOW_RUN_TIMEOUT = 300
+
+# 为发送飞书通知预留的时间（秒），工作流阶段会提前这么多秒到期
+NOTIFY_TIMEOUT_RESERVE = 10
+
+# 工作流阶段的最短可用时间（秒）：请求的时限或排队后剩余的时间不足 预留时间 + 该值 时直接拒绝
+WORKFLOW_MIN_RUN_TIME = 5
+
+# 单个飞书 HTTP 请求的默认超时（秒），实际超时不会超过运行的剩余时间
+HTTP_REQUEST_TIMEOUT = 10
+
+# 巡检运行时限与客户端断开的间隔（秒）
+RUN_MONITOR_INTERVAL = 0.5
+
+
+# ===== 熔断配置 =====
+# 上游依赖（Coze、飞书）连续失败多少次后熔断
+CIRCUIT_FAILURE_THRESHOLD = 5
+
+# 熔断后等待多久（秒）进入半开状态，放行探测请求
+CIRCUIT_RECOVERY_TIMEOUT = 30
+
+# 半开状态下同时放行的探测请求数
+CIRCUIT_HALF_OPEN_MAX_CALLS = 1
+
+
+# ===== 运行历史配置 =====
+# 是否记录每次工作流运行（写入本地 SQLite，可通过 /api/runs 查询）
+RUN_HISTORY_ENABLED = True
+
+# 运行历史数据库路径（Serverless 环境请改为 /tmp 下的路径）
+RUN_HISTORY_DB_PATH = 'run_history.db'
+
+# 后台批量写入：每批最多条数、最长等待时间（秒）
+RUN_HISTORY_BATCH_SIZE = 100
+RUN_HISTORY_FLUSH_INTERVAL = 1.0
+
+# 待写入队列上限，超出后丢弃记录（不阻塞请求）
+RUN_HISTORY_QUEUE_SIZE = 10000
+
+# /api/runs 的管理令牌：请求需携带 X-Admin-Token 请求头；留空时该接口返回 404（记录中含文档链接和群组 ID）
+RUN_HISTORY_TOKEN = ''
+
+
+# ===== 事件流录制配置 =====
+# 是否录制每次运行的 Coze 事件流（含事件间隔与中断恢复），用于离线回放和性能分析
+STREAM_RECORDING_ENABLED = False
+
+# 录制文件目录（每次运行一个 .jsonl 文件，文件名为运行 ID）
+STREAM_RECORD_DIR = 'recordings'
+
+
+# ===== 工作流输出配置 =====
+# 单次运行在内存中最多保留的消息文本（字节），超出时保留开头和结尾，中间部分省略
+TRANSCRIPT_MAX_BYTES = 256 * 1024
+
+# 其中保留开头部分的字节数（其余用于保留结尾，output 通常在最后一条消息中）
+TRANSCRIPT_HEAD_BYTES = 32 * 1024
+
+# 输出超限时完整输出的落盘目录（每次运行一个 .txt 文件），留空表示不落盘
+TRANSCRIPT_SPILL_DIR = ''
+
+
+# ===== 文档结果缓存配置 =====
+# 文档自上次运行后未修改（飞书元数据中的最近修改时间不变）时直接返回上次的结果；应用需有文档的访问权限
+DOC_CACHE_ENABLED = True
+
+# 文档版本查询结果的缓存时长（秒），0 表示不缓存、每次运行前都重新查询；
+# 大于 0 时期间内的修改要等缓存过期后才会触发重新运行（仍会返回旧结果）
+DOC_META_CACHE_TTL = 0
+
+# 合并并发版本查询的等待时间（秒），窗口内的查询合并为一次批量请求
+DOC_META_BATCH_WINDOW = 0.02
+
+# 单次版本查询的时限（秒），超时则按未缓存处理
+DOC_META_TIMEOUT = 3
+
+# 工作流结果的缓存时长（秒）和最大条目数
+DOC_RESULT_CACHE_TTL = 24 * 3600
+DOC_RESULT_CACHE_SIZE = 1000
+
+
+# ===== 文档监听配置 =====
+# 是否开启文档监听：定期检查 /api/watch 监听列表中的文档，有修改时重新运行工作流并发送群通知
+WATCH_ENABLED = False
+
+# 监听列表数据库路径
+WATCH_DB_PATH = 'watched_docs.db'
+
+# 每轮扫描的周期（秒），同一文档的修改最迟在一个周期后被发现
+WATCH_SCAN_INTERVAL = 600
+
+# 每轮扫描分成的组数，每隔 周期/组数 秒扫描一组，避免集中请求
+WATCH_SCAN_SLOTS = 60
+
+# 重新运行有修改文档的 worker 线程数（以 bulk 优先级申请并发名额）
+WATCH_WORKERS = 2
+
+# /api/watch 的管理令牌：请求需携带 X-Admin-Token 请求头；留空时该接口返回 404
+WATCH_ADMIN_TOKEN = ''
+
+
+# ===== 幂等配置 =====
+# /api/process 的 Idempotency-Key 结果保存时长（秒），窗口内的重放直接返回保存的结果
+IDEMPOTENCY_WINDOW = 3600
+
+# 最多保存的幂等键数量（超出后按最久未使用淘汰）
+IDEMPOTENCY_MAX_KEYS = 10000
+
+
+# ===== 自适应并发配置 =====
+# 是否根据 Coze 延迟与错误率自适应限制同时进行的工作流运行数
+ADAPTIVE_CONCURRENCY_ENABLED = True
+
+# 初始、最小、最大并发上限
+CONCURRENCY_INITIAL_LIMIT = 8
+CONCURRENCY_MIN_LIMIT = 1
+CONCURRENCY_MAX_LIMIT = 64
+
+# 首个事件延迟超过基线多少倍视为拥塞
+CONCURRENCY_LATENCY_TOLERANCE = 2.0
+
+# 上游过载（429/5xx、超时、熔断）时并发上限的收缩比例
+CONCURRENCY_BACKOFF_RATIO = 0.7
+
+# 延迟基线的统计窗口（秒），基线取最近两个窗口内的最小延迟
+CONCURRENCY_BASELINE_WINDOW = 300
+
+
+# ===== 对冲启动配置 =====
+# 是否开启对冲：工作流迟迟没有产出首个事件时再发起一次相同的调用，先产出事件的一方胜出
+HEDGE_ENABLED = False
+
+# 对冲延迟取近期首个事件延迟的百分位数
+HEDGE_PERCENTILE = 95
+
+# 对冲延迟下限（秒），避免样本偏小时过早对冲
+HEDGE_MIN_DELAY = 1.0
+
+# 计算分位数使用的最近样本数，样本数不足 HEDGE_MIN_SAMPLES 时不对冲
+HEDGE_SAMPLE_WINDOW = 200
+HEDGE_MIN_SAMPLES = 20
+
+# 对冲预算：对冲调用最多占运行数的比例，以及允许的短时突发次数
+HEDGE_BUDGET_RATIO = 0.05
+HEDGE_BUDGET_BURST = 3
+
+
+# ===== 优先级调度配置 =====
+# 工作流并发名额的优先级类别：
+#   weight    - 权重，名额空出时优先分配给权重高的请求
+#   max_wait  - 名额已满时最多排队的时间（秒），超时后拒绝（网页返回 503，群聊回复繁忙提示）；
+#               实际不超过运行剩余时间减去 NOTIFY_TIMEOUT_RESERVE 与 WORKFLOW_MIN_RUN_TIME
+#   max_share - 该类别最多占用的名额比例，避免批量任务占满所有名额
+# /api/process 默认 interactive，可通过请求头 X-Priority 或请求体 priority 指定；群聊消息默认 bot
+SCHEDULER_CLASSES = {
+    "interactive": {"weight": 8, "max_wait": 10, "max_share": 1.0},
+    "bot": {"weight": 4, "max_wait": 60, "max_share": 1.0},
+    "bulk": {"weight": 1, "max_wait": 600, "max_share": 0.5},
+}
+
+# 老化周期（秒）：每排队一个周期，请求的得分增加一倍权重，保证低优先级请求最终得到执行
+SCHEDULER_AGING_PERIOD = 30
+
+# 指定群聊使用的优先级类别（如自动化群使用 bulk），未列出的群聊使用 bot
+SCHEDULER_CHAT_CLASSES = {}
+
+
+# ===== 群聊公平调度配置 =====
+# 处理群聊消息的后台线程数；各群聊的消息按加权轮询分配给这些线程，单个群聊刷屏不会占满所有线程
+CHAT_WORKER_THREADS = 8
+
+# 每个群聊同时处理的消息数上限
+CHAT_MAX_CONCURRENCY = 2
+
+# 每个群聊最多排队的消息数，超出时丢弃新消息
+CHAT_MAX_QUEUED = 100
+
+# 群聊权重（每轮可处理的消息数），未列出的群聊为 1，例如 {"oc_xxx": 3}
+CHAT_WEIGHTS = {}
+
+
+# ===== 多实例协调配置 =====
+# 协调后端：'local'（进程内，单实例部署）或 'redis'（多实例共享工作队列、消息去重与限流，需要 Redis 6.2+）
+COORDINATION_BACKEND = 'local'
+
+# Redis 地址（redis://[:密码@]主机:端口/库号）与键前缀
+COORDINATION_REDIS_URL = 'redis://127.0.0.1:6379/0'
+COORDINATION_PREFIX = 'coze-assistant:'
+
+# 飞书消息去重记录的保留时长（秒），飞书重推通常发生在几分钟内
+MESSAGE_DEDUPE_TTL = 86400
+
+# 共享工作队列：领取任务后的租约时长（秒，应大于 WORKFLOW_RUN_TIMEOUT），超时未确认的任务重新投递
+WORK_LEASE_TIMEOUT = 360
+
+# 任务最多投递次数
+WORK_MAX_ATTEMPTS = 3
+
+# 每个实例领取共享队列中群聊消息的 worker 线程数（仅 redis 后端），领取后放入本实例的群聊队列，
+# 由 CHAT_WORKER_THREADS 个线程按群聊公平处理
+WORKER_THREADS = 8
+
+# 所有实例合计每分钟最多启动的工作流运行数，0 表示不限
+SHARED_RATE_LIMIT = 0
+
+
+# ===== 性能分析配置 =====
+# 按需分析令牌：请求携带 X-Profile-Token 请求头或 profile=<令牌> 查询参数时，采样分析该请求（含后台线程）
+# 留空则关闭按需分析（飞书回调可在事件订阅地址后临时追加 ?profile=<令牌>）
+PROFILING_TOKEN = ''
+
+# 按需分析的采样间隔（秒）
+PROFILING_INTERVAL = 0.01
+
+# 分析结果目录（collapsed stack 格式，可用 flamegraph.pl 或 speedscope 查看）
+PROFILING_OUTPUT_DIR = 'profiles'
+
+# 常驻低频采样间隔（秒），0 表示关闭；开启时对所有线程采样
+PROFILING_CONTINUOUS_INTERVAL = 0
+
+# 常驻采样结果的写出周期（秒）
+PROFILING_CONTINUOUS_FLUSH = 600
+
+
+# ===== 内存诊断配置 =====
+# 管理接口令牌：配置后注册 /admin/memory 诊断接口，请求需携带 X-Admin-Token 请求头；留空则不注册
+DIAGNOSTICS_TOKEN = ''
+
+# 最多保存的 tracemalloc 快照数量（快照本身占用较多内存）
+MEMORY_SNAPSHOT_LIMIT = 3
+
+
 # ===== 其他配置 =====
 # Access Token 缓存时间（秒），飞书 token 有效期为 2 小时
 TOKEN_CACHE_DURATION = 7000
@@ -65,3 +314,17 @@ TOKEN_CACHE_DURATION = 7000
 # 日志级别
 LOG_LEVEL = 'INFO'
 
+
+# ===== 配置热更新 =====
+# 覆盖以上配置的 JSON 文件路径（也可通过环境变量 AICASE_CONFIG_FILE 指定），留空表示不使用
+# 任一配置项也可以用同名环境变量覆盖，优先级：环境变量 > 配置文件 > 本文件
+CONFIG_FILE = ''
+
+# 检查配置文件是否修改的间隔（秒），修改后自动重新加载；0 表示只在收到 SIGHUP 时重新加载
+CONFIG_WATCH_INTERVAL = 5
+
+
+# 应用环境变量和配置文件中的覆盖值（必须放在文件末尾）
+import config_reload as _config_reload  # noqa: E402
+_config_reload.config_reloader.apply_overrides(globals())
+
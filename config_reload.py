@@ -0,0 +1,391 @@
+"""
+配置热更新模块 - 从环境变量和配置文件覆盖 config.py，运行中重新加载无需重启
+
+- 优先级：环境变量 > 配置文件（CONFIG_FILE，JSON 对象）> config.py 中的默认值
+- 环境变量需加 AICASE_ 前缀（如 AICASE_COZE_API_TOKEN），避免与其他程序的同名变量冲突
+- 只接受 config.py 中已定义的配置项，值按默认值的类型校验和转换（环境变量为字符串），
+  并检查取值范围（除数、上限、超时必须大于 0，优先级类别的结构等）与配置项之间的约束
+- 重新加载时先完整校验，任一项不合法则整体放弃、保留当前配置；校验通过后一次性替换 config 中的值
+- 触发方式：SIGHUP 信号，或配置文件修改（每 CONFIG_WATCH_INTERVAL 秒检查一次）
+- 组件通过 on_change 订阅关心的配置项（如 Coze 客户端、飞书 token、日志级别），
+  进行中的运行继续使用原有对象，新的运行使用新值
+- 各模块在调用时读取 config.X 的配置直接生效；创建时读取的配置（监听地址、数据库路径、
+  协调后端、worker 数、缓存容量、熔断与并发限制参数等）需要重启，重新加载时会给出提示
+"""
+
+import json
+import logging
+import os
+import signal
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+# config 导入时会调用本模块，这里不能导入 utils（utils 依赖 config），直接使用同名 logger
+logger = logging.getLogger("utils")
+
+# 环境变量前缀：只读取 AICASE_<配置项> 形式的环境变量
+ENV_PREFIX = "AICASE_"
+
+# 需要重启才能生效的配置项（在创建全局对象或启动后台线程时读取）
+RESTART_REQUIRED = {
+    "FLASK_HOST", "FLASK_PORT", "FLASK_DEBUG",
+    "RUN_HISTORY_DB_PATH", "WATCH_DB_PATH",
+    "RUN_HISTORY_BATCH_SIZE", "RUN_HISTORY_FLUSH_INTERVAL", "RUN_HISTORY_QUEUE_SIZE",
+    "FEISHU_EVENT_MODE", "FEISHU_WS_DOMAIN",
+    "COORDINATION_BACKEND", "COORDINATION_REDIS_URL", "COORDINATION_PREFIX",
+    "WORKER_THREADS", "WATCH_WORKERS", "CHAT_WORKER_THREADS",
+    "WORK_LEASE_TIMEOUT", "WORK_MAX_ATTEMPTS",
+    "RUN_MONITOR_INTERVAL",
+    "CIRCUIT_FAILURE_THRESHOLD", "CIRCUIT_RECOVERY_TIMEOUT", "CIRCUIT_HALF_OPEN_MAX_CALLS",
+    "CONCURRENCY_INITIAL_LIMIT", "CONCURRENCY_MIN_LIMIT", "CONCURRENCY_MAX_LIMIT",
+    "IDEMPOTENCY_WINDOW", "IDEMPOTENCY_MAX_KEYS",
+    "DOC_RESULT_CACHE_TTL", "DOC_RESULT_CACHE_SIZE", "DOC_META_CACHE_TTL", "DOC_META_BATCH_WINDOW",
+    "HEDGE_SAMPLE_WINDOW",
+    "PROFILING_TOKEN", "PROFILING_CONTINUOUS_INTERVAL", "DIAGNOSTICS_TOKEN",
+    "WATCH_SCAN_INTERVAL", "WATCH_SCAN_SLOTS",
+    "CONFIG_WATCH_INTERVAL",
+}
+
+_LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
+
+_TRUE = ("1", "true", "yes", "on")
+_FALSE = ("0", "false", "no", "off")
+
+
+def _choice(*allowed):
+    def check(value):
+        if value not in allowed:
+            return f"可选值为 {', '.join(allowed)}"
+    return check
+
+
+def _required(value):
+    if not value:
+        return "不能为空"
+
+
+def _positive(value):
+    if value <= 0:
+        return "必须大于 0"
+
+
+def _between(low, high, include_high=True):
+    # 取值范围 (low, high]，include_high 为 False 时为 (low, high)
+    def check(value):
+        if not (low < value <= high) or (not include_high and value == high):
+            return f"取值范围为 ({low}, {high}{']' if include_high else ')'}"
+    return check
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _scheduler_classes(value):
+    if not value:
+        return "至少需要一个类别"
+    for name, settings in value.items():
+        if not isinstance(settings, dict):
+            return f"类别 {name} 应为 JSON 对象"
+        missing = [field for field in ("weight", "max_wait", "max_share") if field not in settings]
+        if missing:
+            return f"类别 {name} 缺少 {', '.join(missing)}"
+        if not all(_is_number(settings[field]) for field in ("weight", "max_wait", "max_share")):
+            return f"类别 {name} 的 weight、max_wait、max_share 应为数字"
+        if settings["weight"] <= 0:
+            return f"类别 {name} 的 weight 必须大于 0"
+        if settings["max_wait"] < 0:
+            return f"类别 {name} 的 max_wait 不能为负数"
+        if not 0 < settings["max_share"] <= 1:
+            return f"类别 {name} 的 max_share 取值范围为 (0, 1]"
+
+
+def _chat_weights(value):
+    for chat_id, weight in value.items():
+        if not _is_number(weight) or weight <= 0:
+            return f"群聊 {chat_id} 的权重必须是大于 0 的数字"
+
+
+# 必须大于 0 的配置项：作为除数、上限、超时或间隔使用，为 0 时运行会出错或停滞
+_POSITIVE = (
+    "FLASK_PORT", "FEISHU_WS_RECONNECT_MIN", "FEISHU_WS_RECONNECT_MAX",
+    "WORKFLOW_RUN_TIMEOUT", "HTTP_REQUEST_TIMEOUT", "RUN_MONITOR_INTERVAL",
+    "CIRCUIT_FAILURE_THRESHOLD", "CIRCUIT_RECOVERY_TIMEOUT", "CIRCUIT_HALF_OPEN_MAX_CALLS",
+    "RUN_HISTORY_BATCH_SIZE", "RUN_HISTORY_FLUSH_INTERVAL", "RUN_HISTORY_QUEUE_SIZE",
+    "TRANSCRIPT_MAX_BYTES", "DOC_META_TIMEOUT", "DOC_RESULT_CACHE_SIZE",
+    "WATCH_SCAN_INTERVAL", "WATCH_SCAN_SLOTS", "WATCH_WORKERS",
+    "IDEMPOTENCY_WINDOW", "IDEMPOTENCY_MAX_KEYS",
+    "CONCURRENCY_INITIAL_LIMIT", "CONCURRENCY_MIN_LIMIT", "CONCURRENCY_MAX_LIMIT",
+    "CONCURRENCY_LATENCY_TOLERANCE", "CONCURRENCY_BASELINE_WINDOW",
+    "HEDGE_SAMPLE_WINDOW", "SCHEDULER_AGING_PERIOD",
+    "CHAT_WORKER_THREADS", "CHAT_MAX_CONCURRENCY", "CHAT_MAX_QUEUED",
+    "MESSAGE_DEDUPE_TTL", "WORK_LEASE_TIMEOUT", "WORK_MAX_ATTEMPTS", "WORKER_THREADS",
+    "PROFILING_INTERVAL", "PROFILING_CONTINUOUS_FLUSH", "TOKEN_CACHE_DURATION",
+)
+
+
+# 校验前的规范化
+_NORMALIZERS: Dict[str, Callable[[Any], Any]] = {
+    "LOG_LEVEL": lambda value: value.upper(),
+}
+
+# 单项校验：返回错误说明，合法时返回 None
+_VALIDATORS: Dict[str, Callable[[Any], Optional[str]]] = {
+    "LOG_LEVEL": _choice(*_LOG_LEVELS),
+    "FEISHU_EVENT_MODE": _choice("webhook", "long_connection"),
+    "COORDINATION_BACKEND": _choice("local", "redis"),
+    "COZE_API_TOKEN": _required,
+    "COZE_WORKFLOW_ID": _required,
+    "COZE_WORKFLOW_INPUT_PARAM": _required,
+    "CONCURRENCY_BACKOFF_RATIO": _between(0, 1, include_high=False),
+    "HEDGE_PERCENTILE": _between(0, 100),
+    "SCHEDULER_CLASSES": _scheduler_classes,
+    "CHAT_WEIGHTS": _chat_weights,
+    **{key: _positive for key in _POSITIVE},
+}
+
+
+class ConfigReloader:
+    """配置加载、校验与热更新"""
+
+    def __init__(self):
+        self._namespace: Dict[str, Any] = {}
+        self._defaults: Dict[str, Any] = {}
+        self._listeners: List[Tuple[frozenset, Callable[[], None]]] = []
+        self._lock = threading.Lock()
+        self._watcher: Optional[threading.Thread] = None
+        self._file_stamp = None
+
+        # 状态信息
+        self.generation = 0
+        self.loaded_at: Optional[float] = None
+        self.overrides: List[str] = []
+        self.last_error: Optional[str] = None
+
+    def apply_overrides(self, namespace: Dict[str, Any]):
+        """
+        首次加载：记录 config.py 中的默认值并应用环境变量和配置文件（在 config.py 末尾调用）
+
+        Raises:
+            ValueError: 覆盖的配置不合法（启动时直接失败，避免带着错误配置运行）
+        """
+        self._namespace = namespace
+        self._defaults = {key: value for key, value in namespace.items() if key.isupper()}
+        values, errors = self._load()
+        if errors:
+            raise ValueError("配置不合法: " + "; ".join(errors))
+        self._apply(values)
+
+    def reload(self) -> Dict[str, Any]:
+        """
+        重新加载配置
+
+        Returns:
+            {"success": 是否生效, "changed": 变化的配置项, "errors": 校验错误}
+        """
+        with self._lock:
+            values, errors = self._load()
+            if errors:
+                self.last_error = "; ".join(errors)
+                logger.error(f"重新加载配置失败，保留当前配置: {self.last_error}")
+                return {"success": False, "changed": [], "errors": errors}
+            changed = self._apply(values)
+            self.last_error = None
+
+        if changed:
+            logger.info(f"配置已重新加载（第 {self.generation} 版），变化的配置项: {', '.join(changed)}")
+            restart = sorted(RESTART_REQUIRED.intersection(changed))
+            if restart:
+                logger.warning(f"以下配置项需要重启才能生效: {', '.join(restart)}")
+            self._notify(set(changed))
+        else:
+            logger.info("配置已重新加载，没有变化")
+        return {"success": True, "changed": changed, "errors": []}
+
+    def on_change(self, keys: Iterable[str], callback: Callable[[], None]):
+        """
+        订阅配置变化：keys 中任一项变化时（在重新加载的线程中）调用 callback
+
+        Args:
+            keys: 关心的配置项
+            callback: 回调函数，无参数，应读取 config 中的新值
+        """
+        self._listeners.append((frozenset(keys), callback))
+
+    def _load(self) -> Tuple[Dict[str, Any], List[str]]:
+        # 合并 默认值 < 配置文件 < 环境变量，返回 (完整配置, 错误列表)
+        values = dict(self._defaults)
+        errors: List[str] = []
+
+        path = self._config_file()
+        if path:
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if not isinstance(data, dict):
+                    raise ValueError("内容应为 JSON 对象")
+                for key, value in data.items():
+                    self._set(values, key, value, f"{path}: {key}", errors, strict=True)
+            except FileNotFoundError:
+                errors.append(f"配置文件不存在: {path}")
+            except (OSError, ValueError) as e:
+                errors.append(f"读取配置文件失败 {path}: {str(e)}")
+
+        for key in self._defaults:
+            name = ENV_PREFIX + key
+            if name in os.environ:
+                self._set(values, key, os.environ[name], f"环境变量 {name}", errors, strict=False)
+
+        if values.get("COZE_BOT_ID") and values.get("COZE_APP_ID"):
+            errors.append("COZE_BOT_ID 和 COZE_APP_ID 不能同时设置")
+        errors.extend(_check_combined(values))
+        return values, errors
+
+    def _set(self, values: Dict[str, Any], key: str, raw: Any, source: str, errors: List[str], strict: bool):
+        if key not in self._defaults:
+            errors.append(f"{source}: 未知的配置项")
+            return
+        try:
+            value = _convert(raw, self._defaults[key], from_env=not strict)
+            if key in _NORMALIZERS:
+                value = _NORMALIZERS[key](value)
+        except (TypeError, ValueError) as e:
+            errors.append(f"{source}: {str(e)}")
+            return
+        check = _VALIDATORS.get(key)
+        problem = check(value) if check else None
+        if problem is None and isinstance(value, (int, float)) and not isinstance(value, bool) and value < 0:
+            problem = "不能为负数"
+        if problem:
+            errors.append(f"{source}: {problem}")
+            return
+        values[key] = value
+
+    def _apply(self, values: Dict[str, Any]) -> List[str]:
+        # 一次性替换变化的配置项，返回变化的配置项名称
+        changed = {key: value for key, value in values.items() if self._namespace.get(key) != value}
+        self._namespace.update(changed)
+        self.overrides = sorted(key for key, value in values.items() if value != self._defaults[key])
+        self.generation += 1
+        self.loaded_at = time.time()
+        return sorted(changed)
+
+    def _notify(self, changed: set):
+        for keys, callback in self._listeners:
+            if keys & changed:
+                try:
+                    callback()
+                except Exception as e:
+                    logger.error(f"应用新配置失败（{getattr(callback, '__name__', callback)}）: {str(e)}")
+
+    def start_watching(self):
+        """
+        开始监听重新加载信号和配置文件修改（在服务进程启动时调用一次）
+        """
+        if hasattr(signal, "SIGHUP") and threading.current_thread() is threading.main_thread():
+            # 信号处理函数中不做耗时操作，交给后台线程重新加载
+            signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(
+                target=self.reload, name="config-reload", daemon=True
+            ).start())
+
+        interval = self._namespace.get("CONFIG_WATCH_INTERVAL", 0)
+        if self._watcher is None and self._config_file() and interval > 0:
+            self._file_stamp = self._stamp()
+            self._watcher = threading.Thread(target=self._watch_loop, args=(interval,), name="config-watcher", daemon=True)
+            self._watcher.start()
+            logger.info(f"监听配置文件修改: {self._config_file()}")
+
+    def _config_file(self) -> Optional[str]:
+        return os.environ.get(ENV_PREFIX + "CONFIG_FILE", self._defaults.get("CONFIG_FILE"))
+
+    def _stamp(self):
+        try:
+            stat = os.stat(self._config_file())
+            return stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
+
+    def _watch_loop(self, interval: float):
+        while True:
+            time.sleep(interval)
+            stamp = self._stamp()
+            if stamp != self._file_stamp:
+                self._file_stamp = stamp
+                self.reload()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """加载状态，用于健康检查（不包含配置的值）"""
+        return {
+            "generation": self.generation,
+            "loaded_at": self.loaded_at,
+            "file": self._config_file() or None,
+            "overrides": self.overrides,
+            "last_error": self.last_error
+        }
+
+
+def _check_combined(values: Dict[str, Any]) -> List[str]:
+    """多个配置项之间的约束，返回错误说明列表"""
+    errors = []
+
+    def get(key):
+        return values.get(key, 0)
+
+    if not get("CONCURRENCY_MIN_LIMIT") <= get("CONCURRENCY_INITIAL_LIMIT") <= get("CONCURRENCY_MAX_LIMIT"):
+        errors.append("并发上限应满足 CONCURRENCY_MIN_LIMIT <= CONCURRENCY_INITIAL_LIMIT <= CONCURRENCY_MAX_LIMIT")
+    if get("FEISHU_WS_RECONNECT_MIN") > get("FEISHU_WS_RECONNECT_MAX"):
+        errors.append("FEISHU_WS_RECONNECT_MIN 不能大于 FEISHU_WS_RECONNECT_MAX")
+    if get("TRANSCRIPT_HEAD_BYTES") >= get("TRANSCRIPT_MAX_BYTES"):
+        errors.append("TRANSCRIPT_HEAD_BYTES 应小于 TRANSCRIPT_MAX_BYTES")
+    if get("WORKFLOW_RUN_TIMEOUT") <= get("NOTIFY_TIMEOUT_RESERVE") + get("WORKFLOW_MIN_RUN_TIME"):
+        errors.append("WORKFLOW_RUN_TIMEOUT 应大于 NOTIFY_TIMEOUT_RESERVE + WORKFLOW_MIN_RUN_TIME")
+
+    classes = values.get("SCHEDULER_CLASSES")
+    if isinstance(classes, dict):
+        unknown = sorted({cls for cls in values.get("SCHEDULER_CHAT_CLASSES", {}).values() if cls not in classes})
+        if unknown:
+            errors.append(f"SCHEDULER_CHAT_CLASSES 使用了未定义的类别: {', '.join(unknown)}")
+    return errors
+
+
+def _convert(raw: Any, default: Any, from_env: bool) -> Any:
+    """
+    按默认值的类型转换配置值
+
+    Raises:
+        ValueError / TypeError: 类型不符或无法转换
+    """
+    if default is None:
+        # 可选配置：空字符串视为未设置
+        return raw if raw != "" else None
+    if isinstance(default, bool):
+        if isinstance(raw, bool):
+            return raw
+        if from_env and str(raw).strip().lower() in _TRUE + _FALSE:
+            return str(raw).strip().lower() in _TRUE
+        raise ValueError("应为布尔值")
+    if isinstance(default, (int, float)):
+        if isinstance(raw, bool):
+            raise ValueError("应为数字")
+        if from_env:
+            raw = float(raw)
+        if not isinstance(raw, (int, float)):
+            raise ValueError("应为数字")
+        if isinstance(default, int) and float(raw).is_integer():
+            return int(raw)
+        return float(raw)
+    if isinstance(default, (dict, list)):
+        if from_env:
+            raw = json.loads(raw)
+        if not isinstance(raw, type(default)):
+            raise ValueError(f"应为 JSON {'对象' if isinstance(default, dict) else '数组'}")
+        return raw
+    if not isinstance(raw, str):
+        raise ValueError("应为字符串")
+    return raw
+
+
+# 全局实例
+config_reloader = ConfigReloader()
+on_change = config_reloader.on_change
@@ -0,0 +1,657 @@
+"""
+协调模块 - 多实例部署时共享的工作队列、去重与限流
+
+两种后端（config.COORDINATION_BACKEND）：
+- local：进程内实现，单实例部署使用（默认）
+- redis：通过 Redis 协议（RESP）连接共享服务，多个实例共用同一份队列、去重记录与限流计数；
+  需要 Redis 6.2+（使用 BLMOVE）。本地联调可使用 StandinRedisServer 代替
+
+工作队列语义：任一实例都可以提交任务，任一 worker 都可以领取；领取后持有租约（WORK_LEASE_TIMEOUT），
+处理完成后确认（ack）。worker 崩溃导致租约过期的任务会被重新放回队列，最多投递 WORK_MAX_ATTEMPTS 次。
+"""
+
+import json
+import socket
+import socketserver
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional
+from urllib.parse import urlparse
+
+import config
+from utils import logger
+from concurrency import LimitExceeded
+
+
+class CoordinationError(Exception):
+    """协调后端不可用或返回错误"""
+
+
+# ===== 进程内后端 =====
+
+class LocalBackend:
+    """进程内后端（线程安全）"""
+
+    distributed = False
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._keys: Dict[str, float] = {}         # 键 -> 过期时间
+        self._counters: Dict[str, list] = {}      # 键 -> [计数, 过期时间]
+        self._queues: Dict[str, Deque[str]] = {}
+        self._processing: Dict[str, Dict[str, tuple]] = {}  # 队列 -> {任务 ID: (原始数据, 租约到期时间)}
+        self._last_purge = time.monotonic()
+
+    def claim_once(self, key: str, ttl: float) -> bool:
+        with self._cond:
+            now = time.monotonic()
+            self._purge(now)
+            expires_at = self._keys.get(key)
+            if expires_at is not None and expires_at > now:
+                return False
+            self._keys[key] = now + ttl
+            return True
+
+    def incr_window(self, key: str, window: float) -> int:
+        with self._cond:
+            now = time.monotonic()
+            counter = self._counters.get(key)
+            if counter is None or counter[1] <= now:
+                counter = self._counters[key] = [0, now + window]
+            counter[0] += 1
+            return counter[0]
+
+    def _purge(self, now: float):
+        # 调用方需持有锁；定期清理过期的去重键和计数，保证内存有界
+        if now - self._last_purge < 60:
+            return
+        self._last_purge = now
+        self._keys = {k: v for k, v in self._keys.items() if v > now}
+        self._counters = {k: v for k, v in self._counters.items() if v[1] > now}
+
+    def push(self, queue: str, raw: str, front: bool = False):
+        with self._cond:
+            items = self._queues.setdefault(queue, deque())
+            if front:
+                items.append(raw)
+            else:
+                items.appendleft(raw)
+            self._cond.notify()
+
+    def claim(self, queue: str, item_id: Callable[[str], str], lease: float, timeout: float) -> Optional[str]:
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            items = self._queues.setdefault(queue, deque())
+            while not items:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            raw = items.pop()
+            self._processing.setdefault(queue, {})[item_id(raw)] = (raw, time.monotonic() + lease)
+            return raw
+
+    def ack(self, queue: str, raw: str, task_id: str):
+        with self._cond:
+            self._processing.get(queue, {}).pop(task_id, None)
+
+    def reap(self, queue: str) -> List[str]:
+        with self._cond:
+            now = time.monotonic()
+            processing = self._processing.get(queue, {})
+            expired = [task_id for task_id, (_, expires_at) in processing.items() if expires_at <= now]
+            return [processing.pop(task_id)[0] for task_id in expired]
+
+    def length(self, queue: str) -> int:
+        with self._cond:
+            return len(self._queues.get(queue, ()))
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "backend": "local",
+                "dedupe_keys": len(self._keys),
+                "counters": len(self._counters),
+                "processing": {queue: len(items) for queue, items in self._processing.items()}
+            }
+
+
+# ===== Redis 协议后端 =====
+
+def _encode_command(args) -> bytes:
+    parts = [f"*{len(args)}\r\n".encode()]
+    for arg in args:
+        data = arg if isinstance(arg, bytes) else str(arg).encode('utf-8')
+        parts.append(f"${len(data)}\r\n".encode() + data + b"\r\n")
+    return b"".join(parts)
+
+
+class RespError(CoordinationError):
+    """服务端返回的错误回复"""
+
+
+def _read_reply(reader) -> Any:
+    line = reader.readline()
+    if not line:
+        raise ConnectionError("连接已关闭")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest.decode('utf-8')
+    if kind == b"-":
+        return RespError(rest.decode('utf-8'))
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        length = int(rest)
+        if length < 0:
+            return None
+        data = reader.read(length + 2)
+        return data[:-2].decode('utf-8')
+    if kind == b"*":
+        count = int(rest)
+        if count < 0:
+            return None
+        return [_read_reply(reader) for _ in range(count)]
+    raise CoordinationError(f"无法解析的回复: {line!r}")
+
+
+class _RespConnection:
+    """单个 RESP 连接"""
+
+    def __init__(self, host: str, port: int, password: Optional[str], db: int):
+        self._sock = socket.create_connection((host, port), timeout=config.HTTP_REQUEST_TIMEOUT)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._reader = self._sock.makefile('rb')
+        if password:
+            self.call("AUTH", password)
+        if db:
+            self.call("SELECT", db)
+
+    def call(self, *args, timeout: float = None):
+        self._sock.settimeout(config.HTTP_REQUEST_TIMEOUT + (timeout or 0))
+        self._sock.sendall(_encode_command(args))
+        reply = _read_reply(self._reader)
+        if isinstance(reply, RespError):
+            raise reply
+        return reply
+
+    def close(self):
+        try:
+            self._reader.close()
+            self._sock.close()
+        except OSError:
+            pass
+
+
+class RedisBackend:
+    """Redis 协议后端（每个线程一个连接，出错后下次调用重新连接）"""
+
+    distributed = True
+
+    # 处理中但没有租约的任务需要持续多久才视为遗失（领取与设置租约之间的间隙）
+    _LEASE_GRACE = 5.0
+
+    def __init__(self, url: str, prefix: str = ""):
+        """
+        Args:
+            url: redis://[:密码@]主机:端口/库号
+            prefix: 所有键的前缀，多个服务共用同一 Redis 时区分命名空间
+        """
+        parsed = urlparse(url)
+        self._host = parsed.hostname or '127.0.0.1'
+        self._port = parsed.port or 6379
+        self._password = parsed.password
+        self._db = int(parsed.path.lstrip('/') or 0)
+        self._prefix = prefix
+        self._local = threading.local()
+        self._suspects: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def _call(self, *args, timeout: float = None):
+        conn = getattr(self._local, 'conn', None)
+        try:
+            if conn is None:
+                conn = self._local.conn = _RespConnection(self._host, self._port, self._password, self._db)
+            return conn.call(*args, timeout=timeout)
+        except RespError:
+            raise
+        except (OSError, ConnectionError) as e:
+            if conn is not None:
+                conn.close()
+            self._local.conn = None
+            raise CoordinationError(f"协调后端连接失败: {str(e)}") from e
+
+    def _key(self, name: str) -> str:
+        return self._prefix + name
+
+    def claim_once(self, key: str, ttl: float) -> bool:
+        return self._call("SET", self._key(key), "1", "NX", "EX", max(1, int(ttl))) == "OK"
+
+    def incr_window(self, key: str, window: float) -> int:
+        count = self._call("INCR", self._key(key))
+        if count == 1:
+            self._call("EXPIRE", self._key(key), max(1, int(window)))
+        return count
+
+    def push(self, queue: str, raw: str, front: bool = False):
+        self._call("RPUSH" if front else "LPUSH", self._key(queue), raw)
+
+    def claim(self, queue: str, item_id: Callable[[str], str], lease: float, timeout: float) -> Optional[str]:
+        raw = self._call(
+            "BLMOVE", self._key(queue), self._key(queue + ":processing"), "RIGHT", "LEFT",
+            max(0.01, timeout), timeout=timeout
+        )
+        if raw is not None:
+            self._call("SET", self._key(f"{queue}:lease:{item_id(raw)}"), "1", "EX", max(1, int(lease)))
+        return raw
+
+    def ack(self, queue: str, raw: str, task_id: str):
+        self._call("LREM", self._key(queue + ":processing"), 1, raw)
+        self._call("DEL", self._key(f"{queue}:lease:{task_id}"))
+
+    def reap(self, queue: str) -> List[str]:
+        processing = self._key(queue + ":processing")
+        now = time.monotonic()
+        expired = []
+        seen = set()
+        for raw in self._call("LRANGE", processing, 0, -1) or []:
+            seen.add(raw)
+            try:
+                task_id = json.loads(raw)["id"]
+            except (ValueError, KeyError):
+                task_id = None
+            if task_id is not None and self._call("EXISTS", self._key(f"{queue}:lease:{task_id}")):
+                continue
+            with self._lock:
+                first_seen = self._suspects.setdefault(raw, now)
+            if now - first_seen < self._LEASE_GRACE:
+                continue
+            # LREM 返回 1 说明由本实例取回，避免多个实例重复放回
+            if self._call("LREM", processing, 1, raw) == 1:
+                expired.append(raw)
+        with self._lock:
+            self._suspects = {raw: t for raw, t in self._suspects.items() if raw in seen and raw not in expired}
+        return expired
+
+    def length(self, queue: str) -> int:
+        return self._call("LLEN", self._key(queue))
+
+    def snapshot(self) -> Dict[str, Any]:
+        try:
+            self._call("PING")
+            reachable = True
+        except CoordinationError:
+            reachable = False
+        return {"backend": "redis", "address": f"{self._host}:{self._port}/{self._db}", "reachable": reachable}
+
+
+# ===== 工作队列 =====
+
+class WorkItem:
+    """一个已领取的任务"""
+
+    def __init__(self, raw: str):
+        data = json.loads(raw)
+        self.raw = raw
+        self.id = data["id"]
+        self.attempts = data.get("attempts", 1)
+        self.payload = data["payload"]
+
+
+class WorkQueue:
+    """共享工作队列（任一实例提交，任一 worker 领取）"""
+
+    def __init__(self, name: str, backend=None, lease: float = None, max_attempts: int = None):
+        """
+        Args:
+            name: 队列名称
+            backend: 协调后端，默认使用全局后端
+            lease: 领取后的租约时长（秒），应大于单个任务的最长处理时间
+            max_attempts: 最多投递次数（租约过期后重新投递）
+        """
+        self.name = name
+        self._backend = backend or coordinator
+        self._lease = lease or config.WORK_LEASE_TIMEOUT
+        self._max_attempts = max_attempts or config.WORK_MAX_ATTEMPTS
+        self._last_reap = 0.0
+        self._reap_lock = threading.Lock()
+        self._workers: List[threading.Thread] = []
+        self._stop = threading.Event()
+
+        # 统计信息
+        self.submitted = 0
+        self.completed = 0
+        self.redelivered = 0
+        self.dropped = 0
+
+    @staticmethod
+    def _item_id(raw: str) -> str:
+        return json.loads(raw)["id"]
+
+    def submit(self, payload: Any) -> str:
+        """提交任务，返回任务 ID"""
+        task_id = uuid.uuid4().hex
+        self._backend.push(self.name, json.dumps({"id": task_id, "attempts": 1, "payload": payload}, ensure_ascii=False))
+        self.submitted += 1
+        return task_id
+
+    def claim(self, timeout: float = 1.0) -> Optional[WorkItem]:
+        """领取一个任务，队列为空时最多等待 timeout 秒"""
+        self._maybe_reap()
+        raw = self._backend.claim(self.name, self._item_id, self._lease, timeout)
+        return WorkItem(raw) if raw is not None else None
+
+    def ack(self, item: WorkItem):
+        """确认任务已处理完成"""
+        self._backend.ack(self.name, item.raw, item.id)
+        self.completed += 1
+
+    def _maybe_reap(self):
+        # 定期把租约过期的任务放回队列（多个 worker 中只有一个执行）
+        now = time.monotonic()
+        if now - self._last_reap < min(self._lease / 4, 30) or not self._reap_lock.acquire(blocking=False):
+            return
+        try:
+            self._last_reap = now
+            for raw in self._backend.reap(self.name):
+                data = json.loads(raw)
+                data["attempts"] = data.get("attempts", 1) + 1
+                if data["attempts"] > self._max_attempts:
+                    self.dropped += 1
+                    logger.error(f"任务超过最大投递次数，放弃: {self.name}/{data.get('id')}")
+                    continue
+                self.redelivered += 1
+                logger.warning(f"任务租约过期，重新投递（第 {data['attempts']} 次）: {self.name}/{data.get('id')}")
+                self._backend.push(self.name, json.dumps(data, ensure_ascii=False), front=True)
+        except CoordinationError as e:
+            logger.error(f"回收过期任务失败: {str(e)}")
+        finally:
+            self._reap_lock.release()
+
+    def start_workers(self, handler: Callable[[Any], None], count: int):
+        """
+        启动 worker 线程持续领取并处理任务
+
+        Args:
+            handler: 任务处理函数，参数为提交时的 payload
+            count: worker 线程数
+        """
+        for index in range(count):
+            thread = threading.Thread(
+                target=self._worker_loop, args=(handler,),
+                name=f"worker-{self.name}-{index}", daemon=True
+            )
+            thread.start()
+            self._workers.append(thread)
+        logger.info(f"已启动 {count} 个 worker 处理队列: {self.name}")
+
+    def stop_workers(self):
+        self._stop.set()
+        for thread in self._workers:
+            thread.join(timeout=5)
+        self._workers = []
+
+    def _worker_loop(self, handler: Callable[[Any], None]):
+        while not self._stop.is_set():
+            try:
+                item = self.claim(timeout=1.0)
+            except CoordinationError as e:
+                logger.error(f"领取任务失败: {str(e)}")
+                self._stop.wait(1.0)
+                continue
+            if item is None:
+                continue
+            try:
+                handler(item.payload)
+            except Exception as e:
+                logger.error(f"处理任务出错: {self.name}/{item.id}: {str(e)}")
+            try:
+                self.ack(item)
+            except CoordinationError as e:
+                logger.error(f"确认任务失败: {str(e)}")
+
+    def snapshot(self) -> Dict[str, Any]:
+        """队列状态，用于健康检查"""
+        try:
+            queued = self._backend.length(self.name)
+        except CoordinationError:
+            queued = None
+        return {
+            "queued": queued,
+            "workers": len(self._workers),
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "redelivered": self.redelivered,
+            "dropped": self.dropped
+        }
+
+
+# ===== 共享去重与限流 =====
+
+def claim_once(key: str, ttl: float = None) -> bool:
+    """
+    在所有实例间只处理一次（如飞书消息去重）
+
+    Returns:
+        True 表示本次是第一次处理；后端不可用时按第一次处理（宁可重复也不丢消息）
+    """
+    try:
+        return coordinator.claim_once(key, ttl or config.MESSAGE_DEDUPE_TTL)
+    except CoordinationError as e:
+        logger.error(f"共享去重失败，按未处理继续: {str(e)}")
+        return True
+
+
+def check_rate(name: str, limit: int = None, window: float = 60):
+    """
+    所有实例共享的固定窗口限流
+
+    Args:
+        name: 限流名称
+        limit: 窗口内允许的次数，0 表示不限
+        window: 窗口长度（秒）
+
+    Raises:
+        LimitExceeded: 超过限额
+    """
+    limit = config.SHARED_RATE_LIMIT if limit is None else limit
+    if not limit:
+        return
+    now = time.time()
+    bucket = int(now // window)
+    try:
+        count = coordinator.incr_window(f"rate:{name}:{bucket}", window)
+    except CoordinationError as e:
+        logger.error(f"共享限流失败，放行请求: {str(e)}")
+        return
+    if count > limit:
+        raise LimitExceeded(name, limit, (bucket + 1) * window - now)
+
+
+# ===== 本地模拟 Redis =====
+
+class StandinRedisServer:
+    """
+    模拟 Redis 服务端（只实现本模块用到的命令），用于本地联调和多实例测试
+
+    用法：
+        server = StandinRedisServer().start()
+        backend = RedisBackend(server.url)
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        self._cond = threading.Condition()
+        self._data: Dict[str, Any] = {}
+        self._expires: Dict[str, float] = {}
+        standin = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                while True:
+                    try:
+                        command = _read_reply(self.rfile)
+                    except (ConnectionError, OSError, ValueError):
+                        return
+                    self.wfile.write(standin._execute(command))
+
+        class Server(socketserver.ThreadingTCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self._server = Server((host, port), Handler)
+        self.url = f"redis://{host}:{self._server.server_address[1]}/0"
+
+    def start(self) -> 'StandinRedisServer':
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _get(self, key: str):
+        # 调用方需持有锁
+        expires_at = self._expires.get(key)
+        if expires_at is not None and expires_at <= time.monotonic():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return self._data.get(key)
+
+    def _execute(self, command: List[str]) -> bytes:
+        name, args = command[0].upper(), command[1:]
+        handler = getattr(self, f"_cmd_{name.lower()}", None)
+        if handler is None:
+            return f"-ERR unknown command '{name}'\r\n".encode()
+        return self._encode(handler(*args))
+
+    @staticmethod
+    def _encode(reply) -> bytes:
+        if reply is None:
+            return b"$-1\r\n"
+        if isinstance(reply, bool):
+            return f":{int(reply)}\r\n".encode()
+        if isinstance(reply, int):
+            return f":{reply}\r\n".encode()
+        if isinstance(reply, list):
+            return f"*{len(reply)}\r\n".encode() + b"".join(StandinRedisServer._encode(item) for item in reply)
+        if reply == "OK" or reply == "PONG":
+            return f"+{reply}\r\n".encode()
+        data = reply.encode('utf-8')
+        return f"${len(data)}\r\n".encode() + data + b"\r\n"
+
+    def _cmd_ping(self, *args):
+        return "PONG"
+
+    def _cmd_select(self, db):
+        return "OK"
+
+    def _cmd_set(self, key, value, *options):
+        options = [option.upper() for option in options]
+        with self._cond:
+            if "NX" in options and self._get(key) is not None:
+                return None
+            self._data[key] = value
+            self._expires.pop(key, None)
+            if "EX" in options:
+                self._expires[key] = time.monotonic() + float(options[options.index("EX") + 1])
+            return "OK"
+
+    def _cmd_del(self, *keys):
+        with self._cond:
+            removed = 0
+            for key in keys:
+                if self._get(key) is not None:
+                    removed += 1
+                self._data.pop(key, None)
+                self._expires.pop(key, None)
+            return removed
+
+    def _cmd_exists(self, key):
+        with self._cond:
+            return int(self._get(key) is not None)
+
+    def _cmd_incr(self, key):
+        with self._cond:
+            value = int(self._get(key) or 0) + 1
+            self._data[key] = str(value)
+            return value
+
+    def _cmd_expire(self, key, seconds):
+        with self._cond:
+            if self._get(key) is None:
+                return 0
+            self._expires[key] = time.monotonic() + float(seconds)
+            return 1
+
+    def _list(self, key) -> Deque[str]:
+        value = self._get(key)
+        if value is None:
+            value = self._data[key] = deque()
+        return value
+
+    def _cmd_lpush(self, key, *values):
+        with self._cond:
+            items = self._list(key)
+            items.extendleft(values)
+            self._cond.notify_all()
+            return len(items)
+
+    def _cmd_rpush(self, key, *values):
+        with self._cond:
+            items = self._list(key)
+            items.extend(values)
+            self._cond.notify_all()
+            return len(items)
+
+    def _cmd_llen(self, key):
+        with self._cond:
+            return len(self._get(key) or ())
+
+    def _cmd_lrange(self, key, start, stop):
+        with self._cond:
+            items = list(self._get(key) or ())
+            stop = int(stop)
+            return items[int(start):None if stop == -1 else stop + 1]
+
+    def _cmd_lrem(self, key, count, value):
+        with self._cond:
+            items = self._get(key)
+            if not items:
+                return 0
+            removed = 0
+            while removed < int(count) and value in items:
+                items.remove(value)
+                removed += 1
+            return removed
+
+    def _cmd_blmove(self, source, destination, where_from, where_to, timeout):
+        deadline = time.monotonic() + float(timeout)
+        with self._cond:
+            while True:
+                items = self._get(source)
+                if items:
+                    value = items.pop() if where_from.upper() == "RIGHT" else items.popleft()
+                    target = self._list(destination)
+                    if where_to.upper() == "LEFT":
+                        target.appendleft(value)
+                    else:
+                        target.append(value)
+                    return value
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+
+
+def create_backend():
+    """按配置创建协调后端"""
+    if config.COORDINATION_BACKEND == 'redis':
+        logger.info(f"使用共享协调后端: {config.COORDINATION_REDIS_URL}")
+        return RedisBackend(config.COORDINATION_REDIS_URL, config.COORDINATION_PREFIX)
+    return LocalBackend()
+
+
+# 全局协调后端（api.py 与 AIcase.py 共用）
+coordinator = create_backend()
@@ -0,0 +1,331 @@
+"""
+运行时限模块 - 为单次工作流运行提供总时限与取消能力
+
+一次运行（流式调用、中断恢复、通知发送）共享同一个 RunDeadline：
+- 每个阶段根据剩余时间计算自己的超时，而不是各自使用固定超时
+- 时限耗尽或发起请求的客户端断开时，后台巡检线程会取消运行，
+  并关闭该运行持有的上游连接，使阻塞中的读取立即返回
+"""
+
+import select
+import socket
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+import config
+from utils import logger
+
+
+# 取消原因
+CANCEL_DEADLINE = "deadline_exceeded"
+CANCEL_CLIENT_GONE = "client_disconnected"
+
+
+class RunCancelled(Exception):
+    """运行已被取消（客户端断开等）"""
+
+    # 主动取消不代表上游故障，熔断器不计入
+    breaker_neutral = True
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class DeadlineExceeded(RunCancelled):
+    """运行总时限已耗尽"""
+
+    def __init__(self, reason: str = CANCEL_DEADLINE, upstream: bool = False):
+        """
+        Args:
+            reason: 取消原因
+            upstream: 是否在上游调用开始后才到期
+        """
+        super().__init__(reason)
+        self.upstream = upstream
+        # 上游调用开始后才到期说明上游迟迟不返回，熔断器计为故障；
+        # 调用前就已到期（排队过久、客户端给的时限过短）与上游无关，不计入
+        self.breaker_neutral = not upstream
+
+
+def close_stream(stream: Any, abort: bool = False):
+    """
+    关闭 Coze 流式响应并释放底层连接
+
+    Args:
+        stream: cozepy 返回的 Stream 对象
+        abort: 是否强制中断（先 shutdown 底层 socket，可从其他线程打断阻塞中的读取）
+    """
+    response = getattr(stream, '_raw_response', None)
+    if response is None:
+        close = getattr(stream, 'close', None)
+        if close:
+            try:
+                close()
+            except Exception:
+                pass
+        return
+
+    if abort:
+        # 只做 shutdown：读取线程会立即收到 EOF/异常，真正的 close 留给持有者线程
+        try:
+            network_stream = response.extensions.get('network_stream')
+            sock = network_stream.get_extra_info('socket') if network_stream else None
+            if sock is not None:
+                sock.shutdown(socket.SHUT_RDWR)
+        except Exception:
+            pass
+        return
+
+    try:
+        response.close()
+    except Exception:
+        pass
+
+
+class RunDeadline:
+    """单次运行的时限与取消令牌"""
+
+    def __init__(self, budget: float, parent: 'RunDeadline' = None):
+        """
+        Args:
+            budget: 可用时间（秒）
+            parent: 父级时限；子级不会晚于父级到期，父级取消时子级一并取消
+        """
+        self.expires_at = time.monotonic() + max(budget, 0.0)
+        if parent is not None:
+            self.expires_at = min(self.expires_at, parent.expires_at)
+        self.cancel_reason: Optional[str] = None
+        # 是否已开始调用上游（见 begin_upstream）
+        self.upstream_started = False
+        self._parent = parent
+        self._lock = threading.Lock()
+        self._children: List['RunDeadline'] = []
+        self._streams: List[Any] = []
+        self._client_socket = None
+
+        if parent is not None:
+            parent._add_child(self)
+        _monitor.add(self)
+
+    def child(self, reserve: float = 0.0) -> 'RunDeadline':
+        """
+        派生一个提前 reserve 秒到期的子时限
+
+        常用于给后续阶段（如发送通知）预留时间
+
+        Raises:
+            DeadlineExceeded: 剩余时间不足 reserve 秒（子时限创建时即已到期）
+        """
+        budget = self.remaining() - reserve
+        if budget <= 0:
+            raise DeadlineExceeded()
+        return RunDeadline(budget, parent=self)
+
+    def remaining(self) -> float:
+        """剩余时间（秒）"""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_reason is not None
+
+    def begin_upstream(self):
+        """标记即将调用上游：此后到期视为上游迟迟不返回（计入熔断器与并发限制器）"""
+        self.upstream_started = True
+
+    def error(self) -> RunCancelled:
+        """根据取消原因构造对应的异常"""
+        if self.cancel_reason == CANCEL_DEADLINE:
+            return DeadlineExceeded(upstream=self.upstream_started)
+        return RunCancelled(self.cancel_reason or "cancelled")
+
+    def check(self):
+        """如果已到期或已取消，抛出对应异常"""
+        if self.cancel_reason is None and time.monotonic() >= self.expires_at:
+            self.cancel(CANCEL_DEADLINE)
+        if self.cancel_reason is not None:
+            raise self.error()
+
+    def timeout(self, default: float) -> float:
+        """
+        计算某个阶段可用的超时时间：不超过 default，也不超过剩余时间
+
+        Raises:
+            RunCancelled: 已到期或已取消
+        """
+        self.check()
+        return max(0.001, min(default, self.remaining()))
+
+    def cancel(self, reason: str):
+        """取消运行：中断所有已登记的上游连接，并传递给子时限"""
+        with self._lock:
+            if self.cancel_reason is not None:
+                return
+            self.cancel_reason = reason
+            streams = list(self._streams)
+            children = list(self._children)
+
+        logger.warning(f"运行已取消: {reason}")
+        for stream in streams:
+            close_stream(stream, abort=True)
+        for child in children:
+            child.cancel(reason)
+
+    def attach(self, stream: Any) -> Any:
+        """
+        登记一个上游流，取消时会被中断
+
+        Raises:
+            RunCancelled: 登记时运行已被取消（流会被立即关闭）
+        """
+        with self._lock:
+            if self.cancel_reason is None:
+                self._streams.append(stream)
+                return stream
+        close_stream(stream)
+        raise self.error()
+
+    def release(self, stream: Any):
+        """注销并关闭一个上游流，释放连接"""
+        with self._lock:
+            if stream in self._streams:
+                self._streams.remove(stream)
+        close_stream(stream)
+
+    def bind_client(self, environ: Dict[str, Any]):
+        """
+        绑定发起请求的客户端连接，客户端断开时自动取消运行
+
+        支持 gunicorn 与 werkzeug 开发服务器；取不到 socket 时（如 Serverless 环境）只按时限控制
+        """
+        self._client_socket = environ.get('gunicorn.socket') or environ.get('werkzeug.socket')
+
+    def client_gone(self) -> bool:
+        """检查绑定的客户端连接是否已经断开"""
+        sock = self._client_socket
+        if sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+            if not readable:
+                return False
+            # 可读但读不到数据，说明对端已关闭
+            return sock.recv(1, socket.MSG_PEEK) == b''
+        except (OSError, ValueError):
+            return True
+
+    def close(self):
+        """运行结束：释放所有上游连接并停止巡检"""
+        _monitor.discard(self)
+        with self._lock:
+            streams = self._streams
+            self._streams = []
+        for stream in streams:
+            close_stream(stream)
+        if self._parent is not None:
+            self._parent._remove_child(self)
+
+    def _add_child(self, child: 'RunDeadline'):
+        with self._lock:
+            self._children.append(child)
+            cancelled = self.cancel_reason
+        if cancelled is not None:
+            child.cancel(cancelled)
+
+    def _remove_child(self, child: 'RunDeadline'):
+        with self._lock:
+            if child in self._children:
+                self._children.remove(child)
+
+    def __enter__(self) -> 'RunDeadline':
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def iter_stream(stream: Any, deadline: RunDeadline) -> Iterator[Any]:
+    """
+    在时限控制下迭代 Coze 事件流，结束、提前退出或取消时都会释放连接
+
+    Args:
+        stream: cozepy 返回的 Stream 对象
+        deadline: 本次运行的时限
+
+    Raises:
+        RunCancelled: 运行被取消或时限耗尽
+    """
+    deadline.attach(stream)
+    try:
+        for event in stream:
+            deadline.check()
+            yield event
+        # 被 shutdown 的连接可能表现为正常结束，这里再确认一次
+        deadline.check()
+    except RunCancelled:
+        raise
+    except Exception:
+        if deadline.cancelled:
+            raise deadline.error() from None
+        raise
+    finally:
+        deadline.release(stream)
+
+
+class _RunMonitor:
+    """后台巡检线程：到期或客户端断开时取消运行，空闲时自动退出"""
+
+    def __init__(self, interval: float):
+        self._interval = interval
+        self._runs = set()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def add(self, run: RunDeadline):
+        with self._lock:
+            self._runs.add(run)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="run-monitor", daemon=True)
+                self._thread.start()
+
+    def discard(self, run: RunDeadline):
+        with self._lock:
+            self._runs.discard(run)
+
+    def __len__(self) -> int:
+        return len(self._runs)
+
+    def _loop(self):
+        while True:
+            time.sleep(self._interval)
+            with self._lock:
+                if not self._runs:
+                    self._thread = None
+                    return
+                runs = list(self._runs)
+
+            now = time.monotonic()
+            for run in runs:
+                try:
+                    if run.cancelled:
+                        pass
+                    elif now >= run.expires_at:
+                        run.cancel(CANCEL_DEADLINE)
+                    elif run.client_gone():
+                        run.cancel(CANCEL_CLIENT_GONE)
+                except Exception as e:
+                    logger.error(f"巡检运行时限时出错: {str(e)}")
+
+                # 已取消的运行不再需要巡检
+                if run.cancelled:
+                    self.discard(run)
+
+
+_monitor = _RunMonitor(config.RUN_MONITOR_INTERVAL)
+
+
+def active_runs() -> int:
+    """正在巡检（未结束且未取消）的运行数"""
+    return len(_monitor)
@@ -0,0 +1,283 @@
+"""
+文档版本缓存模块 - 文档未修改时复用上次的工作流结果
+
+- 通过飞书云文档元数据接口（/drive/v1/metas/batch_query）获取文档的最近修改时间作为版本
+- 工作流结果按（工作流 ID, 入参名, 智能体 ID, 文档类型, 文档 token, 版本）缓存：文档未修改时直接返回，
+  修改后一定重新运行；热更新切换工作流或入参后不会复用旧工作流的结果
+- 元数据查询会合并同一时间窗口内的并发请求为一次批量调用，由后台线程发出，各请求只等待自己的结果；
+  查询结果默认不缓存（DOC_META_CACHE_TTL 为 0），每次运行前都重新确认版本
+- 仍然存在的时间窗口：飞书更新文档最近修改时间有延迟，刚保存的修改可能还未反映到元数据中，
+  此时会返回上一版本的结果；DOC_META_CACHE_TTL 设为大于 0 时，窗口再增加这么多秒
+- 无法获取版本（非飞书文档、应用无权限、接口失败）时不使用缓存
+- revisions 供定期扫描（watchlist）一次查询大量文档
+"""
+
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import config
+from utils import logger, query_doc_metas
+from deadline import RunDeadline
+
+
+# 文档链接路径 -> 元数据接口的 doc_type
+_DOC_TYPES = {
+    "docx": "docx",
+    "docs": "doc",
+    "doc": "doc",
+    "sheets": "sheet",
+    "base": "bitable",
+    "wiki": "wiki",
+    "mindnotes": "mindnote",
+    "file": "file",
+}
+
+_DOC_URL_PATTERN = re.compile(r'https?://[^/\s]+/(' + '|'.join(_DOC_TYPES) + r')/([A-Za-z0-9\-_]+)')
+
+# 元数据接口单次最多查询的文档数
+_MAX_BATCH = 200
+
+DocRef = Tuple[str, str]
+
+# 结果缓存键：（工作流 ID, 入参名, 智能体 ID, 文档类型, 文档 token, 版本）
+CacheKey = Tuple[str, ...]
+
+
+def parse_doc_ref(doc_url: str) -> Optional[DocRef]:
+    """
+    从文档链接解析（文档类型, 文档 token）
+
+    Returns:
+        无法识别的链接返回 None
+    """
+    match = _DOC_URL_PATTERN.match(doc_url or "")
+    if not match:
+        return None
+    return _DOC_TYPES[match.group(1)], match.group(2)
+
+
+class _Lookup:
+    """一次等待中的元数据查询"""
+
+    def __init__(self):
+        self.revision: Optional[str] = None
+        self.done = threading.Event()
+
+
+class DocMetaResolver:
+    """批量、带短期缓存的文档版本查询（线程安全）"""
+
+    def __init__(self, ttl: float = None, batch_window: float = None):
+        """
+        Args:
+            ttl: 查询结果的缓存时长（秒）
+            batch_window: 合并并发查询的等待时间（秒）
+        """
+        self.ttl = ttl if ttl is not None else config.DOC_META_CACHE_TTL
+        self.batch_window = batch_window if batch_window is not None else config.DOC_META_BATCH_WINDOW
+        self._cache: Dict[DocRef, Tuple[float, Optional[str]]] = {}
+        self._pending: Dict[DocRef, _Lookup] = {}
+        self._flushing = False
+        self._lock = threading.Lock()
+
+        # 统计信息
+        self.batches = 0
+        self.lookups = 0
+
+    def revision(self, ref: DocRef, timeout: float = None) -> Optional[str]:
+        """
+        查询文档当前版本（最近修改时间）
+
+        Args:
+            ref: （文档类型, 文档 token）
+            timeout: 最多等待的秒数
+
+        Returns:
+            版本字符串，无法获取时返回 None
+        """
+        timeout = timeout if timeout is not None else config.DOC_META_TIMEOUT
+        with self._lock:
+            cached = self._cache.get(ref)
+            if cached is not None and cached[0] > time.monotonic():
+                return cached[1]
+            lookup = self._pending.get(ref)
+            if lookup is None:
+                lookup = self._pending[ref] = _Lookup()
+                self.lookups += 1
+            start = not self._flushing
+            if start:
+                self._flushing = True
+
+        # 第一个待查文档启动后台线程，短暂等待后批量查询所有待查文档；请求线程只等待自己的结果
+        if start:
+            threading.Thread(
+                target=self._flush_later, args=(timeout,), name="doc-meta-batch", daemon=True
+            ).start()
+
+        lookup.done.wait(timeout)
+        return lookup.revision
+
+    def revisions(self, refs: List[DocRef], timeout: float = None) -> Dict[DocRef, str]:
+        """
+        批量查询大量文档的当前版本（不使用短期缓存，查询结果会写入缓存）
+
+        每 200 个文档一次请求，供定期扫描使用
+
+        Returns:
+            {（文档类型, 文档 token）: 版本}，无法获取版本的文档不在结果中
+        """
+        timeout = timeout if timeout is not None else config.DOC_META_TIMEOUT
+        revisions = {}
+        for offset in range(0, len(refs), _MAX_BATCH):
+            chunk = refs[offset:offset + _MAX_BATCH]
+            found = self._query(chunk, timeout)
+            with self._lock:
+                for ref in chunk:
+                    self._remember(ref, found.get(ref))
+            revisions.update(found)
+        return revisions
+
+    def _remember(self, ref: DocRef, revision: Optional[str]):
+        # 调用方需持有锁；未开启缓存（ttl 为 0）时不保存
+        if self.ttl <= 0:
+            return
+        self._cache[ref] = (time.monotonic() + self.ttl, revision)
+        self._purge()
+
+    def _flush_later(self, timeout: float):
+        time.sleep(self.batch_window)
+        try:
+            self._flush(timeout)
+        except Exception as e:
+            logger.error(f"批量查询文档版本异常: {str(e)}")
+            with self._lock:
+                self._flushing = False
+
+    def _flush(self, timeout: float):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._flushing = False
+                    return
+                batch = dict(list(self._pending.items())[:_MAX_BATCH])
+                for ref in batch:
+                    del self._pending[ref]
+
+            revisions = self._query(list(batch), timeout)
+            with self._lock:
+                for ref, lookup in batch.items():
+                    lookup.revision = revisions.get(ref)
+                    self._remember(ref, lookup.revision)
+            for lookup in batch.values():
+                lookup.done.set()
+
+    def _query(self, refs: List[DocRef], timeout: float) -> Dict[DocRef, str]:
+        self.batches += 1
+        request_docs = [{"doc_token": token, "doc_type": doc_type} for doc_type, token in refs]
+        try:
+            with RunDeadline(timeout) as deadline:
+                metas = query_doc_metas(request_docs, deadline=deadline)
+        except Exception as e:
+            logger.error(f"查询文档版本异常: {str(e)}")
+            metas = None
+        if not metas:
+            return {}
+
+        revisions = {}
+        for doc_type, token in refs:
+            meta = metas.get(token)
+            if meta and meta.get('latest_modify_time'):
+                revisions[(doc_type, token)] = str(meta['latest_modify_time'])
+        return revisions
+
+    def _purge(self):
+        # 调用方需持有锁；清理过期的查询结果
+        if len(self._cache) < 1024:
+            return
+        now = time.monotonic()
+        self._cache = {ref: item for ref, item in self._cache.items() if item[0] > now}
+
+
+class ResultCache:
+    """按（文档, 版本）缓存的工作流结果（LRU，线程安全）"""
+
+    def __init__(self, max_entries: int = None, ttl: float = None):
+        self.max_entries = max_entries or config.DOC_RESULT_CACHE_SIZE
+        self.ttl = ttl or config.DOC_RESULT_CACHE_TTL
+        self._entries: 'OrderedDict[CacheKey, Tuple[float, Dict[str, Any]]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+        # 统计信息
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: CacheKey) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dict(entry[1])
+
+    def put(self, key: CacheKey, result: Dict[str, Any]):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, dict(result))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+def cache_key(doc_url: str, workflow_id: str = None) -> Optional[CacheKey]:
+    """
+    当前版本的缓存键（工作流 ID, 入参名, 智能体 ID, 文档类型, 文档 token, 版本）
+
+    Args:
+        doc_url: 文档链接
+        workflow_id: 工作流 ID（默认 COZE_WORKFLOW_ID）
+
+    Returns:
+        未开启缓存或无法获取版本时返回 None
+    """
+    if not config.DOC_CACHE_ENABLED:
+        return None
+    ref = parse_doc_ref(doc_url)
+    if ref is None:
+        return None
+    revision = doc_meta.revision(ref)
+    if revision is None:
+        return None
+    workflow = (workflow_id or config.COZE_WORKFLOW_ID, config.COZE_WORKFLOW_INPUT_PARAM, config.COZE_BOT_ID or "")
+    return workflow + ref + (revision,)
+
+
+def lookup(doc_url: str, workflow_id: str = None) -> Tuple[Optional[CacheKey], Optional[Dict[str, Any]]]:
+    """
+    查询文档当前版本的缓存结果
+
+    Args:
+        doc_url: 文档链接
+        workflow_id: 工作流 ID（默认 COZE_WORKFLOW_ID）
+
+    Returns:
+        (缓存键, 缓存的结果)；缓存键为 None 表示不可缓存，结果为 None 表示未命中
+    """
+    key = cache_key(doc_url, workflow_id)
+    if key is None:
+        return None, None
+    return key, result_cache.get(key)
+
+
+# 全局实例（api.py 使用）
+doc_meta = DocMetaResolver()
+result_cache = ResultCache()
@@ -1,7 +1,9 @@
 // API 配置
 const API_CONFIG = {
     // 后端 API 地址（已部署到 Vercel）
-    baseUrl: 'https://coze-workflow-assistant-jovc.vercel.app'
+    baseUrl: 'https://coze-workflow-assistant-jovc.vercel.app',
+    // 单次请求的等待上限（毫秒），超时后放弃请求，后端会同步取消本次运行
+    requestTimeoutMs: 300000
 };
 
 // DOM 元素
@@ -12,6 +14,9 @@ const btnText = submitBtn.querySelector('.btn-text');
 const btnLoader = submitBtn.querySelector('.btn-loader');
 const statusMessage = document.getElementById('statusMessage');
 
+// 未得到明确结果的提交（网络错误/超时），再次提交同一文档时复用其幂等键，后端不会重复执行
+let pendingSubmission = null;
+
 // 表单提交处理
 form.addEventListener('submit', async (e) => {
     e.preventDefault();
@@ -28,17 +33,33 @@ form.addEventListener('submit', async (e) => {
     setLoading(true);
     hideMessage();
     
+    if (!pendingSubmission || pendingSubmission.docUrl !== docUrl) {
+        pendingSubmission = { docUrl, key: generateIdempotencyKey() };
+    }
+    
+    // 超时后中断请求，断开的连接会让后端取消仍在执行的工作流
+    const controller = new AbortController();
+    const timer = setTimeout(() => controller.abort(), API_CONFIG.requestTimeoutMs);
+    
     try {
         const response = await fetch(`${API_CONFIG.baseUrl}/api/process`, {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
+                // 告知后端本次请求愿意等待的时间（秒）
+                'X-Request-Timeout': String(Math.floor(API_CONFIG.requestTimeoutMs / 1000)),
+                // 同一次提交的重试使用同一个幂等键
+                'Idempotency-Key': pendingSubmission.key,
             },
-            body: JSON.stringify({ doc_url: docUrl })
+            body: JSON.stringify({ doc_url: docUrl }),
+            signal: controller.signal
         });
         
         const data = await response.json();
         
+        // 已得到明确结果，下次提交使用新的幂等键
+        pendingSubmission = null;
+        
         if (response.ok && data.success) {
             showMessage('success', '✅ 工作流已触发！处理完成后将在飞书群内收到通知。');
             docUrlInput.value = ''; // 清空输入框
@@ -48,16 +69,27 @@ form.addEventListener('submit', async (e) => {
     } catch (error) {
         console.error('请求失败:', error);
         
-        if (error.message.includes('Failed to fetch')) {
+        if (error.name === 'AbortError') {
+            showMessage('error', '⏱️ 处理超时，请稍后重试。');
+        } else if (error.message.includes('Failed to fetch')) {
             showMessage('error', '⚠️ 无法连接到后端服务，请确保后端服务正在运行。');
         } else {
             showMessage('error', `请求失败: ${error.message}`);
         }
     } finally {
+        clearTimeout(timer);
         setLoading(false);
     }
 });
 
+// 生成幂等键
+function generateIdempotencyKey() {
+    if (window.crypto && window.crypto.randomUUID) {
+        return window.crypto.randomUUID();
+    }
+    return `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+}
+
 // 验证飞书文档链接
 function isValidFeishuUrl(url) {
     const pattern = /https:\/\/[a-zA-Z0-9\-]+\.(feishu|larkoffice)\.(cn|com)\/(docx|wiki|docs|sheets|base|file)\/[a-zA-Z0-9\-_]+/;
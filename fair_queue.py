@@ -0,0 +1,203 @@
+"""
+公平队列模块 - 按群聊公平地分配后台处理线程
+
+- 每个群聊一个先进先出队列，固定数量的 worker 线程按加权轮询（deficit round robin）依次从各群聊取任务：
+  每轮每个群聊最多处理 权重 条消息（CHAT_WEIGHTS，默认 1），刷屏的群聊不会占满所有线程
+- 单个群聊同时处理的消息数不超过 CHAT_MAX_CONCURRENCY，达到上限的群聊本轮跳过
+- 单个群聊排队的消息数超过 CHAT_MAX_QUEUED 时丢弃新消息，保证内存有界
+- 统计各群聊的排队数、处理中数、已处理数、丢弃数，以及排队延迟
+"""
+
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+import config
+from utils import logger
+
+
+class _ChatState:
+    """单个群聊的队列与统计"""
+
+    def __init__(self):
+        self.queue: Deque[Tuple[float, Callable[[], None]]] = deque()
+        self.deficit = 0.0
+        self.running = 0
+        self.processed = 0
+        self.dropped = 0
+        self.last_active = time.monotonic()
+
+
+class FairQueue:
+    """按键（群聊 ID）加权轮询的任务队列，带每键并发上限"""
+
+    def __init__(
+        self,
+        name: str,
+        workers: int = None,
+        max_concurrency: int = None,
+        max_queued: int = None,
+        weights: Dict[str, float] = None
+    ):
+        """
+        Args:
+            name: 队列名称（用于线程名和日志）
+            workers: worker 线程数
+            max_concurrency: 每个键同时处理的任务数上限
+            max_queued: 每个键最多排队的任务数
+            weights: 各键的权重（每轮可处理的任务数），未列出的键为 1
+        """
+        self.name = name
+        self.workers = workers or config.CHAT_WORKER_THREADS
+        # 未指定时每次使用时读取配置，支持热更新
+        self._max_concurrency = max_concurrency
+        self._max_queued = max_queued
+        self._weights = weights
+        self._cond = threading.Condition()
+        self._chats: Dict[str, _ChatState] = {}
+        # 有排队任务的键，按轮询顺序排列
+        self._active: Deque[str] = deque()
+        self._threads: List[threading.Thread] = []
+        self._waits_ms: Deque[float] = deque(maxlen=512)
+
+    @property
+    def max_concurrency(self) -> int:
+        return self._max_concurrency or config.CHAT_MAX_CONCURRENCY
+
+    @property
+    def max_queued(self) -> int:
+        return self._max_queued or config.CHAT_MAX_QUEUED
+
+    def weight(self, key: str) -> float:
+        weights = self._weights if self._weights is not None else config.CHAT_WEIGHTS
+        return weights.get(key, 1)
+
+    def submit(self, key: str, task: Callable[[], None]) -> bool:
+        """
+        提交任务
+
+        Args:
+            key: 公平分配的键（群聊 ID）
+            task: 无参数的任务函数
+
+        Returns:
+            该键排队已满、任务被丢弃时返回 False
+        """
+        with self._cond:
+            chat = self._chats.get(key)
+            if chat is None:
+                chat = self._chats[key] = _ChatState()
+            chat.last_active = time.monotonic()
+            if len(chat.queue) >= self.max_queued:
+                chat.dropped += 1
+                return False
+            if not chat.queue:
+                self._active.append(key)
+            chat.queue.append((time.monotonic(), task))
+            self._ensure_workers()
+            self._cond.notify()
+        return True
+
+    def _ensure_workers(self):
+        # 调用方需持有锁；首次提交时启动 worker
+        if self._threads:
+            return
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._worker_loop, name=f"{self.name}-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _next(self) -> Optional[Tuple[str, float, Callable[[], None]]]:
+        # 调用方需持有锁；按加权轮询选出下一个任务，所有键都达到并发上限时返回 None
+        max_concurrency = self.max_concurrency
+        for _ in range(len(self._active)):
+            key = self._active[0]
+            chat = self._chats[key]
+            if chat.running >= max_concurrency:
+                self._active.rotate(-1)
+                continue
+            if chat.deficit < 1:
+                chat.deficit += self.weight(key)
+            if chat.deficit < 1:
+                # 权重小于 1 的键需要积累几轮才能处理一条
+                self._active.rotate(-1)
+                continue
+
+            chat.deficit -= 1
+            enqueued_at, task = chat.queue.popleft()
+            chat.running += 1
+            if not chat.queue:
+                self._active.popleft()
+                chat.deficit = 0.0
+            elif chat.deficit < 1:
+                # 本轮额度用完，排到队尾
+                self._active.rotate(-1)
+            return key, enqueued_at, task
+        return None
+
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                picked = self._next()
+                while picked is None:
+                    self._cond.wait()
+                    picked = self._next()
+                key, enqueued_at, task = picked
+                self._waits_ms.append((time.monotonic() - enqueued_at) * 1000)
+
+            try:
+                task()
+            except Exception as e:
+                logger.error(f"处理任务出错（{self.name}/{key}）: {str(e)}")
+
+            with self._cond:
+                chat = self._chats[key]
+                chat.running -= 1
+                chat.processed += 1
+                self._purge()
+                # 该键可能从并发上限中释放，唤醒所有 worker 重新选择
+                self._cond.notify_all()
+
+    def _purge(self):
+        # 调用方需持有锁；清理长时间空闲的键，保证统计信息有界
+        if len(self._chats) < 1024:
+            return
+        cutoff = time.monotonic() - 3600
+        self._chats = {
+            key: chat for key, chat in self._chats.items()
+            if chat.queue or chat.running or chat.last_active > cutoff
+        }
+
+    def snapshot(self, top: int = 10) -> Dict[str, Any]:
+        """
+        队列状态，用于健康检查
+
+        Args:
+            top: 按排队数列出的群聊数量
+        """
+        with self._cond:
+            chats = {
+                key: {
+                    "queued": len(chat.queue),
+                    "running": chat.running,
+                    "processed": chat.processed,
+                    "dropped": chat.dropped
+                }
+                for key, chat in self._chats.items()
+            }
+            waits = sorted(self._waits_ms)
+        busiest = sorted(chats.items(), key=lambda item: (item[1]["queued"], item[1]["running"]), reverse=True)
+        return {
+            "workers": len(self._threads),
+            "queued": sum(chat["queued"] for chat in chats.values()),
+            "running": sum(chat["running"] for chat in chats.values()),
+            "chats": len(chats),
+            "wait_p50_ms": int(waits[len(waits) // 2]) if waits else None,
+            "wait_p95_ms": int(waits[int(len(waits) * 0.95)]) if waits else None,
+            "busiest": dict(busiest[:top])
+        }
+
+
+# 全局群聊消息队列（AIcase.py 使用）
+chat_queue = FairQueue("chat-worker")
@@ -0,0 +1,501 @@
+"""
+飞书长连接模块 - 通过 WebSocket 长连接接收飞书事件，无需公网回调地址
+
+协议与飞书官方 SDK 一致：
+1. POST {FEISHU_WS_DOMAIN}/callback/ws/endpoint 获取连接地址和客户端配置（心跳间隔等）
+2. 建立 WebSocket 连接，收发 protobuf 编码的帧（pbbp2.Frame）：
+   - 控制帧（method=0）：ping / pong 心跳
+   - 数据帧（method=1）：事件，payload 为与 HTTP 回调相同的 JSON；较大的事件会拆成多帧（sum / seq）
+3. 每个事件处理后回复同一帧，payload 为 {"code": 200}，否则飞书会重推
+
+连接断开或心跳超时后按指数退避自动重连。事件交给与 /webhook 相同的处理函数，沿用同一份去重记录。
+
+本地联调可使用 StandinServer 模拟飞书服务端：
+    python feishu_ws.py --port 9100
+    # 然后将 config.FEISHU_WS_DOMAIN 设为 http://127.0.0.1:9100，在终端输入事件 JSON（每行一个）推送
+"""
+
+import json
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+import config
+from utils import logger
+
+
+# 帧类型（Frame.method）
+FRAME_CONTROL = 0
+FRAME_DATA = 1
+
+# 帧头部 type 取值
+TYPE_PING = "ping"
+TYPE_PONG = "pong"
+TYPE_EVENT = "event"
+
+# 服务端未下发配置时的默认心跳间隔（秒）
+_DEFAULT_PING_INTERVAL = 120
+
+# 多帧事件的拼装超时（秒）
+_CHUNK_TTL = 10
+
+
+class FeishuWSError(Exception):
+    """获取长连接地址失败"""
+
+
+# ===== protobuf 编解码（仅覆盖 pbbp2.Frame 用到的字段类型）=====
+
+def _encode_varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _decode_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _field_varint(number: int, value: int) -> bytes:
+    return _encode_varint(number << 3) + _encode_varint(value)
+
+
+def _field_bytes(number: int, value: bytes) -> bytes:
+    return _encode_varint((number << 3) | 2) + _encode_varint(len(value)) + value
+
+
+def _parse_fields(data: bytes) -> Dict[int, List[Any]]:
+    fields: Dict[int, List[Any]] = {}
+    pos = 0
+    while pos < len(data):
+        key, pos = _decode_varint(data, pos)
+        number, wire_type = key >> 3, key & 0x07
+        if wire_type == 0:
+            value, pos = _decode_varint(data, pos)
+        elif wire_type == 2:
+            length, pos = _decode_varint(data, pos)
+            value = data[pos:pos + length]
+            pos += length
+        elif wire_type == 1:
+            value = data[pos:pos + 8]
+            pos += 8
+        elif wire_type == 5:
+            value = data[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError(f"不支持的 protobuf 字段类型: {wire_type}")
+        fields.setdefault(number, []).append(value)
+    return fields
+
+
+class Frame:
+    """长连接帧（pbbp2.Frame）"""
+
+    def __init__(
+        self,
+        method: int,
+        service: int = 0,
+        headers: Dict[str, str] = None,
+        payload: bytes = b"",
+        seq_id: int = 0,
+        log_id: int = 0
+    ):
+        self.method = method
+        self.service = service
+        self.headers = dict(headers or {})
+        self.payload = payload
+        self.seq_id = seq_id
+        self.log_id = log_id
+
+    def encode(self) -> bytes:
+        parts = [
+            _field_varint(1, self.seq_id),
+            _field_varint(2, self.log_id),
+            _field_varint(3, self.service),
+            _field_varint(4, self.method),
+        ]
+        for key, value in self.headers.items():
+            header = _field_bytes(1, key.encode('utf-8')) + _field_bytes(2, str(value).encode('utf-8'))
+            parts.append(_field_bytes(5, header))
+        if self.payload:
+            parts.append(_field_bytes(8, self.payload))
+        return b"".join(parts)
+
+    @classmethod
+    def decode(cls, data: bytes) -> 'Frame':
+        fields = _parse_fields(data)
+        headers = {}
+        for raw in fields.get(5, []):
+            header = _parse_fields(raw)
+            key = header.get(1, [b""])[0].decode('utf-8')
+            headers[key] = header.get(2, [b""])[0].decode('utf-8')
+        return cls(
+            method=fields.get(4, [0])[0],
+            service=fields.get(3, [0])[0],
+            headers=headers,
+            payload=fields.get(8, [b""])[0],
+            seq_id=fields.get(1, [0])[0],
+            log_id=fields.get(2, [0])[0]
+        )
+
+
+# ===== 客户端 =====
+
+class FeishuLongConnection:
+    """飞书事件长连接客户端（后台线程运行，断线自动重连）"""
+
+    def __init__(
+        self,
+        handler: Callable[[Dict[str, Any]], None],
+        app_id: str = None,
+        app_secret: str = None,
+        domain: str = None
+    ):
+        """
+        Args:
+            handler: 事件处理函数，参数为与 HTTP 回调相同结构的事件 JSON；应尽快返回（耗时处理放到后台线程）
+            app_id: 飞书应用 App ID
+            app_secret: 飞书应用 App Secret
+            domain: 长连接服务地址
+        """
+        self._handler = handler
+        self._app_id = app_id or config.FEISHU_APP_ID
+        self._app_secret = app_secret or config.FEISHU_APP_SECRET
+        self._domain = (domain or config.FEISHU_WS_DOMAIN).rstrip('/')
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._ws = None
+        self._ping_interval = _DEFAULT_PING_INTERVAL
+        self._chunks: Dict[str, Tuple[float, List[Optional[bytes]]]] = {}
+
+        # 统计信息
+        self.connected = False
+        self.connects = 0
+        self.events = 0
+
+    def start(self):
+        """在后台线程中建立连接并持续接收事件"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="feishu-ws", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """断开连接并停止重连"""
+        self._stop.set()
+        ws = self._ws
+        if ws is not None:
+            ws.close()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self):
+        backoff = config.FEISHU_WS_RECONNECT_MIN
+        while not self._stop.is_set():
+            started = time.monotonic()
+            try:
+                self._connect_once()
+            except Exception as e:
+                if self._stop.is_set():
+                    return
+                logger.warning(f"飞书长连接中断: {str(e)}")
+            finally:
+                self.connected = False
+                self._ws = None
+
+            if self._stop.is_set():
+                return
+
+            # 连接维持较久后断开，从最小间隔重新开始退避
+            if time.monotonic() - started > config.FEISHU_WS_RECONNECT_MAX:
+                backoff = config.FEISHU_WS_RECONNECT_MIN
+            delay = random.uniform(backoff / 2, backoff)
+            logger.info(f"飞书长连接已断开，{delay:.1f} 秒后重连")
+            self._stop.wait(delay)
+            backoff = min(backoff * 2, config.FEISHU_WS_RECONNECT_MAX)
+
+    def _endpoint(self) -> Tuple[str, int]:
+        response = requests.post(
+            f"{self._domain}/callback/ws/endpoint",
+            json={"AppID": self._app_id, "AppSecret": self._app_secret},
+            headers={"locale": "zh"},
+            timeout=config.HTTP_REQUEST_TIMEOUT
+        )
+        response.raise_for_status()
+        result = response.json()
+        if result.get('code') != 0:
+            raise FeishuWSError(f"获取长连接地址失败: {result.get('msg')}（code={result.get('code')}）")
+
+        data = result.get('data') or {}
+        self._apply_client_config(data.get('ClientConfig'))
+        url = data.get('URL')
+        if not url:
+            raise FeishuWSError("获取长连接地址失败: 响应中没有 URL")
+        service_id = int(parse_qs(urlparse(url).query).get('service_id', ['0'])[0])
+        return url, service_id
+
+    def _apply_client_config(self, client_config: Optional[Dict[str, Any]]):
+        if client_config and client_config.get('PingInterval'):
+            self._ping_interval = client_config['PingInterval']
+
+    def _connect_once(self):
+        from websockets.sync.client import connect
+
+        url, service_id = self._endpoint()
+        with connect(url, open_timeout=config.HTTP_REQUEST_TIMEOUT, max_size=None) as ws:
+            self._ws = ws
+            self.connected = True
+            self.connects += 1
+            logger.info("飞书长连接已建立")
+
+            # 心跳：按间隔发送 ping；连续两个间隔没有收到任何帧视为连接失效
+            next_ping = time.monotonic()
+            last_received = time.monotonic()
+            while not self._stop.is_set():
+                now = time.monotonic()
+                if now >= next_ping:
+                    ws.send(Frame(FRAME_CONTROL, service_id, {"type": TYPE_PING}).encode())
+                    next_ping = now + self._ping_interval
+                if now - last_received > self._ping_interval * 2:
+                    raise FeishuWSError("心跳超时")
+
+                try:
+                    message = ws.recv(timeout=max(0.0, next_ping - now))
+                except TimeoutError:
+                    continue
+                last_received = time.monotonic()
+
+                if isinstance(message, str):
+                    message = message.encode('utf-8')
+                self._on_frame(ws, Frame.decode(message))
+
+    def _on_frame(self, ws, frame: Frame):
+        frame_type = frame.headers.get('type')
+
+        if frame.method == FRAME_CONTROL:
+            if frame_type == TYPE_PONG and frame.payload:
+                try:
+                    self._apply_client_config(json.loads(frame.payload))
+                except ValueError:
+                    pass
+            return
+
+        if frame_type != TYPE_EVENT:
+            # 卡片回调等其他类型的数据帧：直接确认
+            self._ack(ws, frame, 200, 0)
+            return
+
+        payload = self._assemble(frame)
+        if payload is None:
+            return
+
+        started = time.monotonic()
+        code = 200
+        try:
+            self._handler(json.loads(payload))
+            self.events += 1
+        except Exception as e:
+            logger.error(f"处理长连接事件失败: {str(e)}")
+            code = 500
+        self._ack(ws, frame, code, int((time.monotonic() - started) * 1000))
+
+    def _assemble(self, frame: Frame) -> Optional[bytes]:
+        # 拼装拆分为多帧的事件，未收齐时返回 None
+        total = int(frame.headers.get('sum', 1))
+        if total <= 1:
+            return frame.payload
+
+        now = time.monotonic()
+        for key in [k for k, (at, _) in self._chunks.items() if now - at > _CHUNK_TTL]:
+            del self._chunks[key]
+
+        message_id = frame.headers.get('message_id', '')
+        _, parts = self._chunks.setdefault(message_id, (now, [None] * total))
+        parts[int(frame.headers.get('seq', 0))] = frame.payload
+        if any(part is None for part in parts):
+            return None
+        del self._chunks[message_id]
+        return b"".join(parts)
+
+    def _ack(self, ws, frame: Frame, code: int, biz_rt: int):
+        headers = dict(frame.headers)
+        headers['biz_rt'] = str(biz_rt)
+        ack = Frame(
+            frame.method, frame.service, headers,
+            json.dumps({"code": code}).encode('utf-8'),
+            frame.seq_id, frame.log_id
+        )
+        ws.send(ack.encode())
+
+    def snapshot(self) -> Dict[str, Any]:
+        """连接状态，用于健康检查"""
+        return {"connected": self.connected, "connects": self.connects, "events": self.events}
+
+
+# ===== 本地模拟服务端 =====
+
+class StandinServer:
+    """
+    模拟飞书长连接服务端，用于本地联调和压测
+
+    - POST /callback/ws/endpoint 返回本地 WebSocket 地址
+    - push_event 向所有连接推送事件（可按 chunk_size 拆成多帧），并记录客户端的确认
+    - drop_connections 主动断开连接，用于验证自动重连
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 9100, ping_interval: int = _DEFAULT_PING_INTERVAL):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        from websockets.sync.server import serve
+
+        self.host = host
+        self.ping_interval = ping_interval
+        self.acks: List[Dict[str, Any]] = []
+        self._connections = set()
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._acked = threading.Condition(self._lock)
+
+        self._ws_server = serve(self._handle_ws, host, 0)
+        ws_port = self._ws_server.socket.getsockname()[1]
+        standin = self
+
+        class EndpointHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                body = json.dumps({"code": 0, "msg": "ok", "data": {
+                    "URL": f"ws://{host}:{ws_port}/ws?device_id=standin&service_id=1",
+                    "ClientConfig": {"PingInterval": standin.ping_interval}
+                }}).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._http_server = ThreadingHTTPServer((host, port), EndpointHandler)
+        self.port = self._http_server.server_address[1]
+        self.domain = f"http://{host}:{self.port}"
+
+    def start(self) -> 'StandinServer':
+        threading.Thread(target=self._http_server.serve_forever, daemon=True).start()
+        threading.Thread(target=self._ws_server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._http_server.shutdown()
+        self._ws_server.shutdown()
+
+    def _handle_ws(self, ws):
+        with self._lock:
+            self._connections.add(ws)
+        try:
+            for message in ws:
+                frame = Frame.decode(message)
+                if frame.method == FRAME_CONTROL and frame.headers.get('type') == TYPE_PING:
+                    pong = Frame(FRAME_CONTROL, frame.service, {"type": TYPE_PONG},
+                                 json.dumps({"PingInterval": self.ping_interval}).encode('utf-8'))
+                    ws.send(pong.encode())
+                elif frame.method == FRAME_DATA:
+                    with self._lock:
+                        self.acks.append({
+                            "message_id": frame.headers.get('message_id'),
+                            "code": json.loads(frame.payload).get('code'),
+                            "biz_rt": frame.headers.get('biz_rt')
+                        })
+                        self._acked.notify_all()
+        except Exception:
+            pass
+        finally:
+            with self._lock:
+                self._connections.discard(ws)
+
+    @property
+    def connections(self) -> int:
+        with self._lock:
+            return len(self._connections)
+
+    def push_event(self, event: Dict[str, Any], chunk_size: int = 0) -> int:
+        """
+        向所有连接推送一个事件
+
+        Returns:
+            推送到的连接数
+        """
+        payload = json.dumps(event, ensure_ascii=False).encode('utf-8')
+        chunks = [payload[i:i + chunk_size] for i in range(0, len(payload), chunk_size)] if chunk_size else [payload]
+        with self._lock:
+            self._seq += 1
+            message_id = f"standin_{self._seq}"
+            connections = list(self._connections)
+        for ws in connections:
+            for index, chunk in enumerate(chunks):
+                ws.send(Frame(FRAME_DATA, 1, {
+                    "type": TYPE_EVENT,
+                    "message_id": message_id,
+                    "sum": str(len(chunks)),
+                    "seq": str(index)
+                }, chunk, seq_id=self._seq).encode())
+        return len(connections)
+
+    def wait_acks(self, count: int, timeout: float = 5) -> bool:
+        """等待收到 count 个事件确认"""
+        with self._lock:
+            return self._acked.wait_for(lambda: len(self.acks) >= count, timeout)
+
+    def drop_connections(self):
+        """断开所有连接（模拟网络中断）"""
+        with self._lock:
+            connections = list(self._connections)
+        for ws in connections:
+            ws.close()
+
+
+def main():
+    """
+    启动本地模拟服务端，从标准输入读取事件 JSON（每行一个）推送给已连接的客户端
+    """
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="飞书长连接本地模拟服务端")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    args = parser.parse_args()
+
+    server = StandinServer(args.host, args.port).start()
+    print(f"模拟服务端已启动: {server.domain}（将 FEISHU_WS_DOMAIN 设为该地址），输入事件 JSON 推送")
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            sent = server.push_event(json.loads(line))
+            print(f"已推送到 {sent} 个连接")
+        except ValueError as e:
+            print(f"JSON 格式错误: {e}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+"""
+对冲启动模块 - 降低工作流首个事件的尾延迟
+
+- 发起流式调用后，若超过对冲延迟仍未收到任何事件，再发起一次相同的调用
+- 两次调用中先产出事件（或先结束）的一方胜出，另一方的连接立即中断并释放
+- 对冲延迟取近期首个事件延迟的分位数（HEDGE_PERCENTILE），样本不足时不对冲
+- 对冲次数受预算限制：每次运行积累 HEDGE_BUDGET_RATIO 个额度，每次对冲消耗 1 个，
+  额外的上游调用不超过运行数的该比例（允许短时突发 HEDGE_BUDGET_BURST 次）
+- 统计对冲次数、对冲胜出次数、预算不足次数，供健康检查查看
+"""
+
+import queue
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Iterator, Optional
+
+import config
+from utils import logger
+from deadline import RunDeadline, RunCancelled, close_stream, iter_stream
+
+
+# 等待首个事件时检查运行是否已取消的间隔（秒）
+_POLL_INTERVAL = 0.5
+
+# 流在产出任何事件前就已结束
+_END = object()
+
+
+class _Attempt:
+    """一次流式调用尝试：在后台线程中发起调用并读取首个事件"""
+
+    def __init__(self, index: int, start: Callable[[], Any], deadline: RunDeadline, results: queue.Queue):
+        self.index = index
+        self.started = time.monotonic()
+        self.stream = None
+        self.iterator = None
+        self._start = start
+        self._deadline = deadline
+        self._results = results
+        self._lock = threading.Lock()
+        self._done = False
+        self._lost = False
+
+        threading.Thread(target=self._run, name=f"hedge-attempt-{index}", daemon=True).start()
+
+    def _run(self):
+        first, error = _END, None
+        try:
+            stream = self._start()
+            self._deadline.attach(stream)
+            with self._lock:
+                self.stream = stream
+                lost = self._lost
+            # 发起调用期间已被放弃：不再等待首个事件
+            if not lost:
+                self.iterator = iter(stream)
+                first = next(self.iterator, _END)
+        except Exception as e:
+            error = e
+
+        with self._lock:
+            self._done = True
+            lost = self._lost
+        if lost:
+            self._discard()
+        else:
+            self._results.put((self, first, error))
+
+    def abandon(self):
+        """放弃本次尝试：中断正在进行的读取，读取线程结束后释放连接"""
+        with self._lock:
+            self._lost = True
+            done = self._done
+            stream = self.stream
+        if done:
+            self._discard()
+        elif stream is not None:
+            close_stream(stream, abort=True)
+
+    def _discard(self):
+        if self.stream is not None:
+            # 录制中的调用标记为作废，回放时只使用胜出的一方（见 stream_recorder）
+            mark_discarded = getattr(self.stream, 'mark_discarded', None)
+            if mark_discarded is not None:
+                mark_discarded()
+            self._deadline.release(self.stream)
+
+
+class HedgePolicy:
+    """对冲延迟、对冲预算与统计（线程安全）"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._samples = deque(maxlen=config.HEDGE_SAMPLE_WINDOW)
+        self._tokens = float(config.HEDGE_BUDGET_BURST)
+        self._lock = threading.Lock()
+
+        # 统计信息
+        self.runs = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.budget_denied = 0
+
+    def delay(self) -> Optional[float]:
+        """
+        当前的对冲延迟（秒）
+
+        Returns:
+            未开启对冲或样本不足时返回 None
+        """
+        if not config.HEDGE_ENABLED:
+            return None
+        with self._lock:
+            if len(self._samples) < config.HEDGE_MIN_SAMPLES:
+                return None
+            samples = sorted(self._samples)
+        value = samples[min(int(len(samples) * config.HEDGE_PERCENTILE / 100), len(samples) - 1)]
+        return max(value, config.HEDGE_MIN_DELAY)
+
+    def on_run(self):
+        """登记一次运行并积累对冲额度"""
+        with self._lock:
+            self.runs += 1
+            self._tokens = min(self._tokens + config.HEDGE_BUDGET_RATIO, config.HEDGE_BUDGET_BURST)
+
+    def try_hedge(self) -> bool:
+        """消耗一个对冲额度，额度不足返回 False"""
+        with self._lock:
+            if self._tokens < 1:
+                self.budget_denied += 1
+                return False
+            self._tokens -= 1
+            self.hedged += 1
+            return True
+
+    def on_first_event(self, latency: float, hedge_won: bool):
+        """
+        记录胜出调用的首个事件延迟
+
+        Args:
+            latency: 从该次调用发起到收到首个事件的时间（秒）
+            hedge_won: 是否为对冲调用胜出
+        """
+        with self._lock:
+            self._samples.append(latency)
+            if hedge_won:
+                self.hedge_wins += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        delay = self.delay()
+        with self._lock:
+            return {
+                "enabled": config.HEDGE_ENABLED,
+                "delay_ms": int(delay * 1000) if delay is not None else None,
+                "samples": len(self._samples),
+                "runs": self.runs,
+                "hedged": self.hedged,
+                "hedge_wins": self.hedge_wins,
+                "budget_denied": self.budget_denied
+            }
+
+
+def hedged_stream(start: Callable[[], Any], deadline: RunDeadline, policy: 'HedgePolicy' = None) -> Iterator[Any]:
+    """
+    在时限控制下迭代 Coze 事件流，首个事件迟迟不到时发起对冲调用
+
+    未开启对冲（或样本不足）时等同于 iter_stream(start(), deadline)。
+
+    Args:
+        start: 发起流式调用的函数（如 lambda: client.workflows.runs.stream(**params)），可能被调用两次
+        deadline: 本次运行的时限
+        policy: 对冲策略，默认使用全局的 workflow_hedging
+
+    Raises:
+        RunCancelled: 运行被取消或时限耗尽
+    """
+    policy = policy or workflow_hedging
+    policy.on_run()
+    delay = policy.delay()
+    if delay is None:
+        started = time.monotonic()
+        first = True
+        for event in iter_stream(start(), deadline):
+            if first:
+                policy.on_first_event(time.monotonic() - started, hedge_won=False)
+                first = False
+            yield event
+        return
+
+    winner, first = _race(start, deadline, policy, delay)
+    try:
+        if first is _END:
+            deadline.check()
+            return
+        yield first
+        for event in winner.iterator:
+            deadline.check()
+            yield event
+        # 被 shutdown 的连接可能表现为正常结束，这里再确认一次
+        deadline.check()
+    except RunCancelled:
+        raise
+    except Exception:
+        if deadline.cancelled:
+            raise deadline.error() from None
+        raise
+    finally:
+        deadline.release(winner.stream)
+
+
+def _race(start: Callable[[], Any], deadline: RunDeadline, policy: HedgePolicy, delay: float):
+    """
+    发起调用并在需要时对冲，返回先产出首个事件的尝试及该事件
+
+    Raises:
+        所有尝试都失败时抛出第一个尝试的异常
+    """
+    results: queue.Queue = queue.Queue()
+    attempts = [_Attempt(0, start, deadline, results)]
+    hedge_at = attempts[0].started + delay
+    errors = []
+
+    try:
+        while True:
+            deadline.check()
+            wait = min(_POLL_INTERVAL, deadline.remaining())
+            if len(attempts) == 1:
+                wait = min(wait, max(0.0, hedge_at - time.monotonic()))
+            try:
+                attempt, first, error = results.get(timeout=wait)
+            except queue.Empty:
+                if len(attempts) == 1 and time.monotonic() >= hedge_at:
+                    if policy.try_hedge():
+                        logger.info(f"{delay * 1000:.0f}ms 内未收到工作流事件，发起对冲调用")
+                        attempts.append(_Attempt(1, start, deadline, results))
+                    else:
+                        # 预算不足，不再对冲
+                        hedge_at = float('inf')
+                continue
+
+            if error is None:
+                policy.on_first_event(time.monotonic() - attempt.started, hedge_won=attempt.index > 0)
+                if len(attempts) > 1:
+                    logger.info("对冲调用胜出" if attempt.index > 0 else "原调用胜出，放弃对冲调用")
+                for other in attempts:
+                    if other is not attempt:
+                        other.abandon()
+                return attempt, first
+
+            # 某次尝试失败：还有其他尝试在进行时继续等待
+            errors.append(error)
+            if len(errors) == len(attempts):
+                raise errors[0]
+    except BaseException:
+        for attempt in attempts:
+            attempt.abandon()
+        raise
+
+
+# 全局工作流对冲策略（api.py 与 AIcase.py 共用）
+workflow_hedging = HedgePolicy("coze_workflow")
@@ -0,0 +1,161 @@
+"""
+幂等键模块 - 同一 Idempotency-Key 的重复请求只执行一次
+
+- 首个请求执行处理，结果在时间窗口内保存
+- 窗口内的重放直接返回保存的结果；原请求仍在执行时，重放会等待并共享其结果
+- 原请求没有产生可复用的结果（如客户端断开、上游熔断）时，等待者重新竞争执行
+- 存储按 LRU 淘汰已完成的条目，条目数有上限；执行中的条目不会被淘汰（否则重试会再次执行），
+  所有条目都在执行中时拒绝新的幂等键
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Optional, Tuple
+
+import config
+from utils import logger
+
+
+# 幂等键最大长度
+MAX_KEY_LENGTH = 255
+
+
+class IdempotencyConflict(Exception):
+    """同一个幂等键被用于内容不同的请求"""
+
+
+class IdempotencyInProgress(Exception):
+    """原请求仍在执行，等待超时"""
+
+
+class IdempotencyStoreFull(Exception):
+    """存储已满且所有条目都在执行中，无法登记新的幂等键"""
+
+
+class _Entry:
+    """一个幂等键对应的执行状态"""
+
+    def __init__(self, fingerprint: str):
+        self.fingerprint = fingerprint
+        self.outcome: Any = None
+        self.expires_at: Optional[float] = None  # 完成前为 None（执行中）
+        self.finished = threading.Event()
+
+
+class IdempotencyStore:
+    """有界的幂等结果存储（线程安全）"""
+
+    def __init__(self, max_keys: int = None, window: float = None):
+        """
+        Args:
+            max_keys: 最多保存的幂等键数量
+            window: 结果保存时长（秒）
+        """
+        self.max_keys = max_keys or config.IDEMPOTENCY_MAX_KEYS
+        self.window = window or config.IDEMPOTENCY_WINDOW
+        self._entries: 'OrderedDict[str, _Entry]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def execute(
+        self,
+        key: str,
+        fingerprint: str,
+        func: Callable[[], Any],
+        wait_timeout: float,
+        cacheable: Callable[[Any], bool] = lambda outcome: True
+    ) -> Tuple[Any, bool]:
+        """
+        以幂等方式执行 func
+
+        Args:
+            key: 幂等键
+            fingerprint: 请求内容指纹，同一个键必须对应同样的内容
+            func: 实际的处理函数
+            wait_timeout: 原请求仍在执行时，最多等待的秒数
+            cacheable: 判断结果是否可以保存复用
+
+        Returns:
+            (结果, 是否为重放)
+
+        Raises:
+            IdempotencyConflict: 键已被用于不同内容的请求
+            IdempotencyInProgress: 原请求仍在执行且等待超时
+            IdempotencyStoreFull: 存储已满且所有条目都在执行中
+        """
+        while True:
+            entry, owner = self._claim(key, fingerprint)
+
+            if owner:
+                return self._run(key, entry, func, cacheable), False
+
+            if entry.fingerprint != fingerprint:
+                raise IdempotencyConflict(key)
+
+            if not entry.finished.wait(wait_timeout):
+                raise IdempotencyInProgress(key)
+
+            if entry.outcome is not None:
+                logger.info(f"幂等键命中，返回已保存的结果: {key}")
+                return entry.outcome, True
+
+            # 原请求没有产生可复用的结果，重新竞争执行
+            logger.info(f"幂等键对应的原请求未完成，重新执行: {key}")
+
+    def _claim(self, key: str, fingerprint: str) -> Tuple[_Entry, bool]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at is not None and time.monotonic() >= entry.expires_at:
+                del self._entries[key]
+                entry = None
+
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry, False
+
+            if not self._evict():
+                raise IdempotencyStoreFull(key)
+            entry = _Entry(fingerprint)
+            self._entries[key] = entry
+            return entry, True
+
+    def _run(self, key: str, entry: _Entry, func: Callable[[], Any], cacheable: Callable[[Any], bool]) -> Any:
+        try:
+            outcome = func()
+        except BaseException:
+            self._discard(key, entry)
+            raise
+
+        if cacheable(outcome):
+            with self._lock:
+                entry.outcome = outcome
+                entry.expires_at = time.monotonic() + self.window
+            entry.finished.set()
+        else:
+            self._discard(key, entry)
+        return outcome
+
+    def _discard(self, key: str, entry: _Entry):
+        with self._lock:
+            if self._entries.get(key) is entry:
+                del self._entries[key]
+        entry.finished.set()
+
+    def _evict(self) -> bool:
+        # 调用方需持有锁；为新条目腾出位置，从最久未使用的一端起只淘汰已完成的条目，
+        # 腾不出位置（其余都在执行中）时返回 False
+        if len(self._entries) < self.max_keys:
+            return True
+        for key in list(self._entries):
+            if self._entries[key].expires_at is not None:
+                del self._entries[key]
+                if len(self._entries) < self.max_keys:
+                    return True
+        return False
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# 全局幂等存储（/api/process 使用）
+idempotency_store = IdempotencyStore()
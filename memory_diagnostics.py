@@ -0,0 +1,255 @@
+"""
+内存诊断模块 - 在不重启进程的情况下定位长期运行时的内存增长
+
+管理接口（仅在配置了 config.DIAGNOSTICS_TOKEN 时注册，请求需携带 X-Admin-Token 请求头）：
+- GET  /admin/memory                 进程内存、线程数、内部结构大小；tracemalloc 开启时附带分配最多的位置
+                                     参数 top（条数）、group（lineno / filename / traceback）、diff（与指定快照对比）、
+                                     objects=1（统计 gc 跟踪的对象数，对象多时较慢）
+- POST /admin/memory/tracemalloc     {"action": "start" | "stop", "frames": 回溯帧数}
+- POST /admin/memory/snapshot        记录一个 tracemalloc 快照，返回快照 ID，供之后 diff 对比
+
+tracemalloc 默认不开启（开启后每次分配都有额外开销），空闲时只有内部结构计数的成本
+"""
+
+import gc
+import hmac
+import itertools
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, OrderedDict
+from typing import Any, Callable, Dict
+
+import config
+from utils import logger
+
+
+# top 参数上限
+_MAX_TOP = 100
+
+# 内部结构大小的统计函数 {名称: 返回数值或字典的函数}
+_gauges: Dict[str, Callable[[], Any]] = {}
+
+# 保存的快照 {快照 ID: (创建时间, 快照)}，只保留最近 MEMORY_SNAPSHOT_LIMIT 个
+_snapshots: 'OrderedDict[int, Any]' = OrderedDict()
+_snapshot_ids = itertools.count(1)
+_lock = threading.Lock()
+
+
+def register_gauge(name: str, func: Callable[[], Any]):
+    """
+    注册一个内部结构的大小统计，只在诊断接口被调用时执行
+
+    Args:
+        name: 统计项名称
+        func: 返回当前大小的函数（数值或字典）
+    """
+    _gauges[name] = func
+
+
+def _rss_kb() -> Dict[str, Any]:
+    # Linux 下读取 /proc/self/status，其他平台只返回峰值
+    result = {}
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith(('VmRSS:', 'VmHWM:')):
+                    key, value = line.split(':', 1)
+                    result[key] = int(value.split()[0])
+    except OSError:
+        try:
+            import resource
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            result['VmHWM'] = peak if sys.platform != 'darwin' else peak // 1024
+        except ImportError:
+            pass
+    return {"rss_kb": result.get('VmRSS'), "peak_rss_kb": result.get('VmHWM')}
+
+
+def _threads() -> Dict[str, Any]:
+    # 按线程名前缀分组（去掉编号），便于发现不断增长的线程
+    groups = Counter()
+    for thread in threading.enumerate():
+        groups[thread.name.split('-')[0].split(' ')[0]] += 1
+    return {"total": threading.active_count(), "by_name": dict(groups.most_common())}
+
+
+def _gauge_values() -> Dict[str, Any]:
+    values = {}
+    for name, func in _gauges.items():
+        try:
+            values[name] = func()
+        except Exception as e:
+            values[name] = f"统计失败: {str(e)}"
+    return values
+
+
+def _format_stat(stat) -> Dict[str, Any]:
+    frames = [f"{frame.filename}:{frame.lineno}" for frame in stat.traceback]
+    item = {"location": frames[0] if len(frames) == 1 else frames, "size_kb": round(stat.size / 1024, 1), "count": stat.count}
+    if hasattr(stat, 'size_diff'):
+        item["size_diff_kb"] = round(stat.size_diff / 1024, 1)
+        item["count_diff"] = stat.count_diff
+    return item
+
+
+def _snapshot_list():
+    with _lock:
+        return [{"id": sid, "taken_at": taken_at} for sid, (taken_at, _) in _snapshots.items()]
+
+
+def report(top: int = 20, group: str = 'lineno', diff: int = None, count_objects: bool = False) -> Dict[str, Any]:
+    """
+    生成内存诊断报告
+
+    Args:
+        top: 返回的分配位置条数
+        group: tracemalloc 统计分组方式
+        diff: 对比的快照 ID（可选）
+        count_objects: 是否统计 gc 跟踪的对象数
+
+    Raises:
+        ValueError: 参数不合法或快照不存在
+    """
+    if group not in ('lineno', 'filename', 'traceback'):
+        raise ValueError("group 只能是 lineno / filename / traceback")
+    top = max(1, min(int(top), _MAX_TOP))
+
+    result = {
+        "process": _rss_kb(),
+        "threads": _threads(),
+        "gc": {"counts": gc.get_count(), "objects": len(gc.get_objects()) if count_objects else None},
+        "structures": _gauge_values(),
+        "tracemalloc": {"tracing": tracemalloc.is_tracing()},
+        "snapshots": _snapshot_list()
+    }
+
+    if not tracemalloc.is_tracing():
+        if diff is not None:
+            raise ValueError("tracemalloc 未开启，无法对比快照")
+        return result
+
+    current, peak = tracemalloc.get_traced_memory()
+    result["tracemalloc"].update({
+        "frames": tracemalloc.get_traceback_limit(),
+        "traced_kb": round(current / 1024, 1),
+        "peak_kb": round(peak / 1024, 1)
+    })
+
+    snapshot = _take_snapshot()
+    if diff is not None:
+        with _lock:
+            base = _snapshots.get(diff)
+        if base is None:
+            raise ValueError(f"快照不存在: {diff}")
+        stats = snapshot.compare_to(base[1], group)
+        result["diff"] = {"base": diff, "top": [_format_stat(stat) for stat in stats[:top]]}
+    else:
+        result["top"] = [_format_stat(stat) for stat in snapshot.statistics(group)[:top]]
+    return result
+
+
+def _take_snapshot():
+    # 排除 tracemalloc 与本模块自身的分配
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+
+
+def start_tracing(frames: int = 1):
+    """开启 tracemalloc（已开启时忽略）"""
+    frames = max(1, min(int(frames), 50))
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+        logger.warning(f"已开启 tracemalloc（{frames} 帧），内存分配将有额外开销")
+
+
+def stop_tracing():
+    """关闭 tracemalloc 并丢弃已保存的快照"""
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+        logger.info("已关闭 tracemalloc")
+    with _lock:
+        _snapshots.clear()
+
+
+def save_snapshot() -> int:
+    """
+    保存一个 tracemalloc 快照
+
+    Returns:
+        快照 ID
+
+    Raises:
+        ValueError: tracemalloc 未开启
+    """
+    if not tracemalloc.is_tracing():
+        raise ValueError("tracemalloc 未开启，请先 start")
+    snapshot = _take_snapshot()
+    with _lock:
+        sid = next(_snapshot_ids)
+        _snapshots[sid] = (time.time(), snapshot)
+        while len(_snapshots) > config.MEMORY_SNAPSHOT_LIMIT:
+            _snapshots.popitem(last=False)
+    return sid
+
+
+def install(app):
+    """
+    为 Flask 应用注册内存诊断接口（未配置 DIAGNOSTICS_TOKEN 时不注册）
+
+    Args:
+        app: Flask 应用
+    """
+    if not config.DIAGNOSTICS_TOKEN:
+        return
+
+    from flask import request, jsonify
+
+    def authorized() -> bool:
+        token = request.headers.get('X-Admin-Token', '')
+        return bool(token) and hmac.compare_digest(token, config.DIAGNOSTICS_TOKEN)
+
+    @app.route('/admin/memory', methods=['GET'])
+    def admin_memory():
+        if not authorized():
+            return jsonify({"error": "未授权"}), 401
+        try:
+            diff = request.args.get('diff')
+            return jsonify(report(
+                top=request.args.get('top', 20),
+                group=request.args.get('group', 'lineno'),
+                diff=int(diff) if diff else None,
+                count_objects=request.args.get('objects') == '1'
+            ))
+        except ValueError as e:
+            return jsonify({"error": f"参数错误: {str(e)}"}), 400
+
+    @app.route('/admin/memory/tracemalloc', methods=['POST'])
+    def admin_tracemalloc():
+        if not authorized():
+            return jsonify({"error": "未授权"}), 401
+        data = request.get_json(silent=True) or {}
+        action = data.get('action')
+        if action == 'start':
+            try:
+                start_tracing(data.get('frames', 1))
+            except (TypeError, ValueError):
+                return jsonify({"error": "参数错误: frames 必须是整数"}), 400
+        elif action == 'stop':
+            stop_tracing()
+        else:
+            return jsonify({"error": "参数错误: action 只能是 start / stop"}), 400
+        return jsonify({"tracing": tracemalloc.is_tracing()})
+
+    @app.route('/admin/memory/snapshot', methods=['POST'])
+    def admin_snapshot():
+        if not authorized():
+            return jsonify({"error": "未授权"}), 401
+        try:
+            return jsonify({"id": save_snapshot()})
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 409
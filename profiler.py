@@ -0,0 +1,287 @@
+"""
+采样分析模块 - 按需分析单个请求（含其后台线程）的耗时分布
+
+- 按需模式：请求携带 X-Profile-Token 请求头或 profile=<token> 查询参数（与 config.PROFILING_TOKEN 一致）时，
+  对处理该请求的线程以及由它派生的后台线程（见 bind）进行采样
+- 常驻模式：config.PROFILING_CONTINUOUS_INTERVAL > 0 时以低频率采样所有线程，定期写出
+- 采样结果写为 collapsed stack 格式（每行 "帧1;帧2;...;帧N 次数"），可直接用 flamegraph.pl / speedscope 查看；
+  等待网络的时间会落在 socket 读写相关的栈上，与自身代码耗时一目了然
+- 未开启时每个请求只多一次字典查找，采样线程不会启动
+"""
+
+import hmac
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Set
+
+import config
+from utils import logger
+
+
+# 单个调用栈最多记录的帧数
+_MAX_DEPTH = 128
+
+_local = threading.local()
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _collapse(frame) -> str:
+    names = []
+    while frame is not None and len(names) < _MAX_DEPTH:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names)
+
+
+class ProfileSession:
+    """一次分析会话：一组被采样的线程与累计的调用栈"""
+
+    def __init__(self, name: str, path: str):
+        self.name = name
+        self.path = path
+        self.started_at = time.time()
+        self.samples: Counter = Counter()
+        self._threads: Set[int] = set()
+        self._refs = 0
+        self._lock = threading.Lock()
+
+    def retain(self):
+        """增加引用（请求或后台线程开始使用该会话）"""
+        with self._lock:
+            self._refs += 1
+
+    def release(self):
+        """减少引用，全部释放后写出结果并结束会话"""
+        with self._lock:
+            self._refs -= 1
+            done = self._refs <= 0
+        if done:
+            _sampler.remove(self)
+            self.write()
+
+    def attach(self, thread_id: int = None):
+        with self._lock:
+            self._threads.add(thread_id or threading.get_ident())
+
+    def detach(self, thread_id: int = None):
+        with self._lock:
+            self._threads.discard(thread_id or threading.get_ident())
+
+    def sample(self, frames: Dict[int, Any]):
+        with self._lock:
+            threads = list(self._threads)
+        stacks = [_collapse(frames[thread_id]) for thread_id in threads if frames.get(thread_id) is not None]
+        self._add(stacks)
+
+    def _add(self, stacks: List[str]):
+        # 采样线程累加样本，与 write 的读取互斥
+        with self._lock:
+            for stack in stacks:
+                self.samples[stack] += 1
+
+    def write(self):
+        """把采样结果写为 collapsed stack 文件"""
+        # write 在请求结束时调用，可能与采样线程的最后一次采样同时进行，先在锁内复制
+        with self._lock:
+            samples = Counter(self.samples)
+        if not samples:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path, 'w', encoding='utf-8') as f:
+                for stack, count in samples.most_common():
+                    f.write(f"{stack} {count}\n")
+            logger.info(f"分析结果已写出: {self.path}（{sum(samples.values())} 个样本）")
+        except OSError as e:
+            logger.error(f"写出分析结果失败: {str(e)}")
+
+
+class _ContinuousSession(ProfileSession):
+    """常驻低频采样：采样所有线程，定期写出并清空"""
+
+    def sample(self, frames: Dict[int, Any]):
+        current = threading.get_ident()
+        self._add([_collapse(frame) for thread_id, frame in frames.items() if thread_id != current])
+
+
+class _Sampler:
+    """采样线程：有活动会话时运行，空闲时自动退出"""
+
+    def __init__(self):
+        self._sessions: Set[ProfileSession] = set()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._continuous: Optional[_ContinuousSession] = None
+        self._next_continuous = 0.0
+        self._next_flush = 0.0
+
+    def add(self, session: ProfileSession):
+        with self._lock:
+            self._sessions.add(session)
+            self._ensure_thread()
+
+    def remove(self, session: ProfileSession):
+        with self._lock:
+            self._sessions.discard(session)
+
+    def start_continuous(self):
+        with self._lock:
+            if self._continuous is None:
+                self._continuous = _new_continuous_session()
+                self._next_flush = time.monotonic() + config.PROFILING_CONTINUOUS_FLUSH
+                self._ensure_thread()
+
+    def _ensure_thread(self):
+        # 调用方需持有锁
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="profiler-sampler", daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        while True:
+            with self._lock:
+                sessions = list(self._sessions)
+                continuous = self._continuous
+                if not sessions and continuous is None:
+                    self._thread = None
+                    return
+
+            interval = config.PROFILING_INTERVAL if sessions else config.PROFILING_CONTINUOUS_INTERVAL
+            time.sleep(interval)
+
+            frames = sys._current_frames()
+            for session in sessions:
+                session.sample(frames)
+
+            if continuous is not None:
+                now = time.monotonic()
+                if now >= self._next_continuous:
+                    self._next_continuous = now + config.PROFILING_CONTINUOUS_INTERVAL
+                    continuous.sample(frames)
+                if now >= self._next_flush:
+                    continuous.write()
+                    with self._lock:
+                        self._continuous = _new_continuous_session()
+                    self._next_flush = now + config.PROFILING_CONTINUOUS_FLUSH
+            del frames
+
+
+def _output_path(name: str) -> str:
+    safe = "".join(c if c.isalnum() or c in "-_" else "_" for c in name).strip("_") or "request"
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    return os.path.join(config.PROFILING_OUTPUT_DIR, f"{stamp}-{safe}-{os.getpid()}-{threading.get_ident()}.folded")
+
+
+def _new_continuous_session() -> _ContinuousSession:
+    return _ContinuousSession("continuous", _output_path("continuous"))
+
+
+_sampler = _Sampler()
+
+
+def is_authorized(token: Optional[str]) -> bool:
+    """校验分析令牌（未配置 PROFILING_TOKEN 时一律拒绝）"""
+    expected = config.PROFILING_TOKEN
+    if not expected or not token:
+        return False
+    return hmac.compare_digest(token, expected)
+
+
+def start_session(name: str) -> ProfileSession:
+    """为当前线程开启一个按需分析会话"""
+    session = ProfileSession(name, _output_path(name))
+    session.retain()
+    session.attach()
+    _local.session = session
+    _sampler.add(session)
+    logger.info(f"开始分析请求: {name}")
+    return session
+
+
+def end_session():
+    """结束当前线程的分析会话（后台线程仍在使用时延后写出）"""
+    session = getattr(_local, 'session', None)
+    if session is None:
+        return
+    _local.session = None
+    session.detach()
+    session.release()
+
+
+def current_session() -> Optional[ProfileSession]:
+    return getattr(_local, 'session', None)
+
+
+def bind(func: Callable) -> Callable:
+    """
+    让后台线程加入当前请求的分析会话
+
+    未在分析中时原样返回 func，不引入额外开销；返回的函数如果不会被调用（如任务被丢弃），
+    需要调用 unbind 释放会话，否则会话不会结束
+    """
+    session = current_session()
+    if session is None:
+        return func
+
+    session.retain()
+
+    def wrapper(*args, **kwargs):
+        _local.session = session
+        session.attach()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            session.detach()
+            _local.session = None
+            session.release()
+
+    wrapper.profile_session = session
+    return wrapper
+
+
+def unbind(func: Callable):
+    """释放 bind 占用的会话引用（bind 返回的函数不会再被调用时使用）"""
+    session = getattr(func, 'profile_session', None)
+    if session is not None:
+        session.release()
+
+
+def install(app):
+    """
+    为 Flask 应用启用按需分析与常驻采样
+
+    Args:
+        app: Flask 应用
+    """
+    from flask import request
+
+    if config.PROFILING_CONTINUOUS_INTERVAL > 0:
+        _sampler.start_continuous()
+
+    if not config.PROFILING_TOKEN:
+        return
+
+    @app.before_request
+    def _start_profiling():
+        token = request.headers.get('X-Profile-Token') or request.args.get('profile')
+        if token and is_authorized(token):
+            start_session(request.path)
+
+    @app.after_request
+    def _profile_header(response):
+        session = current_session()
+        if session is not None:
+            response.headers['X-Profile-File'] = os.path.basename(session.path)
+        return response
+
+    @app.teardown_request
+    def _end_profiling(exc):
+        end_session()
@@ -0,0 +1,356 @@
+"""
+运行历史模块 - 将每次工作流运行持久化到本地 SQLite（WAL 模式）
+
+- 请求路径上只做内存操作：记录放入队列后立即返回
+- 后台写线程按批次写入数据库，批次大小或时间间隔到达即提交
+- 按文档链接、开始时间、状态建立索引，供 /api/runs 分页查询
+"""
+
+import atexit
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+import config
+from utils import logger
+
+from cozepy import WorkflowEventType
+
+
+# 运行状态
+STATUS_RUNNING = "running"
+STATUS_SUCCESS = "success"
+STATUS_ERROR = "error"
+STATUS_TIMEOUT = "timeout"
+STATUS_CANCELLED = "cancelled"
+STATUS_REJECTED = "rejected"
+
+_COLUMNS = (
+    "run_id", "source", "doc_url", "chat_id", "status",
+    "started_at", "finished_at", "duration_ms", "first_event_ms",
+    "interrupt_count", "message_count", "output", "error"
+)
+
+_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS runs (
+        run_id TEXT PRIMARY KEY,
+        source TEXT NOT NULL,
+        doc_url TEXT,
+        chat_id TEXT,
+        status TEXT NOT NULL,
+        started_at REAL NOT NULL,
+        finished_at REAL,
+        duration_ms INTEGER,
+        first_event_ms INTEGER,
+        interrupt_count INTEGER DEFAULT 0,
+        message_count INTEGER DEFAULT 0,
+        output TEXT,
+        error TEXT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_runs_doc_url ON runs (doc_url, started_at)",
+    "CREATE INDEX IF NOT EXISTS idx_runs_started_at ON runs (started_at)",
+    "CREATE INDEX IF NOT EXISTS idx_runs_status ON runs (status, started_at)",
+]
+
+# 错误信息最多保存的字符数
+_MAX_ERROR_LENGTH = 1000
+
+
+class RunRecord:
+    """单次运行的记录，运行过程中逐步填充"""
+
+    def __init__(self, source: str, doc_url: str, chat_id: str = None):
+        """
+        Args:
+            source: 运行来源（api / bot）
+            doc_url: 文档链接
+            chat_id: 飞书群组 ID（机器人来源时有值）
+        """
+        self.run_id = uuid.uuid4().hex
+        self.source = source
+        self.doc_url = doc_url
+        self.chat_id = chat_id
+        self.status = STATUS_RUNNING
+        self.started_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.duration_ms: Optional[int] = None
+        self.first_event_ms: Optional[int] = None
+        self.interrupt_count = 0
+        self.message_count = 0
+        self.output: Optional[str] = None
+        self.error: Optional[str] = None
+        self._start = time.monotonic()
+
+    def on_event(self, event_type: Any):
+        """登记收到的一个工作流事件（记录首个事件耗时、消息数与中断数）"""
+        if self.first_event_ms is None:
+            self.first_event_ms = int((time.monotonic() - self._start) * 1000)
+        if event_type == WorkflowEventType.MESSAGE:
+            self.message_count += 1
+        elif event_type == WorkflowEventType.INTERRUPT:
+            self.interrupt_count += 1
+
+    def finish(self, status: str, output: str = None, error: str = None):
+        """结束运行并记录耗时"""
+        self.status = status
+        self.output = output
+        self.error = error[:_MAX_ERROR_LENGTH] if error else None
+        self.finished_at = time.time()
+        self.duration_ms = int((time.monotonic() - self._start) * 1000)
+
+    def finish_from_result(self, result: Dict[str, Any]):
+        """根据 WorkflowEngine.execute 的返回结果结束运行"""
+        if result.get('success'):
+            self.finish(STATUS_SUCCESS, output=result.get('output'))
+        elif 'retry_after' in result:
+            self.finish(STATUS_REJECTED, error=result.get('error'))
+        elif result.get('cancelled') == "deadline_exceeded":
+            self.finish(STATUS_TIMEOUT, error=result.get('error'))
+        elif result.get('cancelled'):
+            self.finish(STATUS_CANCELLED, error=result.get('error'))
+        else:
+            self.finish(STATUS_ERROR, error=result.get('error'))
+
+    def to_row(self) -> tuple:
+        return tuple(getattr(self, column) for column in _COLUMNS)
+
+
+# 写入线程的停止标记（放入队列，排在已提交的记录之后）
+_STOP = object()
+
+
+class RunHistoryStore:
+    """运行历史存储：异步批量写入，按需查询"""
+
+    def __init__(
+        self,
+        db_path: str,
+        batch_size: int = None,
+        flush_interval: float = None,
+        queue_size: int = None
+    ):
+        self.db_path = db_path
+        self.batch_size = batch_size or config.RUN_HISTORY_BATCH_SIZE
+        self.flush_interval = flush_interval or config.RUN_HISTORY_FLUSH_INTERVAL
+        self._queue = queue.Queue(maxsize=queue_size or config.RUN_HISTORY_QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self._writer: Optional[threading.Thread] = None
+        self._stopping = False
+        self._schema_ready = False
+        self._dropped = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=5)
+        conn.row_factory = sqlite3.Row
+        if not self._schema_ready:
+            conn.execute("PRAGMA journal_mode=WAL")
+            for statement in _SCHEMA:
+                conn.execute(statement)
+            conn.commit()
+            self._schema_ready = True
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def record(self, run: RunRecord):
+        """
+        提交一条运行记录（非阻塞）
+
+        队列已满时丢弃记录并计数，保证不影响请求路径
+        """
+        if not config.RUN_HISTORY_ENABLED:
+            return
+        self._ensure_writer()
+        try:
+            self._queue.put_nowait(run.to_row())
+        except queue.Full:
+            self._dropped += 1
+            logger.warning(f"运行历史队列已满，丢弃记录: run_id={run.run_id}")
+
+    def _ensure_writer(self):
+        if self._writer is not None or self._stopping:
+            return
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name="run-history-writer", daemon=True)
+                self._writer.start()
+
+    def _write_loop(self):
+        conn = None
+        stopping = False
+        while not stopping:
+            batch = self._take_batch()
+            if batch[-1] is _STOP:
+                batch.pop()
+                stopping = True
+            if not batch:
+                continue
+            try:
+                if conn is None:
+                    conn = self._connect()
+                self._write_batch(conn, batch)
+            except Exception as e:
+                logger.error(f"写入运行历史失败（{len(batch)} 条）: {str(e)}")
+                if conn is not None:
+                    conn.close()
+                    conn = None
+        if conn is not None:
+            conn.close()
+
+    def _take_batch(self) -> List[tuple]:
+        # 阻塞等待第一条，之后在 flush_interval 内尽量凑满一批
+        # 取到停止标记时立即返回（标记在批次末尾）
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size and batch[-1] is not _STOP:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write_batch(self, conn: sqlite3.Connection, batch: List[tuple]):
+        placeholders = ", ".join("?" for _ in _COLUMNS)
+        conn.executemany(
+            f"INSERT OR REPLACE INTO runs ({', '.join(_COLUMNS)}) VALUES ({placeholders})",
+            batch
+        )
+        conn.commit()
+
+    def close(self, timeout: float = 5):
+        """
+        进程退出时调用：通知写入线程写完已提交的记录后退出，再同步写入剩余的记录
+
+        写入线程未能在 timeout 秒内退出时放弃剩余记录，避免两个线程同时写库
+        """
+        self._stopping = True
+        writer = self._writer
+        if writer is not None:
+            try:
+                self._queue.put(_STOP, timeout=timeout)
+            except queue.Full:
+                pass
+            writer.join(timeout)
+            if writer.is_alive():
+                logger.warning(f"运行历史写入线程未能按时退出，放弃剩余的 {self._queue.qsize()} 条记录")
+                return
+        self.flush()
+
+    def flush(self):
+        """同步写入队列中剩余的记录（写入线程未运行或已退出时调用，见 close）"""
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if not batch:
+            return
+        try:
+            conn = self._connect()
+            try:
+                self._write_batch(conn, batch)
+            finally:
+                conn.close()
+        except Exception as e:
+            logger.error(f"写入运行历史失败（{len(batch)} 条）: {str(e)}")
+
+    def query(
+        self,
+        doc_url: str = None,
+        status: str = None,
+        source: str = None,
+        since: float = None,
+        until: float = None,
+        limit: int = 50,
+        offset: int = 0
+    ) -> Dict[str, Any]:
+        """
+        分页查询运行历史（按开始时间倒序）
+
+        Args:
+            doc_url: 按文档链接过滤
+            status: 按状态过滤
+            source: 按来源过滤
+            since: 开始时间下限（Unix 时间戳）
+            until: 开始时间上限（Unix 时间戳）
+            limit: 每页条数
+            offset: 偏移量
+
+        Returns:
+            {"runs": [...], "total": 总数, "limit": ..., "offset": ..., "next_offset": 下一页偏移或 None}
+        """
+        conditions = []
+        params: List[Any] = []
+        for column, value in (("doc_url", doc_url), ("status", status), ("source", source)):
+            if value:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if since is not None:
+            conditions.append("started_at >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("started_at < ?")
+            params.append(until)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        conn = self._connect()
+        try:
+            total = conn.execute(f"SELECT COUNT(*) FROM runs {where}", params).fetchone()[0]
+            rows = conn.execute(
+                f"SELECT * FROM runs {where} ORDER BY started_at DESC LIMIT ? OFFSET ?",
+                params + [limit, offset]
+            ).fetchall()
+        finally:
+            conn.close()
+
+        next_offset = offset + len(rows)
+        return {
+            "runs": [dict(row) for row in rows],
+            "total": total,
+            "limit": limit,
+            "offset": offset,
+            "next_offset": next_offset if next_offset < total else None
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": self._queue.qsize(),
+            "dropped": self._dropped
+        }
+
+
+def query_from_args(args: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    根据 HTTP 查询参数查询运行历史
+
+    支持参数：doc_url、status、source、since、until、limit（最大 200）、offset
+
+    Raises:
+        ValueError: 参数格式错误
+    """
+    limit = min(max(int(args.get('limit', 50)), 1), 200)
+    offset = max(int(args.get('offset', 0)), 0)
+    since = float(args['since']) if args.get('since') else None
+    until = float(args['until']) if args.get('until') else None
+    return run_history.query(
+        doc_url=args.get('doc_url'),
+        status=args.get('status'),
+        source=args.get('source'),
+        since=since,
+        until=until,
+        limit=limit,
+        offset=offset
+    )
+
+
+# 全局运行历史实例
+run_history = RunHistoryStore(config.RUN_HISTORY_DB_PATH)
+atexit.register(run_history.close)
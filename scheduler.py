@@ -0,0 +1,217 @@
+"""
+优先级调度模块 - 在交互请求、群聊消息和批量任务之间分配工作流并发名额
+
+- 每个优先级类别有权重、最长排队时间和可占用的名额比例（见 config.SCHEDULER_CLASSES，
+  与老化周期一样在每次使用时读取，支持热更新）
+- 名额空出时，从排队请求中选择得分最高者：权重 ×（1 + 已等待时间 / 老化周期），
+  低优先级请求等待越久得分越高，保证最终能够得到执行
+- 统计各类别的排队数、在途数、排队延迟与运行耗时（p50/p95）、被拒绝次数
+"""
+
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+import config
+from utils import logger
+from concurrency import AdaptiveLimiter, LimitExceeded, Permit, workflow_limiter
+
+
+# 内置的优先级类别
+CLASS_INTERACTIVE = "interactive"
+CLASS_BOT = "bot"
+CLASS_BULK = "bulk"
+
+# 排队请求的兜底轮询间隔（秒），防止错过名额归还通知
+_POLL_INTERVAL = 0.5
+
+# 配置热更新后已被删除的类别（仍有排队或在途的请求）使用的设置
+_FALLBACK_CLASS = {"weight": 1, "max_wait": 60, "max_share": 1.0}
+
+
+class _Waiter:
+    """一个排队中的请求"""
+
+    def __init__(self, cls: str):
+        self.cls = cls
+        self.enqueued_at = time.monotonic()
+        self.permit: Optional[Permit] = None
+        self.granted = threading.Event()
+
+
+class _ClassStats:
+    """单个优先级类别的统计"""
+
+    def __init__(self):
+        self.inflight = 0
+        self.admitted = 0
+        self.shed = 0
+        self.waits_ms = deque(maxlen=512)
+        # 获得名额到归还名额的耗时
+        self.runs_ms = deque(maxlen=512)
+
+    def snapshot(self, queued: int) -> Dict[str, Any]:
+        waits = sorted(self.waits_ms)
+        runs = sorted(self.runs_ms)
+        return {
+            "queued": queued,
+            "inflight": self.inflight,
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "wait_p50_ms": waits[len(waits) // 2] if waits else None,
+            "wait_p95_ms": waits[int(len(waits) * 0.95)] if waits else None,
+            "run_p50_ms": runs[len(runs) // 2] if runs else None,
+            "run_p95_ms": runs[int(len(runs) * 0.95)] if runs else None
+        }
+
+
+class PriorityScheduler:
+    """带权重与老化的优先级调度器，向自适应并发限制器申请名额"""
+
+    def __init__(
+        self,
+        limiter: AdaptiveLimiter,
+        classes: Dict[str, Dict[str, Any]] = None,
+        aging_period: float = None
+    ):
+        """
+        Args:
+            limiter: 并发限制器
+            classes: 类别配置 {名称: {"weight": 权重, "max_wait": 最长排队秒数, "max_share": 最多占用的名额比例}}
+            aging_period: 老化周期（秒），每等待一个周期，得分增加一倍权重
+        """
+        self._limiter = limiter
+        # 未指定时每次使用时读取配置，支持热更新
+        self._classes = classes
+        self._aging_period = aging_period
+        self._lock = threading.Lock()
+        self._waiters: List[_Waiter] = []
+        self._stats: Dict[str, _ClassStats] = {}
+        limiter.add_listener(self._dispatch)
+
+    @property
+    def classes(self) -> Dict[str, Dict[str, Any]]:
+        return self._classes if self._classes is not None else config.SCHEDULER_CLASSES
+
+    @property
+    def aging_period(self) -> float:
+        return self._aging_period or config.SCHEDULER_AGING_PERIOD
+
+    def _settings(self, cls: str) -> Dict[str, Any]:
+        return self.classes.get(cls, _FALLBACK_CLASS)
+
+    def _class_stats(self, cls: str) -> _ClassStats:
+        # 调用方需持有锁
+        stats = self._stats.get(cls)
+        if stats is None:
+            stats = self._stats[cls] = _ClassStats()
+        return stats
+
+    def resolve_class(self, requested: Optional[str], default: str) -> str:
+        """
+        确定请求的优先级类别
+
+        Raises:
+            ValueError: 指定了不存在的类别
+        """
+        if not requested:
+            return default
+        requested = requested.strip().lower()
+        classes = self.classes
+        if requested not in classes:
+            raise ValueError(f"未知的优先级类别: {requested}，可选: {', '.join(classes)}")
+        return requested
+
+    def acquire(self, cls: str, timeout: float = None) -> Permit:
+        """
+        按优先级申请一个并发名额
+
+        Args:
+            cls: 优先级类别
+            timeout: 最多排队的秒数（不超过类别的 max_wait）
+
+        Raises:
+            LimitExceeded: 排队超时
+        """
+        max_wait = self._settings(cls)["max_wait"]
+        if timeout is not None:
+            max_wait = min(max_wait, timeout)
+
+        waiter = _Waiter(cls)
+        with self._lock:
+            self._waiters.append(waiter)
+        self._dispatch()
+
+        deadline = waiter.enqueued_at + max_wait
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining > 0:
+                waiter.granted.wait(min(remaining, _POLL_INTERVAL))
+
+            with self._lock:
+                if waiter.permit is not None:
+                    return waiter.permit
+                if remaining <= 0:
+                    self._waiters.remove(waiter)
+                    self._class_stats(cls).shed += 1
+                    break
+
+            self._dispatch()
+
+        logger.warning(f"优先级 {cls} 排队超时（{max_wait:.0f} 秒），拒绝请求")
+        raise LimitExceeded(self._limiter.name, self._limiter.limit, self._limiter.retry_after())
+
+    def _score(self, waiter: _Waiter, now: float) -> float:
+        weight = self._settings(waiter.cls)["weight"]
+        return weight * (1 + (now - waiter.enqueued_at) / self.aging_period)
+
+    def _share_ok(self, cls: str) -> bool:
+        # 调用方需持有锁；限制该类别最多占用的名额比例
+        share = self._settings(cls).get("max_share", 1.0)
+        return self._class_stats(cls).inflight < max(1, int(share * self._limiter.limit))
+
+    def _dispatch(self):
+        """把空闲名额分配给得分最高的排队请求"""
+        with self._lock:
+            now = time.monotonic()
+            while self._waiters:
+                candidates = [w for w in self._waiters if self._share_ok(w.cls)]
+                if not candidates:
+                    return
+                best = max(candidates, key=lambda w: (self._score(w, now), -w.enqueued_at))
+
+                permit = self._limiter.try_acquire()
+                if permit is None:
+                    return
+
+                cls = best.cls
+                # 用默认参数绑定当前的类别和时间（同一轮循环可能分配多个名额）
+                permit.on_release = lambda cls=cls, granted_at=now: self._on_release(cls, granted_at)
+                stats = self._class_stats(cls)
+                stats.inflight += 1
+                stats.admitted += 1
+                stats.waits_ms.append(int((now - best.enqueued_at) * 1000))
+
+                self._waiters.remove(best)
+                best.permit = permit
+                best.granted.set()
+
+    def _on_release(self, cls: str, granted_at: float):
+        run_ms = int((time.monotonic() - granted_at) * 1000)
+        with self._lock:
+            stats = self._class_stats(cls)
+            stats.inflight -= 1
+            stats.runs_ms.append(run_ms)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """各优先级类别的统计，用于健康检查"""
+        with self._lock:
+            queued = {cls: 0 for cls in list(self.classes) + list(self._stats)}
+            for waiter in self._waiters:
+                queued[waiter.cls] = queued.get(waiter.cls, 0) + 1
+            return {cls: self._class_stats(cls).snapshot(count) for cls, count in queued.items()}
+
+
+# 全局工作流调度器（api.py 与 AIcase.py 共用）
+workflow_scheduler = PriorityScheduler(workflow_limiter)
@@ -0,0 +1,314 @@
+"""
+事件流录制与回放模块 - 离线复现 Coze 工作流运行
+
+录制文件为追加写入的 JSON Lines，每行一条记录：
+- 段开始：{"seg": 0, "op": "stream", "params": {...}, "at": 1760000000.0}
+  初始调用为第 0 段，每次中断恢复（resume）开启新的一段
+- 事件：{"seg": 0, "t": 1532, "event": {...}}，t 为该段开始后的毫秒数
+- 段结束：{"seg": 0, "t": 20311, "end": true}
+- 段作废：{"seg": 1, "t": 812, "discarded": true}，对冲调用中落败的一方（见 hedging），回放时跳过
+
+RecordingClient / ReplayClient 与 Coze 客户端的 workflows.runs.stream/resume 接口一致，
+可直接传给 WorkflowEngine.run / execute 的 client 参数。
+synthetic_segments 生成合成的事件流，无需录制即可测量引擎开销（见 workflow_engine.main）。
+
+命令行回放（离线性能测试）：
+    python stream_recorder.py recordings/xxx.jsonl --speed 0 --repeat 20
+"""
+
+import json
+import os
+import threading
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, Iterator, List
+
+import config
+from utils import logger
+
+from cozepy import WorkflowEvent
+
+
+def _dumps(data: Dict[str, Any]) -> str:
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+
+class _RecordedStream:
+    """包装一个 Coze 事件流，迭代时把事件写入录制文件"""
+
+    def __init__(self, stream: Any, recorder: 'RecordingClient', seg: int, started: float):
+        self._stream = stream
+        self._recorder = recorder
+        self._seg = seg
+        self._started = started
+        # 保留原始响应，deadline.close_stream 据此中断并释放连接
+        self._raw_response = getattr(stream, '_raw_response', None)
+
+    def __iter__(self) -> Iterator[WorkflowEvent]:
+        for event in self._stream:
+            self._recorder._write({
+                "seg": self._seg,
+                "t": self._elapsed_ms(),
+                "event": event.model_dump(mode='json', exclude_none=True)
+            })
+            yield event
+        self._recorder._write({"seg": self._seg, "t": self._elapsed_ms(), "end": True})
+
+    def _elapsed_ms(self) -> int:
+        return int((time.monotonic() - self._started) * 1000)
+
+    def close(self):
+        close = getattr(self._stream, 'close', None)
+        if close:
+            close()
+
+    def mark_discarded(self):
+        """标记本段作废（对冲落败的调用），回放时不会使用"""
+        self._recorder._write({"seg": self._seg, "t": self._elapsed_ms(), "discarded": True})
+
+
+class RecordingClient:
+    """录制客户端：转发调用给真实的 Coze 客户端，同时录制事件流"""
+
+    def __init__(self, client: Any, path: str):
+        """
+        Args:
+            client: 真实的 Coze 客户端
+            path: 录制文件路径（追加写入）
+        """
+        self._client = client
+        self.path = path
+        self._lock = threading.Lock()
+        self._segments = 0
+        self.workflows = SimpleNamespace(runs=self)
+
+    def stream(self, **params) -> _RecordedStream:
+        return self._open("stream", params, self._client.workflows.runs.stream)
+
+    def resume(self, **params) -> _RecordedStream:
+        return self._open("resume", params, self._client.workflows.runs.resume)
+
+    def _open(self, op: str, params: Dict[str, Any], call) -> _RecordedStream:
+        with self._lock:
+            seg = self._segments
+            self._segments += 1
+        self._write({"seg": seg, "op": op, "params": params, "at": time.time()})
+        started = time.monotonic()
+        return _RecordedStream(call(**params), self, seg, started)
+
+    def _write(self, data: Dict[str, Any]):
+        line = _dumps(data) + "\n"
+        try:
+            with self._lock:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(line)
+        except OSError as e:
+            logger.error(f"写入事件流录制失败: {str(e)}")
+
+
+def recording_client(client: Any, run_id: str) -> Any:
+    """
+    按配置为一次运行包装录制客户端
+
+    Args:
+        client: 真实的 Coze 客户端
+        run_id: 运行 ID，用作录制文件名
+
+    Returns:
+        开启录制时返回 RecordingClient，否则原样返回 client
+    """
+    if not config.STREAM_RECORDING_ENABLED:
+        return client
+    os.makedirs(config.STREAM_RECORD_DIR, exist_ok=True)
+    path = os.path.join(config.STREAM_RECORD_DIR, f"{run_id}.jsonl")
+    logger.info(f"录制本次运行的事件流: {path}")
+    return RecordingClient(client, path)
+
+
+class _ReplayStream:
+    """回放一段录制的事件流，按录制时的间隔（除以回放速度）依次产出事件"""
+
+    def __init__(self, segment: Dict[str, Any], speed: float):
+        self._segment = segment
+        self._speed = speed
+        self._closed = threading.Event()
+
+    def __iter__(self) -> Iterator[WorkflowEvent]:
+        started = time.monotonic()
+        for t, event in self._segment["events"]:
+            self._wait_until(started, t)
+            if self._closed.is_set():
+                return
+            yield WorkflowEvent.model_validate(event)
+        if self._segment.get("end") is not None:
+            self._wait_until(started, self._segment["end"])
+
+    def _wait_until(self, started: float, t: int):
+        if self._speed <= 0:
+            return
+        delay = t / 1000 / self._speed - (time.monotonic() - started)
+        if delay > 0:
+            self._closed.wait(delay)
+
+    def close(self):
+        """中断回放（deadline 取消时调用）"""
+        self._closed.set()
+
+
+class ReplayClient:
+    """回放客户端：从录制文件产出事件流，不访问网络"""
+
+    def __init__(self, path: str = None, speed: float = 1.0, segments: List[Dict[str, Any]] = None):
+        """
+        Args:
+            path: 录制文件路径
+            speed: 回放速度倍数，1 为实时，0 表示不等待（尽可能快）
+            segments: 直接给出段列表（格式同 load_recording），代替录制文件
+        """
+        self.path = path or "<synthetic>"
+        self.speed = speed
+        self.segments = segments if segments is not None else load_recording(path)
+        self._used = set()
+        self._lock = threading.Lock()
+        self.workflows = SimpleNamespace(runs=self)
+
+    def stream(self, **params) -> _ReplayStream:
+        return _ReplayStream(self._take("stream"), self.speed)
+
+    def resume(self, **params) -> _ReplayStream:
+        event_id = params.get('event_id')
+        return _ReplayStream(self._take("resume", event_id), self.speed)
+
+    def _take(self, op: str, event_id: str = None) -> Dict[str, Any]:
+        # 优先匹配 event_id 相同的段，否则取下一个同类型的段
+        with self._lock:
+            candidates = [
+                seg for seg in self.segments
+                if seg["op"] == op and seg["seg"] not in self._used and not seg.get("discarded")
+            ]
+            if event_id is not None:
+                matched = [seg for seg in candidates if seg["params"].get('event_id') == event_id]
+                candidates = matched or candidates
+            if not candidates:
+                raise ValueError(f"录制文件中没有可回放的 {op} 段: {self.path}")
+            segment = candidates[0]
+            self._used.add(segment["seg"])
+            return segment
+
+    def reset(self):
+        """重置回放进度，便于同一录制反复回放"""
+        with self._lock:
+            self._used.clear()
+
+
+def load_recording(path: str) -> List[Dict[str, Any]]:
+    """
+    读取录制文件
+
+    Returns:
+        按段号排序的段列表：{"seg", "op", "params", "at", "events": [(t, event)], "end": t 或 None, "discarded"}
+    """
+    segments: Dict[int, Dict[str, Any]] = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            data = json.loads(line)
+            seg = data["seg"]
+            if "op" in data:
+                segments[seg] = {
+                    "seg": seg,
+                    "op": data["op"],
+                    "params": data.get("params", {}),
+                    "at": data.get("at"),
+                    "events": [],
+                    "end": None,
+                    "discarded": False
+                }
+            elif seg in segments:
+                if data.get("discarded"):
+                    segments[seg]["discarded"] = True
+                elif data.get("end"):
+                    segments[seg]["end"] = data["t"]
+                else:
+                    segments[seg]["events"].append((data["t"], data["event"]))
+    return [segments[seg] for seg in sorted(segments)]
+
+
+def synthetic_segments(messages: int, message_bytes: int = 200, interrupts: int = 0) -> List[Dict[str, Any]]:
+    """
+    生成合成的事件流（段列表，格式同 load_recording），事件间隔为 1 毫秒
+
+    Args:
+        messages: 每段的消息数
+        message_bytes: 每条消息的内容字节数
+        interrupts: 中断次数，每次中断后接一段恢复的事件流；最后一段以 output 消息结尾
+
+    Returns:
+        段列表，可传给 ReplayClient(segments=...)
+    """
+    filler = "x" * message_bytes
+    segments = []
+    for seg in range(interrupts + 1):
+        events = []
+        for index in range(messages):
+            events.append((index, {
+                "id": index,
+                "event": "Message",
+                "message": {"content": filler, "node_title": f"node-{index}", "node_seq_id": "0", "node_is_finish": True}
+            }))
+        if seg < interrupts:
+            events.append((messages, {
+                "id": messages,
+                "event": "Interrupt",
+                "interrupt": {"interrupt_data": {"event_id": f"interrupt-{seg}", "type": 2}, "node_title": "question"}
+            }))
+        else:
+            events.append((messages, {
+                "id": messages,
+                "event": "Message",
+                "message": {
+                    "content": '{"output": "example.com/synthetic"}',
+                    "node_title": "End", "node_seq_id": "0", "node_is_finish": True
+                }
+            }))
+        segments.append({
+            "seg": seg,
+            "op": "stream" if seg == 0 else "resume",
+            "params": (
+                {"parameters": {config.COZE_WORKFLOW_INPUT_PARAM: "https://example.feishu.cn/docx/synthetic"}}
+                if seg == 0 else {"event_id": f"interrupt-{seg - 1}"}
+            ),
+            "at": None,
+            "events": events,
+            "end": messages + 1
+        })
+    return segments
+
+
+def main():
+    """
+    命令行回放：将录制文件反复送入工作流运行引擎，统计自身事件处理开销
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description="回放 Coze 事件流录制")
+    parser.add_argument("path", help="录制文件路径")
+    parser.add_argument("--speed", type=float, default=0, help="回放速度倍数（0 表示不等待）")
+    parser.add_argument("--repeat", type=int, default=1, help="回放次数")
+    args = parser.parse_args()
+
+    from workflow_engine import benchmark
+
+    client = ReplayClient(args.path, speed=args.speed)
+    doc_url = client.segments[0]["params"].get("parameters", {}).get(config.COZE_WORKFLOW_INPUT_PARAM, "")
+    stats = benchmark(client, doc_url, args.repeat)
+
+    result = stats["result"]
+    print(f"回放 {args.repeat} 次, 结果: success={result.get('success')}, output={result.get('output')}")
+    print(f"耗时 min={stats['min_ms']:.1f}ms p50={stats['p50_ms']:.1f}ms max={stats['max_ms']:.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
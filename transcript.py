@@ -0,0 +1,199 @@
+"""
+工作流输出缓冲模块 - 限制单次运行保存的消息文本大小
+
+- 内存中最多保留 TRANSCRIPT_MAX_BYTES 字节（UTF-8）：开头 TRANSCRIPT_HEAD_BYTES 字节 + 结尾剩余字节，
+  中间部分丢弃并在最终文本中标注省略的字节数
+- 配置了 TRANSCRIPT_SPILL_DIR 时，首次发生丢弃起把完整输出写入磁盘文件，便于事后查看
+- 最终文本只拼接一次并缓存（text）
+"""
+
+import os
+from collections import deque
+from typing import Deque, Optional
+
+import config
+from utils import logger
+
+
+def _size(text: str) -> int:
+    return len(text.encode('utf-8'))
+
+
+def _prefix(text: str, limit: int) -> str:
+    # 按字节截取开头，避免切断多字节字符
+    return text.encode('utf-8')[:limit].decode('utf-8', 'ignore')
+
+
+def _suffix(text: str, limit: int) -> str:
+    return text.encode('utf-8')[-limit:].decode('utf-8', 'ignore') if limit > 0 else ""
+
+
+class TranscriptBuffer:
+    """有界的工作流输出缓冲（保留开头与结尾，可选完整落盘）"""
+
+    def __init__(
+        self,
+        run_id: str,
+        max_bytes: int = None,
+        head_bytes: int = None,
+        spill_dir: str = None,
+        separator: str = "\n"
+    ):
+        """
+        Args:
+            run_id: 运行 ID，用作落盘文件名
+            max_bytes: 内存中最多保留的字节数
+            head_bytes: 其中保留开头部分的字节数，其余用于保留结尾
+            spill_dir: 完整输出的落盘目录，为空表示不落盘
+            separator: 消息之间的分隔符
+        """
+        self.run_id = run_id
+        self.max_bytes = max_bytes or config.TRANSCRIPT_MAX_BYTES
+        self.head_bytes = min(head_bytes if head_bytes is not None else config.TRANSCRIPT_HEAD_BYTES, self.max_bytes)
+        self.tail_limit = self.max_bytes - self.head_bytes
+        self.spill_dir = config.TRANSCRIPT_SPILL_DIR if spill_dir is None else spill_dir
+        self.separator = separator
+
+        self._head: list = []
+        self._head_size = 0
+        self._head_full = False
+        self._tail: Deque[str] = deque()
+        self._tail_size = 0
+        # 结尾的第一段是否为开头最后一条消息被截断后的剩余部分
+        self._continued = False
+        self._last: Optional[str] = None
+        self._text: Optional[str] = None
+        self._spill = None
+
+        # 统计信息
+        self.count = 0
+        self.total_bytes = 0
+        self.omitted_bytes = 0
+        self.spill_path: Optional[str] = None
+
+    def append(self, message: str):
+        """追加一条消息"""
+        size = _size(message)
+        self.count += 1
+        self.total_bytes += size
+        self._text = None
+
+        if self._spill is None and self.spill_dir and self.retained_bytes + size > self.max_bytes:
+            self._open_spill()
+        if self._spill is not None:
+            self._write_spill(message)
+
+        # 开头部分未满时先写入开头，超出的部分转入结尾
+        if not self._head_full:
+            room = self.head_bytes - self._head_size
+            if size <= room:
+                self._head.append(message)
+                self._head_size += size
+                self._last = message
+                return
+            self._head_full = True
+            if room > 0:
+                part = _prefix(message, room)
+                self._head.append(part)
+                self._head_size += _size(part)
+                message = message[len(part):]
+                size = _size(message)
+                self._continued = True
+
+        self._push_tail(message, size)
+
+    def _push_tail(self, message: str, size: int):
+        if size > self.tail_limit:
+            # 单条消息超过结尾容量：只保留它的末尾
+            self.omitted_bytes += self._tail_size + size
+            self._tail.clear()
+            message = _suffix(message, self.tail_limit)
+            size = _size(message)
+            self.omitted_bytes -= size
+            self._tail_size = 0
+            self._continued = False
+
+        self._tail.append(message)
+        self._tail_size += size
+        self._last = message
+
+        while self._tail_size > self.tail_limit and len(self._tail) > 1:
+            dropped = self._tail.popleft()
+            dropped_size = _size(dropped)
+            self._tail_size -= dropped_size
+            self.omitted_bytes += dropped_size
+            self._continued = False
+
+    @property
+    def retained_bytes(self) -> int:
+        return self._head_size + self._tail_size
+
+    @property
+    def truncated(self) -> bool:
+        return self.omitted_bytes > 0
+
+    @property
+    def last(self) -> Optional[str]:
+        """最后一条消息（过长时只有末尾部分）"""
+        return self._last
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __bool__(self) -> bool:
+        return self.count > 0
+
+    def _messages(self):
+        # 保留的消息（把被截断在开头与结尾之间的同一条消息拼回去）
+        head = list(self._head)
+        tail = list(self._tail)
+        if self._continued and head and tail:
+            head[-1] += tail.pop(0)
+        return head, tail
+
+    def text(self) -> str:
+        """拼接保留的内容（结果缓存，重复调用不会再次拼接）"""
+        if self._text is None:
+            head, tail = self._messages()
+            if self.truncated:
+                marker = f"...（省略 {self.omitted_bytes} 字节"
+                if self.spill_path:
+                    marker += f"，完整输出见 {self.spill_path}"
+                head.append(marker + "）...")
+            self._text = self.separator.join(head + tail)
+        return self._text
+
+    def _open_spill(self):
+        try:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            self.spill_path = os.path.join(self.spill_dir, f"{self.run_id}.txt")
+            self._spill = open(self.spill_path, 'w', encoding='utf-8')
+            # 此前的内容尚未丢弃，全部写入
+            head, tail = self._messages()
+            for message in head + tail:
+                self._write_spill(message)
+            logger.info(f"工作流输出超过 {self.max_bytes} 字节，完整输出写入: {self.spill_path}")
+        except OSError as e:
+            logger.error(f"创建输出落盘文件失败: {str(e)}")
+            self.spill_dir = None
+            self.spill_path = None
+            self._spill = None
+
+    def _write_spill(self, message: str):
+        try:
+            self._spill.write(message)
+            self._spill.write(self.separator)
+        except OSError as e:
+            logger.error(f"写入输出落盘文件失败: {str(e)}")
+
+    def close(self):
+        """关闭落盘文件（不影响已保留的内容）"""
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+    def __enter__(self) -> 'TranscriptBuffer':
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
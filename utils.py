@@ -2,14 +2,17 @@
 工具模块 - 提供飞书 API 调用、消息构建等功能
 """
 
+import hmac
 import re
 import time
 import logging
 import requests
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Tuple
 from datetime import datetime, timezone, timedelta
 
 import config
+from config_reload import on_change
+from circuit_breaker import get_breaker, CircuitOpenError
 
 # 配置日志
 logging.basicConfig(
@@ -18,6 +21,14 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 日志级别支持热更新
+on_change(("LOG_LEVEL",), lambda: logging.getLogger().setLevel(getattr(logging, config.LOG_LEVEL)))
+
+# 飞书依赖的熔断器（token 获取、应用 API 发消息、自定义机器人 Webhook）
+token_breaker = get_breaker("feishu_token")
+feishu_api_breaker = get_breaker("feishu_api")
+webhook_breaker = get_breaker("feishu_webhook")
+
 
 class FeishuTokenManager:
     """飞书 Access Token 管理器，支持缓存"""
@@ -26,10 +37,13 @@ class FeishuTokenManager:
         self._access_token = None
         self._token_expire_time = 0
     
-    def get_tenant_access_token(self) -> Optional[str]:
+    def get_tenant_access_token(self, deadline=None) -> Optional[str]:
         """
         获取租户访问令牌（tenant_access_token）
         如果缓存未过期则返回缓存的 token，否则重新获取
+        
+        Args:
+            deadline: 所属运行的时限（可选），请求超时不会超过剩余时间
         """
         current_time = time.time()
         
@@ -45,8 +59,10 @@ class FeishuTokenManager:
         }
         
         try:
-            response = requests.post(url, json=payload, timeout=10)
-            response.raise_for_status()
+            timeout = request_timeout(deadline)
+            with token_breaker.guard():
+                response = requests.post(url, json=payload, timeout=timeout)
+                response.raise_for_status()
             data = response.json()
             
             if data.get('code') == 0:
@@ -59,15 +75,42 @@ class FeishuTokenManager:
             else:
                 logger.error(f"获取 token 失败: {data.get('msg')}")
                 return None
+        
+        except CircuitOpenError as e:
+            logger.warning(f"获取 tenant_access_token 被熔断: {str(e)}")
+            return None
                 
         except Exception as e:
             logger.error(f"获取 tenant_access_token 异常: {str(e)}")
             return None
+    
+    def invalidate(self):
+        """丢弃缓存的 token（应用凭证变更后调用），下次请求时重新获取"""
+        self._access_token = None
+        self._token_expire_time = 0
+
+
+def request_timeout(deadline=None) -> float:
+    """
+    计算单个 HTTP 请求的超时时间
+    
+    Args:
+        deadline: 所属运行的时限（deadline.RunDeadline），为空时使用默认超时
+    
+    Returns:
+        超时秒数；时限已耗尽时由 deadline 抛出异常
+    """
+    if deadline is None:
+        return config.HTTP_REQUEST_TIMEOUT
+    return deadline.timeout(config.HTTP_REQUEST_TIMEOUT)
 
 
 # 全局 token 管理器实例
 token_manager = FeishuTokenManager()
 
+# 应用凭证或 API 地址变更时丢弃旧 token
+on_change(("FEISHU_APP_ID", "FEISHU_APP_SECRET", "FEISHU_API_BASE"), token_manager.invalidate)
+
 
 def extract_doc_url(text: str) -> Optional[str]:
     """
@@ -205,7 +248,8 @@ def build_rich_text_message(
 
 def send_feishu_message(
     chat_id: str,
-    message_card: Dict[str, Any]
+    message_card: Dict[str, Any],
+    deadline=None
 ) -> bool:
     """
     发送飞书富文本消息卡片到指定群组
@@ -216,6 +260,7 @@ def send_feishu_message(
     Args:
         chat_id: 群组 ID（使用 API 时需要，使用 Webhook 时可忽略）
         message_card: 消息卡片 JSON
+        deadline: 所属运行的时限（可选）
     
     Returns:
         发送成功返回 True，否则返回 False
@@ -225,11 +270,11 @@ def send_feishu_message(
     # 方式1：使用自定义机器人 Webhook
     if hasattr(config, 'USE_CUSTOM_BOT_WEBHOOK') and config.USE_CUSTOM_BOT_WEBHOOK:
         if hasattr(config, 'FEISHU_CUSTOM_BOT_WEBHOOK') and config.FEISHU_CUSTOM_BOT_WEBHOOK:
-            return send_via_custom_bot_webhook(message_card)
+            return send_via_custom_bot_webhook(message_card, deadline=deadline)
     
     # 方式2：使用企业自建应用 API
     # 获取 access token
-    access_token = token_manager.get_tenant_access_token()
+    access_token = token_manager.get_tenant_access_token(deadline=deadline)
     if not access_token:
         logger.error("无法获取 access_token，消息发送失败")
         return False
@@ -252,14 +297,16 @@ def send_feishu_message(
     
     # 发送请求
     try:
-        response = requests.post(
-            url,
-            headers=headers,
-            json=payload,
-            params={"receive_id_type": "chat_id"},
-            timeout=10
-        )
-        response.raise_for_status()
+        timeout = request_timeout(deadline)
+        with feishu_api_breaker.guard():
+            response = requests.post(
+                url,
+                headers=headers,
+                json=payload,
+                params={"receive_id_type": "chat_id"},
+                timeout=timeout
+            )
+            response.raise_for_status()
         data = response.json()
         
         if data.get('code') == 0:
@@ -268,18 +315,23 @@ def send_feishu_message(
         else:
             logger.error(f"消息发送失败（API）: {data.get('msg')}")
             return False
+    
+    except CircuitOpenError as e:
+        logger.warning(f"消息发送被熔断（API）: {str(e)}")
+        return False
             
     except Exception as e:
         logger.error(f"发送消息异常（API）: {str(e)}")
         return False
 
 
-def send_via_custom_bot_webhook(message_card: Dict[str, Any]) -> bool:
+def send_via_custom_bot_webhook(message_card: Dict[str, Any], deadline=None) -> bool:
     """
     通过自定义机器人 Webhook 发送消息
     
     Args:
         message_card: 消息卡片 JSON
+        deadline: 所属运行的时限（可选）
     
     Returns:
         发送成功返回 True，否则返回 False
@@ -295,13 +347,15 @@ def send_via_custom_bot_webhook(message_card: Dict[str, Any]) -> bool:
     }
     
     try:
-        response = requests.post(
-            webhook_url,
-            headers={"Content-Type": "application/json; charset=utf-8"},
-            data=json.dumps(payload),
-            timeout=10
-        )
-        response.raise_for_status()
+        timeout = request_timeout(deadline)
+        with webhook_breaker.guard():
+            response = requests.post(
+                webhook_url,
+                headers={"Content-Type": "application/json; charset=utf-8"},
+                data=json.dumps(payload),
+                timeout=timeout
+            )
+            response.raise_for_status()
         data = response.json()
         
         if data.get('code') == 0 or data.get('StatusCode') == 0:
@@ -310,12 +364,67 @@ def send_via_custom_bot_webhook(message_card: Dict[str, Any]) -> bool:
         else:
             logger.error(f"消息发送失败（Webhook）: {data}")
             return False
+    
+    except CircuitOpenError as e:
+        logger.warning(f"消息发送被熔断（Webhook）: {str(e)}")
+        return False
             
     except Exception as e:
         logger.error(f"发送消息异常（Webhook）: {str(e)}")
         return False
 
 
+def query_doc_metas(request_docs: List[Dict[str, str]], deadline=None) -> Optional[Dict[str, Dict[str, Any]]]:
+    """
+    批量查询云文档元数据（最近修改时间等）
+    
+    Args:
+        request_docs: [{"doc_token": 文档 token, "doc_type": 文档类型}]，单次最多 200 个
+        deadline: 所属运行的时限（可选）
+    
+    Returns:
+        {文档 token: 元数据}，无权限或不存在的文档不在结果中；请求失败返回 None
+    """
+    access_token = token_manager.get_tenant_access_token(deadline=deadline)
+    if not access_token:
+        logger.error("无法获取 access_token，查询文档元数据失败")
+        return None
+    
+    url = f"{config.FEISHU_API_BASE}/drive/v1/metas/batch_query"
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json; charset=utf-8"
+    }
+    payload = {
+        "request_docs": request_docs,
+        "with_url": False
+    }
+    
+    try:
+        timeout = request_timeout(deadline)
+        with feishu_api_breaker.guard():
+            response = requests.post(url, headers=headers, json=payload, timeout=timeout)
+            response.raise_for_status()
+        data = response.json()
+        
+        if data.get('code') != 0:
+            logger.error(f"查询文档元数据失败: {data.get('msg')}")
+            return None
+        
+        result = data.get('data') or {}
+        for failed in result.get('failed_list') or []:
+            logger.info(f"文档元数据不可用: {failed.get('token')}（code={failed.get('code')}）")
+        return {meta['doc_token']: meta for meta in result.get('metas') or []}
+    
+    except CircuitOpenError as e:
+        logger.warning(f"查询文档元数据被熔断: {str(e)}")
+        return None
+    
+    except Exception as e:
+        logger.error(f"查询文档元数据异常: {str(e)}")
+        return None
+
+
 def is_mention_bot(event_data: Dict[str, Any], bot_open_id: str = None) -> bool:
     """
     检查消息是否 @了机器人
@@ -395,3 +504,20 @@ def get_chat_id(event_data: Dict[str, Any]) -> Optional[str]:
         logger.error(f"提取 chat_id 时出错: {str(e)}")
         return None
 
+
+def admin_token_error(expected: str, provided: Optional[str]) -> Optional[Tuple[str, int]]:
+    """
+    校验管理接口的令牌（X-Admin-Token 请求头）
+    
+    Args:
+        expected: 配置的令牌，为空表示接口关闭
+        provided: 请求携带的令牌
+    
+    Returns:
+        校验失败时返回 (错误说明, 状态码)：未配置令牌为 404，令牌缺失或错误为 401；通过时返回 None
+    """
+    if not expected:
+        return "接口未开启", 404
+    if not provided or not hmac.compare_digest(provided, expected):
+        return "未授权", 401
+    return None
@@ -0,0 +1,253 @@
+"""
+文档监听模块 - 定期检查监听列表中的文档，有修改时重新运行工作流
+
+- 监听列表保存在本地 SQLite（WATCH_DB_PATH），通过 /api/watch 增删查
+- 每个扫描周期（WATCH_SCAN_INTERVAL）按文档 token 的哈希分成 WATCH_SCAN_SLOTS 组，
+  每隔 周期/组数 秒扫描一组，请求均匀分布在整个周期内，不会集中爆发
+- 每组文档通过飞书元数据接口批量查询版本（每 200 个文档一次请求），
+  只有版本与上次处理时不同的文档才提交到工作队列（doc_watch）重新运行
+- 首次检查只记录版本，不触发运行；运行失败的文档在下个周期重试
+- 多实例共享同一监听库时，同一文档的同一版本只会被提交一次（coordination.claim_once）
+"""
+
+import random
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, Callable, Dict, Optional
+
+import config
+from utils import logger
+from doc_cache import doc_meta, parse_doc_ref
+from coordination import WorkQueue, claim_once
+
+
+# 文档 token 的哈希取值范围，扫描时再按 WATCH_SCAN_SLOTS 取模分组
+_SLOT_RANGE = 4096
+
+_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS watched_docs (
+        doc_url TEXT PRIMARY KEY,
+        doc_type TEXT NOT NULL,
+        doc_token TEXT NOT NULL,
+        slot INTEGER NOT NULL,
+        revision TEXT,
+        queued_revision TEXT,
+        added_at REAL NOT NULL,
+        checked_at REAL,
+        queued_at REAL
+    )
+    """
+]
+
+_COLUMNS = ("doc_url", "doc_type", "doc_token", "revision", "queued_revision", "added_at", "checked_at", "queued_at")
+
+
+class DocWatcher:
+    """监听列表与定期扫描"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.queue = WorkQueue("doc_watch")
+        self._schema_ready = False
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+        # 统计信息
+        self.scans = 0
+        self.checked = 0
+        self.unresolved = 0
+        self.changed = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=5)
+        conn.row_factory = sqlite3.Row
+        if not self._schema_ready:
+            conn.execute("PRAGMA journal_mode=WAL")
+            for statement in _SCHEMA:
+                conn.execute(statement)
+            conn.commit()
+            self._schema_ready = True
+        return conn
+
+    def add(self, doc_url: str) -> Dict[str, Any]:
+        """
+        添加监听文档（已存在时保持原状态）
+
+        Raises:
+            ValueError: 无法识别的飞书文档链接
+        """
+        ref = parse_doc_ref(doc_url)
+        if ref is None:
+            raise ValueError(f"无法识别的飞书文档链接: {doc_url}")
+        doc_type, token = ref
+        conn = self._connect()
+        try:
+            conn.execute(
+                "INSERT OR IGNORE INTO watched_docs (doc_url, doc_type, doc_token, slot, added_at) VALUES (?, ?, ?, ?, ?)",
+                (doc_url, doc_type, token, zlib.crc32(token.encode()) % _SLOT_RANGE, time.time())
+            )
+            conn.commit()
+            row = conn.execute(
+                f"SELECT {', '.join(_COLUMNS)} FROM watched_docs WHERE doc_url = ?", (doc_url,)
+            ).fetchone()
+        finally:
+            conn.close()
+        logger.info(f"添加监听文档: {doc_url}")
+        return dict(row)
+
+    def remove(self, doc_url: str) -> bool:
+        """取消监听，文档不在列表中时返回 False"""
+        conn = self._connect()
+        try:
+            removed = conn.execute("DELETE FROM watched_docs WHERE doc_url = ?", (doc_url,)).rowcount
+            conn.commit()
+        finally:
+            conn.close()
+        if removed:
+            logger.info(f"取消监听文档: {doc_url}")
+        return removed > 0
+
+    def list(self, limit: int = 50, offset: int = 0) -> Dict[str, Any]:
+        """
+        分页查询监听列表（按添加时间倒序）
+
+        Returns:
+            {"docs": [...], "total": 总数, "limit": ..., "offset": ..., "next_offset": 下一页偏移或 None}
+        """
+        conn = self._connect()
+        try:
+            total = conn.execute("SELECT COUNT(*) FROM watched_docs").fetchone()[0]
+            rows = conn.execute(
+                f"SELECT {', '.join(_COLUMNS)} FROM watched_docs ORDER BY added_at DESC LIMIT ? OFFSET ?",
+                (limit, offset)
+            ).fetchall()
+        finally:
+            conn.close()
+
+        next_offset = offset + len(rows)
+        return {
+            "docs": [dict(row) for row in rows],
+            "total": total,
+            "limit": limit,
+            "offset": offset,
+            "next_offset": next_offset if next_offset < total else None
+        }
+
+    def scan_slot(self, slot: int, slots: int = None) -> int:
+        """
+        检查一组文档的版本，把有修改的文档提交到工作队列
+
+        Args:
+            slot: 组号
+            slots: 总组数，默认 WATCH_SCAN_SLOTS
+
+        Returns:
+            提交运行的文档数
+        """
+        slots = slots or config.WATCH_SCAN_SLOTS
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT doc_url, doc_type, doc_token, revision, queued_revision FROM watched_docs WHERE slot % ? = ?",
+                (slots, slot)
+            ).fetchall()
+            if not rows:
+                return 0
+
+            revisions = doc_meta.revisions([(row["doc_type"], row["doc_token"]) for row in rows])
+            now = time.time()
+            checked, queued, changed = [], [], []
+            for row in rows:
+                revision = revisions.get((row["doc_type"], row["doc_token"]))
+                if revision is None:
+                    self.unresolved += 1
+                    continue
+                checked.append((revision, now, row["doc_url"]))
+                if row["revision"] is None:
+                    # 首次检查：只记录版本
+                    queued.append((revision, now, row["doc_url"]))
+                elif revision != row["queued_revision"]:
+                    changed.append((row, revision))
+
+            submitted = 0
+            for row, revision in changed:
+                if not claim_once(f"watch:{row['doc_type']}:{row['doc_token']}:{revision}", config.WATCH_SCAN_INTERVAL / 2):
+                    continue
+                self.queue.submit({"doc_url": row["doc_url"], "revision": revision})
+                queued.append((revision, now, row["doc_url"]))
+                submitted += 1
+                logger.info(f"监听文档已修改，提交重新运行: {row['doc_url']}")
+
+            conn.executemany("UPDATE watched_docs SET revision = ?, checked_at = ? WHERE doc_url = ?", checked)
+            conn.executemany("UPDATE watched_docs SET queued_revision = ?, queued_at = ? WHERE doc_url = ?", queued)
+            conn.commit()
+        finally:
+            conn.close()
+
+        self.scans += 1
+        self.checked += len(rows)
+        self.changed += submitted
+        return submitted
+
+    def retry_later(self, doc_url: str, revision: str):
+        """运行失败：清除提交记录，下个扫描周期重新提交"""
+        conn = self._connect()
+        try:
+            conn.execute(
+                "UPDATE watched_docs SET queued_revision = NULL WHERE doc_url = ? AND queued_revision = ?",
+                (doc_url, revision)
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def start(self, handler: Callable[[Dict[str, Any]], None]):
+        """
+        启动扫描线程和处理 worker
+
+        Args:
+            handler: 处理一个有修改的文档，参数为 {"doc_url", "revision"}
+        """
+        if self._thread is not None:
+            return
+        self.queue.start_workers(handler, config.WATCH_WORKERS)
+        self._thread = threading.Thread(target=self._scan_loop, name="doc-watcher", daemon=True)
+        self._thread.start()
+        logger.info(f"文档监听已启动: 每 {config.WATCH_SCAN_INTERVAL} 秒扫描一轮，分 {config.WATCH_SCAN_SLOTS} 组")
+
+    def stop(self):
+        self._stop.set()
+        self.queue.stop_workers()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _scan_loop(self):
+        slots = config.WATCH_SCAN_SLOTS
+        tick = config.WATCH_SCAN_INTERVAL / slots
+        # 从随机的组开始，多个实例的扫描不会对齐
+        slot = random.randrange(slots)
+        while not self._stop.wait(tick):
+            try:
+                self.scan_slot(slot, slots)
+            except Exception as e:
+                logger.error(f"扫描监听文档出错（第 {slot} 组）: {str(e)}")
+            slot = (slot + 1) % slots
+
+    def snapshot(self) -> Dict[str, Any]:
+        """监听状态，用于健康检查"""
+        return {
+            "running": self._thread is not None,
+            "scans": self.scans,
+            "checked": self.checked,
+            "unresolved": self.unresolved,
+            "changed": self.changed,
+            "queue": self.queue.snapshot()
+        }
+
+
+# 全局监听实例（api.py 使用）
+doc_watcher = DocWatcher(config.WATCH_DB_PATH)
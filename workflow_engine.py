@@ -0,0 +1,522 @@
+"""
+工作流运行引擎 - api.py 与 AIcase.py 共用的 Coze 工作流运行流程
+
+- 一次运行：缓存查询 → 共享限额与并发名额 → 流式调用（首个事件迟到时对冲）→ 中断自动恢复
+  → 提取输出 → 发送通知 → 写入运行历史
+- Coze 客户端由本模块统一创建，Coze 凭证或地址热更新后重建（见 current_coze_client）
+- 各入口的差异通过构造参数（钩子）配置：
+  - transport：通知发送方式，如自定义机器人 Webhook（api）或发送到触发消息的群聊（机器人）
+  - admit：并发控制，默认检查共享限额后向 workflow_scheduler 申请名额
+  - use_cache：按文档版本缓存成功的结果（见 doc_cache）
+  - record_history：是否写入运行历史（基准测试关闭）
+  - add_listener：每次运行结束时回调 (RunRecord, 结果)，用于指标统计
+- 工作流的入参名为 COZE_WORKFLOW_INPUT_PARAM，所有入口一致
+- 客户端可替换为录制回放或合成的事件流，单独测量引擎自身的开销：
+    python workflow_engine.py --messages 200 --interrupts 2 --repeat 50
+    python workflow_engine.py recordings/xxx.jsonl --repeat 20
+"""
+
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import config
+from utils import build_rich_text_message, logger
+from deadline import RunDeadline, RunCancelled, DeadlineExceeded, CANCEL_CLIENT_GONE, iter_stream
+from hedging import hedged_stream
+from circuit_breaker import get_breaker, is_dependency_failure, CircuitOpenError
+from concurrency import LimitExceeded, Permit, report_result
+from scheduler import workflow_scheduler
+from coordination import check_rate
+from run_history import RunRecord, run_history
+from stream_recorder import recording_client
+from transcript import TranscriptBuffer
+from config_reload import on_change
+import doc_cache
+
+from cozepy import Coze, TokenAuth, WorkflowEventType
+
+
+# 中断恢复的最大嵌套深度
+MAX_RESUME_DEPTH = 10
+
+# 从工作流消息中提取 output 的正则表达式（按顺序尝试）
+_OUTPUT_PATTERNS = [
+    re.compile(r'"output"\s*:\s*"([^"]+)"'),
+    re.compile(r'output\s*:\s*"([^"]+)"'),
+    re.compile(r'output\s*:\s*([^\s\n,\}]+)'),
+]
+
+# 进行中运行的工作流输出 {运行 ID: TranscriptBuffer}，供内存诊断统计
+active_transcripts: Dict[str, TranscriptBuffer] = {}
+
+
+def _build_coze_client() -> Coze:
+    return Coze(
+        auth=TokenAuth(token=config.COZE_API_TOKEN),
+        base_url=config.COZE_API_BASE
+    )
+
+
+# 各入口共用的 Coze 客户端
+_coze_client = _build_coze_client()
+
+
+def current_coze_client() -> Coze:
+    """当前的 Coze 客户端（配置热更新后为重建的客户端）"""
+    return _coze_client
+
+
+def _reload_coze_client():
+    """Coze 凭证或地址变更后重建客户端（进行中的运行继续使用原客户端）"""
+    global _coze_client
+    _coze_client = _build_coze_client()
+    logger.info("已按新配置重建 Coze 客户端")
+
+
+# 配置热更新：订阅 Coze 配置变化
+on_change(("COZE_API_TOKEN", "COZE_API_BASE"), _reload_coze_client)
+
+
+class WorkflowError(Exception):
+    """工作流自身报告的错误（ERROR 事件），属于业务失败，不计入熔断"""
+
+    breaker_neutral = True
+
+
+def admit_scheduled(priority: str, deadline: RunDeadline) -> Permit:
+    """
+    默认的并发控制：先检查所有实例共享的限额，再按优先级申请并发名额
+
+    排队只能占用运行时限中多出的部分：至少为工作流阶段留下 WORKFLOW_MIN_RUN_TIME 秒，
+    并为通知留下 NOTIFY_TIMEOUT_RESERVE 秒；排队超时与上游无关，不影响熔断器和并发上限
+
+    Raises:
+        LimitExceeded: 限额已满或排队超时
+    """
+    check_rate("coze_workflow")
+    wait = deadline.remaining() - config.NOTIFY_TIMEOUT_RESERVE - config.WORKFLOW_MIN_RUN_TIME
+    return workflow_scheduler.acquire(priority, timeout=max(wait, 0.0))
+
+
+def extract_output(transcript: TranscriptBuffer) -> Optional[str]:
+    """
+    从工作流消息中提取输出链接：先查最后一条消息（多数工作流在最后输出结果），再查全部消息
+
+    Returns:
+        带协议前缀的链接，未找到时返回 None
+    """
+    if not transcript:
+        return None
+    for text in (transcript.last, transcript.text()):
+        for pattern in _OUTPUT_PATTERNS:
+            match = pattern.search(text)
+            if match:
+                output = match.group(1)
+                if not output.startswith(('http://', 'https://')):
+                    output = f"http://{output}"
+                return output
+    return None
+
+
+class WorkflowEngine:
+    """Coze 工作流运行引擎（线程安全，每个入口一个实例）"""
+
+    def __init__(
+        self,
+        source: str,
+        client: Callable[[], Any] = current_coze_client,
+        transport: Callable[[Optional[str], Dict[str, Any], RunDeadline], bool] = None,
+        admit: Callable[[str, RunDeadline], Permit] = admit_scheduled,
+        use_cache: bool = True,
+        notify_rejected: bool = False,
+        record_history: bool = True
+    ):
+        """
+        Args:
+            source: 运行来源（api / bot），写入运行历史
+            client: 返回当前 Coze 客户端的函数，默认为 current_coze_client（随配置热更新重建）
+            transport: 发送通知卡片 (chat_id, card, deadline) -> 是否成功，为空时不发送通知
+            admit: 申请并发名额 (priority, deadline) -> Permit
+            use_cache: 是否按文档版本缓存结果
+            notify_rejected: 被拒绝（限额已满、熔断）时是否也发送通知
+            record_history: 是否把运行记录写入运行历史
+        """
+        self.source = source
+        self._client = client
+        self._transport = transport
+        self._admit = admit
+        self.use_cache = use_cache
+        self.notify_rejected = notify_rejected
+        self.record_history = record_history
+        self._listeners: List[Callable[[RunRecord, Dict[str, Any]], None]] = []
+        self._lock = threading.Lock()
+
+        # 统计信息
+        self.runs = 0
+        self.cached = 0
+        self.rejected = 0
+        self.failed = 0
+
+    def add_listener(self, listener: Callable[[RunRecord, Dict[str, Any]], None]):
+        """订阅运行结束：listener(运行记录, 结果) 在运行线程中调用，应尽快返回"""
+        self._listeners.append(listener)
+
+    def run(
+        self,
+        doc_url: str,
+        priority: str,
+        deadline: RunDeadline,
+        chat_id: str = None,
+        workflow_id: str = None,
+        client=None
+    ) -> Dict[str, Any]:
+        """
+        完整运行一次：缓存 → 并发名额 → 工作流 → 通知
+
+        Args:
+            doc_url: 文档链接
+            priority: 优先级类别（interactive / bot / bulk）
+            deadline: 本次运行的总时限（工作流阶段为通知预留 NOTIFY_TIMEOUT_RESERVE 秒）
+            chat_id: 飞书群组 ID（机器人来源时有值，作为通知目标）
+            workflow_id: 工作流 ID（默认 COZE_WORKFLOW_ID）
+            client: 替换 Coze 客户端（回放录制时传入 stream_recorder.ReplayClient）
+
+        Returns:
+            execute 的返回结果；命中缓存时含 cached=True，被拒绝时含 retry_after
+        """
+        # 缓存键与实际调用使用同一个工作流 ID（运行期间配置可能热更新）
+        workflow_id = workflow_id or config.COZE_WORKFLOW_ID
+        cache_key = None
+        if self.use_cache:
+            # 文档自上次运行后未修改时直接使用缓存的结果，不占用限额和并发名额
+            cache_key, result = doc_cache.lookup(doc_url, workflow_id)
+            if result is not None:
+                logger.info(f"文档未修改，使用缓存的工作流结果: {doc_url}")
+                result['cached'] = True
+                self._finish(RunRecord(source=self.source, doc_url=doc_url, chat_id=chat_id), result)
+                self.notify(doc_url, result, deadline, chat_id)
+                return result
+
+        try:
+            permit = self._admit(priority, deadline)
+        except LimitExceeded as e:
+            logger.warning(f"并发已达上限，拒绝运行: {doc_url}")
+            result = {"success": False, "error": str(e), "retry_after": e.retry_after}
+            self._finish(RunRecord(source=self.source, doc_url=doc_url, chat_id=chat_id), result)
+            if self.notify_rejected:
+                self.notify(doc_url, result, deadline, chat_id)
+            return result
+
+        # 工作流阶段提前到期，为发送通知预留时间；完成后立即归还并发名额
+        try:
+            stage = deadline.child(reserve=config.NOTIFY_TIMEOUT_RESERVE)
+        except DeadlineExceeded as e:
+            # 剩余时间已不足以运行工作流：不调用上游，只归还名额
+            permit.release()
+            logger.warning(f"剩余时间不足，放弃运行工作流: {doc_url}")
+            result = {"success": False, "error": "工作流执行超时", "cancelled": e.reason}
+            self._finish(RunRecord(source=self.source, doc_url=doc_url, chat_id=chat_id), result)
+        else:
+            with stage, permit:
+                result = self.execute(
+                    doc_url, deadline=stage, client=client, cache_key=cache_key,
+                    chat_id=chat_id, workflow_id=workflow_id
+                )
+                report_result(permit, result)
+
+        if result.get('cancelled') == CANCEL_CLIENT_GONE:
+            # 客户端已放弃，不再发送通知
+            return result
+        if 'retry_after' in result and not self.notify_rejected:
+            # 上游已熔断，不发送注定失败的通知
+            return result
+        self.notify(doc_url, result, deadline, chat_id)
+        return result
+
+    def execute(
+        self,
+        doc_url: str,
+        deadline: RunDeadline = None,
+        client=None,
+        cache_key=None,
+        chat_id: str = None,
+        workflow_id: str = None
+    ) -> Dict[str, Any]:
+        """
+        执行工作流（流式调用、中断自动恢复、提取输出），并记录运行历史
+
+        Args:
+            doc_url: 文档链接
+            deadline: 本次运行的时限（可选），到期或被取消时会中断流式调用并释放连接
+            client: 提供 workflows.runs.stream/resume 的客户端（可选，默认使用当前 Coze 客户端）
+            cache_key: 文档版本缓存键（可选，见 doc_cache.lookup），成功的结果按此键缓存
+            chat_id: 飞书群组 ID（可选，写入运行历史）
+            workflow_id: 工作流 ID（默认 COZE_WORKFLOW_ID）
+
+        Returns:
+            {"success", "result", "output"}，失败时为 {"success": False, "error"}；
+            熔断时含 retry_after，被取消时含 cancelled（取消原因），另含 first_event_ms
+        """
+        record = RunRecord(source=self.source, doc_url=doc_url, chat_id=chat_id)
+        if client is None:
+            client = recording_client(self._client(), record.run_id)
+
+        own_deadline = deadline is None
+        if own_deadline:
+            deadline = RunDeadline(config.WORKFLOW_RUN_TIMEOUT)
+        try:
+            result = self._stream(doc_url, workflow_id or config.COZE_WORKFLOW_ID, deadline, record, client)
+        finally:
+            if own_deadline:
+                deadline.close()
+
+        if cache_key is not None and result.get('success'):
+            doc_cache.result_cache.put(cache_key, result)
+
+        # 首个事件延迟，供并发限制器作为延迟样本
+        result['first_event_ms'] = record.first_event_ms
+        self._finish(record, result)
+        return result
+
+    def _stream(self, doc_url: str, workflow_id: str, deadline: RunDeadline, record: RunRecord, client) -> Dict[str, Any]:
+        # 所有消息（有界缓冲，超出上限时只保留开头和结尾）
+        transcript = TranscriptBuffer(record.run_id)
+        active_transcripts[record.run_id] = transcript
+
+        params = {
+            "workflow_id": workflow_id,
+            "parameters": {config.COZE_WORKFLOW_INPUT_PARAM: doc_url}
+        }
+        # 工作流关联智能体时需要 bot_id
+        if config.COZE_BOT_ID:
+            params["bot_id"] = config.COZE_BOT_ID
+
+        try:
+            logger.info(f"开始调用工作流: {params}")
+
+            # 调用前已到期（排队过久等）与 Coze 无关，在熔断器之外检查
+            deadline.check()
+
+            # 在 Coze 熔断器保护下进行流式调用（含中断恢复）
+            with get_breaker("coze").guard():
+                deadline.begin_upstream()
+                # 首个事件迟迟不到时可能发起对冲调用
+                events = hedged_stream(lambda: client.workflows.runs.stream(**params), deadline)
+                self._consume(events, workflow_id, deadline, record, transcript, client, depth=0)
+
+            output = extract_output(transcript)
+            logger.info(
+                f"工作流事件流结束: {len(transcript)} 条消息，共 {transcript.total_bytes} 字节"
+                + (f"（省略中间 {transcript.omitted_bytes} 字节）" if transcript.truncated else "")
+            )
+            if output:
+                logger.info(f"✅ 提取到输出链接: {output}")
+            else:
+                logger.warning(f"⚠️ 未能从工作流消息中提取到 output 变量，请检查工作流是否正确输出: {transcript.text()}")
+
+            return {
+                "success": True,
+                "result": transcript.text() if transcript else "工作流执行完成",
+                "output": output
+            }
+
+        except WorkflowError as e:
+            logger.error(f"工作流执行错误: {str(e)}")
+            return {"success": False, "error": str(e)}
+
+        except CircuitOpenError as e:
+            logger.warning(f"工作流调用被熔断: {str(e)}")
+            return {"success": False, "error": str(e), "retry_after": e.retry_after}
+
+        except RunCancelled as e:
+            logger.warning(f"工作流运行已取消: {e.reason}")
+            return {
+                "success": False,
+                "error": "工作流执行超时" if e.reason != CANCEL_CLIENT_GONE else "客户端已断开",
+                "cancelled": e.reason,
+                # 上游调用开始后才到期时为 True（见 deadline.DeadlineExceeded）
+                "upstream_failure": is_dependency_failure(e)
+            }
+
+        except Exception as e:
+            logger.error(f"处理工作流时发生异常: {str(e)}")
+            return {"success": False, "error": str(e), "upstream_failure": is_dependency_failure(e)}
+
+        finally:
+            active_transcripts.pop(record.run_id, None)
+            transcript.close()
+
+    def _consume(self, events, workflow_id: str, deadline: RunDeadline, record: RunRecord,
+                 transcript: TranscriptBuffer, client, depth: int):
+        """
+        处理一段事件流；遇到中断时立即恢复并处理恢复后的事件流（可能多次嵌套中断）
+
+        Raises:
+            WorkflowError: 工作流报告错误，或中断嵌套过深
+        """
+        for event in events:
+            record.on_event(event.event)
+
+            if event.event == WorkflowEventType.MESSAGE:
+                if event.message:
+                    transcript.append(str(event.message))
+
+            elif event.event == WorkflowEventType.ERROR:
+                raise WorkflowError(str(event.error))
+
+            elif event.event == WorkflowEventType.INTERRUPT:
+                if depth >= MAX_RESUME_DEPTH:
+                    raise WorkflowError("中断嵌套过深，可能存在循环")
+                interrupt_data = event.interrupt.interrupt_data
+                logger.info(f"工作流中断，自动恢复执行（深度: {depth}）: {event.interrupt}")
+                deadline.check()
+                resume_stream = client.workflows.runs.resume(
+                    workflow_id=workflow_id,
+                    event_id=interrupt_data.event_id,
+                    resume_data="",
+                    interrupt_type=interrupt_data.type
+                )
+                self._consume(iter_stream(resume_stream, deadline), workflow_id, deadline,
+                              record, transcript, client, depth + 1)
+
+            else:
+                logger.debug(f"其他事件类型: {event.event}: {event}")
+
+    def notify(self, doc_url: str, result: Dict[str, Any], deadline: RunDeadline, chat_id: str = None) -> bool:
+        """
+        把运行结果发送到飞书群（未配置 transport 时不发送）
+
+        Args:
+            doc_url: 文档链接
+            result: execute 的返回结果
+            deadline: 本次运行的时限
+            chat_id: 飞书群组 ID（发送到指定群聊的 transport 使用）
+
+        Returns:
+            是否发送成功
+        """
+        if self._transport is None:
+            return False
+        if result['success']:
+            card = build_rich_text_message(
+                doc_url=doc_url,
+                workflow_result=result.get('result', '工作流执行完成'),
+                workflow_output=result.get('output'),
+                status="success"
+            )
+        else:
+            card = build_rich_text_message(
+                doc_url=doc_url,
+                workflow_result=f"执行失败: {result.get('error', '未知错误')}",
+                status="error"
+            )
+
+        try:
+            sent = self._transport(chat_id, card, deadline)
+        except Exception as e:
+            logger.error(f"发送通知失败: {str(e)}")
+            sent = False
+        if sent:
+            logger.info(f"成功发送结果通知: {chat_id or doc_url}")
+        else:
+            logger.warning(f"发送结果通知失败: {chat_id or doc_url}")
+        return sent
+
+    def _finish(self, record: RunRecord, result: Dict[str, Any]):
+        # 结束运行记录，异步写入运行历史（不增加请求耗时），并通知监听者
+        record.finish_from_result(result)
+        if self.record_history:
+            run_history.record(record)
+        with self._lock:
+            self.runs += 1
+            if result.get('cached'):
+                self.cached += 1
+            elif 'retry_after' in result:
+                self.rejected += 1
+            elif not result.get('success'):
+                self.failed += 1
+        for listener in self._listeners:
+            try:
+                listener(record, result)
+            except Exception as e:
+                logger.error(f"运行监听回调出错: {str(e)}")
+
+    def snapshot(self) -> Dict[str, Any]:
+        """运行统计，用于健康检查"""
+        with self._lock:
+            return {
+                "runs": self.runs,
+                "cached": self.cached,
+                "rejected": self.rejected,
+                "failed": self.failed,
+                "active": len(active_transcripts)
+            }
+
+
+def benchmark(client, doc_url: str, repeat: int) -> Dict[str, Any]:
+    """
+    用给定客户端（回放或合成的事件流）反复执行工作流，统计引擎自身的处理开销
+
+    不发送通知、不使用缓存、不写入运行历史
+
+    Returns:
+        {"runs", "result", "min_ms", "p50_ms", "p95_ms", "max_ms", "events": 每次运行的消息数与中断数}
+    """
+    engine = WorkflowEngine("benchmark", client=lambda: client, transport=None, use_cache=False, record_history=False)
+    counts: List[Dict[str, int]] = []
+    engine.add_listener(lambda record, result: counts.append({
+        "messages": record.message_count, "interrupts": record.interrupt_count
+    }))
+
+    durations = []
+    result = None
+    for _ in range(repeat):
+        if hasattr(client, 'reset'):
+            client.reset()
+        started = time.perf_counter()
+        result = engine.execute(doc_url, client=client)
+        durations.append((time.perf_counter() - started) * 1000)
+
+    durations.sort()
+    return {
+        "runs": repeat,
+        "result": {key: result.get(key) for key in ("success", "output", "error")},
+        "min_ms": round(durations[0], 2),
+        "p50_ms": round(durations[len(durations) // 2], 2),
+        "p95_ms": round(durations[int(len(durations) * 0.95)], 2),
+        "max_ms": round(durations[-1], 2),
+        "events": counts[-1] if counts else {}
+    }
+
+
+def main():
+    """
+    命令行基准测试：用录制文件或合成的事件流驱动引擎，不访问网络
+    """
+    import argparse
+    import json
+
+    from stream_recorder import ReplayClient, synthetic_segments
+
+    parser = argparse.ArgumentParser(description="工作流运行引擎基准测试")
+    parser.add_argument("path", nargs="?", help="录制文件路径（为空时使用合成的事件流）")
+    parser.add_argument("--speed", type=float, default=0, help="回放速度倍数（0 表示不等待）")
+    parser.add_argument("--repeat", type=int, default=20, help="运行次数")
+    parser.add_argument("--messages", type=int, default=50, help="合成事件流：每段的消息数")
+    parser.add_argument("--message-bytes", type=int, default=200, help="合成事件流：每条消息的字节数")
+    parser.add_argument("--interrupts", type=int, default=0, help="合成事件流：中断恢复次数")
+    args = parser.parse_args()
+
+    if args.path:
+        client = ReplayClient(args.path, speed=args.speed)
+    else:
+        client = ReplayClient(segments=synthetic_segments(args.messages, args.message_bytes, args.interrupts), speed=args.speed)
+    doc_url = client.segments[0]["params"].get("parameters", {}).get(config.COZE_WORKFLOW_INPUT_PARAM, "")
+
+    print(json.dumps(benchmark(client, doc_url, args.repeat), ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()